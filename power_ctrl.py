@@ -1,40 +1,604 @@
 #!/usr/bin/env python3
+from array import array
+from collections import OrderedDict
 from http import cookies
-from bs4 import BeautifulSoup
 import http.client
+import os
+import socket
 import sys
+import time
 import urllib.parse
 
-class sp8h:
+# Callables called with a dict for every request event of every device, see http_device.emit().
+HOOKS = []
+
+class power_ctrl_error(Exception):
     """
-    A Python class to access Smart Power 8H power switch.
-    This mimics web access because we don't know how to use API interface.
-    For now, this library only supports turn on/off directly via http interface.
+    Base class of all errors raised by the power_ctrl drivers.
     """
 
-    POWER_OFF = 2
-    POWER_ON = 1
-    POWER_RST = 3
+class connection_error(power_ctrl_error):
+    """
+    The device could not be reached, or dropped the connection.
+    """
 
-    LOGIN_STS_OK = b'0'
-    LOGIN_STS_FAIL = b'1'
-    LOGIN_STS_FULL = b'2'
+class timeout_error(connection_error):
+    """
+    Connecting to the device or waiting for its reply took longer than the timeout.
+    """
 
-    LOGIN_URL = "/login_auth.csp"
-    LOGOUT_URL = "/logout.csp"
-    POWER_CTL_URL = "/power_monitor_frame.csp"
-    POWER_STS_URL = POWER_CTL_URL
+class circuit_open_error(connection_error):
+    """
+    The device failed too often in a row, requests are refused until a probe reaches it again.
+    """
+
+class response_error(power_ctrl_error):
+    """
+    The device replied with an unexpected HTTP status.
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class auth_error(response_error):
+    """
+    Login failed, or the device rejected the session.
+    """
+
+class session_full_error(auth_error):
+    """
+    The SP8H refused the login because all its login slots are in use.
+    """
+
+class parse_error(power_ctrl_error):
+    """
+    A status page could not be parsed.
+    """
+
+class port_state:
+    """
+    On/off of the ports of one SP8H machine or AW-2401 as a bitmask, bit 0 is power id 1.
+    Works as a set of power ids: iterating gives the ids that are set, and
+    | & - ^ ~ are union, mask, difference, diff (ports that differ) and the
+    complement within ports.
+    """
+
+    __slots__ = ('bits', 'ports')
+
+    def __init__(self, bits=0, ports=8):
+        self.bits = bits & ((1 << ports) - 1)
+        self.ports = ports
+
+    @classmethod
+    def from_ids(cls, power_ids, ports=8):
+        bits = 0
+        for pid in power_ids:
+            if pid < 1 or pid > ports:
+                raise ValueError("Invalid power id {}".format(pid))
+            bits |= 1 << (pid - 1)
+        return cls(bits, ports)
+
+    @classmethod
+    def all(cls, ports=8):
+        return cls((1 << ports) - 1, ports)
+
+    def ids(self):
+        return [i + 1 for i in range(self.ports) if self.bits >> i & 1]
+
+    def __iter__(self):
+        return iter(self.ids())
+
+    def __contains__(self, pid):
+        return 1 <= pid <= self.ports and bool(self.bits >> (pid - 1) & 1)
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __or__(self, other):
+        return port_state(self.bits | other.bits, max(self.ports, other.ports))
+
+    def __and__(self, other):
+        return port_state(self.bits & other.bits, max(self.ports, other.ports))
+
+    def __sub__(self, other):
+        return port_state(self.bits & ~other.bits, self.ports)
+
+    def __xor__(self, other):
+        return port_state(self.bits ^ other.bits, max(self.ports, other.ports))
+
+    def __invert__(self):
+        return port_state(~self.bits, self.ports)
+
+    def union(self, other):
+        return self | other
+
+    def mask(self, other):
+        return self & other
+
+    def diff(self, other):
+        """
+        The ports whose state differs between self and other.
+        """
+        return self ^ other
+
+    def __eq__(self, other):
+        if isinstance(other, port_state):
+            return self.bits == other.bits
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __repr__(self):
+        return 'port_state(0b{:0{}b}, ports={})'.format(self.bits, self.ports, self.ports)
+
+class port_status:
+    """
+    Port states and amperes of one SP8H machine or AW-2401, as parsed from a status page.
+    states holds one b'1' (on) or b'0' (off) per port, amperes one float per port if the
+    device reports them. The amperes are only converted on first use, most callers never
+    look at them. Indexing keeps the old [status, ampere] pair form, with the ampere
+    string as the device sent it, e.g. '0.10'.
+    """
+
+    __slots__ = ('states', '_amperes', '_raw_amperes', '_ampere_text')
+
+    def __init__(self, states=b'', amperes=None, raw_amperes=None):
+        self.states = states
+        self._amperes = amperes
+        self._raw_amperes = raw_amperes
+        self._ampere_text = None
+
+    @property
+    def state(self):
+        """
+        The port states as a port_state.
+        """
+        return port_state(int(self.states[::-1], 2) if self.states else 0, len(self.states))
+
+    @property
+    def amperes(self):
+        if self._amperes is None and self._raw_amperes is not None:
+            try:
+                self._amperes = array('d', map(float, self._raw_amperes.split(b"','")))
+            except ValueError as e:
+                raise parse_error('Unexpected ampere value: ' + str(e)) from None
+        return self._amperes
+
+    def ampere_text(self):
+        """
+        The ampere strings of the ports, from the page if parsed from one.
+        """
+        if self._ampere_text is None and self.amperes is not None:
+            if self._raw_amperes is not None:
+                self._ampere_text = self._raw_amperes.decode('ascii').split("','")
+            else:
+                self._ampere_text = [repr(a) for a in self._amperes]
+        return self._ampere_text
+
+    def __len__(self):
+        return len(self.states)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(len(self))[idx]]
+        amperes = self.ampere_text()
+        return [chr(self.states[idx]), amperes[idx] if amperes is not None else None]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, port_status):
+            return self.states == other.states and self.amperes == other.amperes
+        return list(self) == other
+
+    def __repr__(self):
+        return 'port_status(states={!r}, amperes={!r})'.format(self.states, self.amperes)
+
+def parse_sp8h_status(data):
+    """
+    Parse the SP8H power monitor frame, e.g. [['P1','P2'],['1','0'],['0.12','0.00']].
+    An empty or "TimeOut" page gives an empty port_status.
+    """
+    data = data.rstrip()
+    if not data or data == b"TimeOut":
+        return port_status()
+
+    first = data.find(b"],[")
+    second = data.find(b"],[", first + 3)
+    if first < 0 or second < 0 or not data.endswith(b"']]"):
+        raise parse_error('Unexpected power monitor frame')
+
+    # Every state is one character between quotes, so dropping the separators leaves them packed.
+    states = data[first + 4:second - 1].replace(b"','", b"")
+    if len(states) != data.count(b"','", first, second) + 1:
+        raise parse_error('Unexpected power status')
+
+    # Like the zip() of the old parser, a short ampere list cuts the states.
+    count = data.count(b"','", second) + 1
+    if count < len(states):
+        states = states[:count]
+    return port_status(states, raw_amperes=data[second + 4:-3])
+
+def parse_aw2401_status(data):
+    """
+    Parse the AW-2401 port mode page, the value of each <input> tag is 'on' or 'off'.
+    Falls back to BeautifulSoup, if installed, for markup the scanner does not understand.
+    """
+    lower = data.lower()
+    states = bytearray()
+    pos = lower.find(b"<input")
+    while pos >= 0:
+        end = lower.find(b">", pos)
+        attr = lower.find(b"value=", pos, end)
+        if end < 0 or attr < 0 or lower[attr - 1] not in b" \t\r\n":
+            return parse_aw2401_status_soup(data)
+        attr += 6
+        quote = data[attr:attr + 1]
+        if quote in (b'"', b"'"):
+            value = lower[attr + 1:lower.find(quote, attr + 1)]
+        else:
+            value = lower[attr:end].split(None, 1)[0].rstrip(b"/")
+        states += b'1' if value == b'on' else b'0'
+        pos = lower.find(b"<input", end)
+    return port_status(bytes(states))
+
+def parse_aw2401_status_soup(data):
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        raise parse_error('Unexpected port mode page')
+
+    soup = BeautifulSoup(data, "html.parser")
+    return port_status(b''.join(b'1' if tag.get('value', '').lower() == 'on' else b'0' for tag in soup.find_all('input')))
+
+class session_cache:
+    """
+    An on-disk cache of SP8H login sessions, keyed by device ip and user.
+    Concurrent processes take a file lock around login, so they share one
+    session instead of each using a login slot.
+    """
+
+    DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "power_ctrl", "sessions.json")
+    DEFAULT_TTL = 300
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        self.path = path if path else self.DEFAULT_PATH
+        self.ttl = ttl
+        self.lock_fd = None
+        self.lock_depth = 0
+
+    def __enter__(self):
+        self.lock()
+        return self
+
+    def __exit__(self, *exc):
+        self.unlock()
+
+    def lock(self):
+        """
+        Take the exclusive cache lock, blocks until other processes release it.
+        """
+        self.lock_depth += 1
+        if self.lock_depth > 1:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(self.lock_fd, msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+
+    def unlock(self):
+        """
+        Release the cache lock.
+        """
+        self.lock_depth -= 1
+        if self.lock_depth > 0:
+            return
+
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(self.lock_fd, msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        os.close(self.lock_fd)
+        self.lock_fd = None
+
+    def key(self, target_url, port, user):
+        return "{}:{}/{}".format(target_url, port, user)
+
+    def read_db(self):
+        import json
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_db(self, db):
+        import json
+        now = time.time()
+        db = {k: v for (k, v) in db.items() if v.get("expires", 0) > now}
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(db, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self, target_url, port, user):
+        """
+        Return the cookie string of a still valid session, or None.
+        """
+        entry = self.entry(target_url, port, user)
+        return entry[0] if entry is not None else None
+
+    def entry(self, target_url, port, user):
+        """
+        Return (cookie string, expiry time) of a still valid session, or None.
+        """
+        with self:
+            entry = self.read_db().get(self.key(target_url, port, user))
+        if entry is None or entry.get("expires", 0) <= time.time():
+            return None
+        return (entry.get("cookie"), entry["expires"])
+
+    def store(self, target_url, port, user, cookie_str):
+        """
+        Store or refresh a session, it expires ttl seconds from now. Returns the expiry time.
+        """
+        expires = time.time() + self.ttl
+        with self:
+            db = self.read_db()
+            db[self.key(target_url, port, user)] = {"cookie": cookie_str, "expires": expires}
+            self.write_db(db)
+        return expires
+
+    def invalidate(self, target_url, port, user, cookie_str=None):
+        """
+        Drop a session. If cookie_str is given, only drop it if it is still the cached one,
+        so a session another process has just refreshed survives.
+        """
+        with self:
+            db = self.read_db()
+            k = self.key(target_url, port, user)
+            if k in db and (cookie_str is None or db[k].get("cookie") == cookie_str):
+                del db[k]
+                self.write_db(db)
+
+class status_cache:
+    """
+    An in-memory cache of get_status() results, keyed by device and machine id,
+    with the least recently used entry evicted beyond max_entries.
+
+    A switch() drops the entry of its machine, and for hold_off seconds after it
+    reads of that machine go to the device, so a read back waiting for a port to
+    change is never answered from the cache. One cache can be shared by many
+    devices and threads.
+    """
+
+    def __init__(self, ttl=2.0, max_entries=1024, hold_off=5.0):
+        import threading
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hold_off = hold_off
+        self.entries = OrderedDict()
+        self.switched = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Return the cached status, or None.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        now = time.monotonic()
+        with self.lock:
+            if self.switched.get(key, 0) > now:
+                return
+            self.switched.pop(key, None)
+            self.entries[key] = (now + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+            self.switched[key] = time.monotonic() + self.hold_off
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'entries': len(self.entries), 'hit_rate': self.hits / total if total else 0.0}
+
+def probe_port(host, port, timeout=5.0):
+    """
+    Check that the device accepts a TCP connection, without sending a request.
+    """
+    try:
+        socket.create_connection((host, port), timeout).close()
+    except socket.timeout:
+        raise timeout_error("{}:{}: connect timed out after {}s".format(host, port, timeout)) from None
+    except OSError as e:
+        raise connection_error("{}:{}: {}".format(host, port, e)) from None
+
+class device_health:
+    """
+    Consecutive failures, last success and the latency of the last WINDOW
+    requests of one device. Only connection failures count, a device that
+    answers, even with an error, is up.
+    """
+
+    WINDOW = 32
+
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_success = None
+        self.last_failure = None
+        self.last_error = None
+        self.latencies = array('d', [0.0]) * self.WINDOW
+
+    def success(self, elapsed):
+        with self.lock:
+            self.latencies[self.successes % self.WINDOW] = elapsed
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.last_success = time.time()
+
+    def failure(self, error):
+        with self.lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_failure = time.time()
+            self.last_error = str(error)
+
+    def latency(self):
+        """
+        Mean latency(s) of the last WINDOW successful requests, None before the first.
+        """
+        with self.lock:
+            n = min(self.successes, self.WINDOW)
+            return sum(self.latencies[:n]) / n if n else None
+
+    def as_dict(self):
+        latency = self.latency()
+        with self.lock:
+            return {'successes': self.successes, 'failures': self.failures, 'consecutive_failures': self.consecutive_failures,
+                    'last_success': self.last_success, 'last_failure': self.last_failure, 'last_error': self.last_error,
+                    'latency': latency}
+
+class circuit_breaker:
+    """
+    Fail fast for a device that is known to be down.
+
+    After threshold connection failures in a row the circuit opens: check()
+    raises circuit_open_error at once instead of waiting for the connect
+    timeout, and a background thread calls probe() after backoff seconds,
+    doubling the wait after every failed probe up to max_backoff. The first
+    probe that gets through closes the circuit again.
+    """
+
+    def __init__(self, health, probe, threshold=3, backoff=1.0, max_backoff=60.0):
+        import threading
+        self.health = health
+        self.probe = probe
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.opened = None
+        self.next_probe = None
+        self.probes = 0
+        self.trips = 0
+
+    def is_open(self):
+        return self.opened is not None
+
+    def state(self):
+        return 'open' if self.is_open() else 'closed'
+
+    def check(self, name):
+        if self.opened is not None:
+            raise circuit_open_error("{}: circuit open after {} failure(s), next probe in {:.1f}s, last error: {}".format(
+                name, self.health.consecutive_failures, max(0.0, self.next_probe - time.monotonic()), self.health.last_error))
+
+    def update(self):
+        """
+        Open the circuit if the health says so, called after each failure.
+        """
+        import threading
+        with self.lock:
+            if self.opened is not None or self.health.consecutive_failures < self.threshold:
+                return
+            self.opened = time.monotonic()
+            self.next_probe = self.opened + self.backoff
+            self.trips += 1
+        threading.Thread(target=self.probe_loop, daemon=True).start()
+
+    def probe_loop(self):
+        delay = self.backoff
+        while not self.stopping.wait(max(0.0, self.next_probe - time.monotonic())):
+            self.probes += 1
+            start = time.perf_counter()
+            try:
+                self.probe()
+            except power_ctrl_error as e:
+                self.health.failure(e)
+                delay = min(delay * 2, self.max_backoff)
+                self.next_probe = time.monotonic() + delay
+                continue
+            self.health.success(time.perf_counter() - start)
+            with self.lock:
+                self.opened = None
+            return
+
+    def close(self):
+        """
+        Stop probing.
+        """
+        self.stopping.set()
+
+    def as_dict(self):
+        return {'state': self.state(), 'trips': self.trips, 'probes': self.probes,
+                'next_probe': max(0.0, self.next_probe - time.monotonic()) if self.is_open() else None}
+
+class http_device:
+    """
+    The keep-alive HTTP connection to one device, shared by sp8h and aw2401.
+    A request on a reused connection the device has dropped in the meantime
+    is sent once more on a new connection.
+    """
+
+    CONNECT_TIMEOUT = 5.0
+    READ_TIMEOUT = 10.0
 
     def __init__(self):
         self.port = 80
         self.target_url = ""
         self.http_header = {}
         self.http_params = {}
-        self.cookie_db = cookies.SimpleCookie()
-        self.user = ""
-        self.passwd = ""
+        self.connect_timeout = self.CONNECT_TIMEOUT
+        self.read_timeout = self.READ_TIMEOUT
+        self.conn = None
+        self.conn_requests = 0
+        self.reconnects = 0
+        self.status_cache = None
+        self.hooks = None
+        self.health = device_health()
+        self.breaker = None
         self.is_connected = False
-        self.is_login = False
 
     def eprint(self, *args, **kwargs):
         """
@@ -42,23 +606,219 @@ class sp8h:
         """
         print(*args, file=sys.stderr, **kwargs)
 
+    def address(self):
+        return "{}:{}".format(self.target_url, self.port)
+
+    def tracing(self):
+        return bool(self.hooks if self.hooks is not None else HOOKS)
+
+    def emit(self, event, op, **fields):
+        """
+        Pass an event to the hooks, dev.hooks if set, else the module wide HOOKS.
+        event is "request" (status, elapsed, error), "reconnect", "retry" (a rejected
+        session was renewed), "timeout_response" (the SP8H answered "TimeOut") or
+        "parse" (elapsed); op is login, logout, switch or get_status.
+        Switching adds "port_switch" (machine, ports, action, error), and the read
+        back loops "port_resend" (machine, port, action, attempt) and "port_verify"
+        (machine, port, action, ok, elapsed, attempt).
+        """
+        hooks = self.hooks if self.hooks is not None else HOOKS
+        if hooks:
+            fields['event'] = event
+            fields['device'] = self.address()
+            fields['op'] = op
+            for hook in hooks:
+                hook(fields)
+
+    def cached_status(self, machin_id, read):
+        """
+        Return the status of a machine from the status_cache if set, else read() it.
+        """
+        if self.status_cache is None:
+            return read()
+        key = (self.address(), machin_id)
+        status_data = self.status_cache.get(key)
+        if status_data is None:
+            status_data = read()
+            self.status_cache.put(key, status_data)
+        return status_data
+
+    def invalidate_status(self, machin_id):
+        if self.status_cache is not None:
+            self.status_cache.invalidate((self.address(), machin_id))
+
     def connect(self):
         """
-        Connect to target SP8H.
+        Set up the connection to the device, the socket itself is opened by the first request.
         """
 
         #TODO: check parameters if valid.
-        self.conn = http.client.HTTPConnection(self.target_url, self.port)
+        self.conn = http.client.HTTPConnection(self.target_url, self.port, timeout=self.connect_timeout)
+        self.conn_requests = 0
         self.is_connected = True
 
     def disconnect(self):
         """
-        Disconnect from target SP8H.
+        Disconnect from the device.
         """
         if self.is_connected:
             self.conn.close()
             self.is_connected = False
 
+    def open_socket(self):
+        try:
+            self.conn.connect()
+        except socket.timeout:
+            self.conn.close()
+            raise timeout_error("{}: connect timed out after {}s".format(self.address(), self.connect_timeout)) from None
+        except OSError as e:
+            self.conn.close()
+            raise connection_error("{}: {}".format(self.address(), e)) from None
+        self.conn.sock.settimeout(self.read_timeout)
+        self.conn_requests = 0
+
+    def probe(self):
+        probe_port(self.target_url, self.port, self.connect_timeout)
+
+    def traced_switch(self, machine, modes, send):
+        """
+        Run send(), the request switching modes {power_id: action} of a machine,
+        and emit a "port_switch" event per action with its outcome.
+        """
+        if not self.tracing():
+            return send()
+        error = None
+        try:
+            return send()
+        except power_ctrl_error as e:
+            error = type(e).__name__
+            raise
+        finally:
+            for action in sorted(set(modes.values())):
+                self.emit("port_switch", "switch", machine=machine, ports=sorted(pid for pid in modes if modes[pid] == action),
+                          action=self.ACTION_NAMES[action], error=error)
+
+    def request(self, method, url, body=None, headers=None, op="request"):
+        """
+        Send a request and return the response with its body already read.
+        The outcome goes to health, and with a breaker set a device that is
+        known to be down is not tried at all.
+        """
+        if headers is None:
+            headers = {}
+        if self.breaker is not None:
+            self.breaker.check(self.address())
+
+        start = time.perf_counter()
+        try:
+            response, data = self.send(method, url, body, headers, op)
+        except power_ctrl_error as e:
+            if isinstance(e, connection_error):
+                self.health.failure(e)
+                if self.breaker is not None:
+                    self.breaker.update()
+            if self.tracing():
+                self.emit("request", op, status=None, elapsed=time.perf_counter() - start, error=type(e).__name__)
+            raise
+        elapsed = time.perf_counter() - start
+        self.health.success(elapsed)
+        if self.tracing():
+            self.emit("request", op, status=response.status, elapsed=elapsed, error=None)
+        return response, data
+
+    def peer_closed(self):
+        """
+        True if the device closed the kept-alive socket, seen before a request is written to it.
+        """
+        import select
+        try:
+            if not select.select([self.conn.sock], [], [], 0)[0]:
+                return False
+            return self.conn.sock.recv(1, socket.MSG_PEEK) == b""
+        except OSError:
+            return True
+
+    def send(self, method, url, body, headers, op):
+        if not self.is_connected:
+            self.connect()
+
+        if self.conn.sock is not None and self.conn_requests > 0 and self.peer_closed():
+            self.conn.close()
+            self.reconnects += 1
+            self.emit("reconnect", op)
+
+        for attempt in range(2):
+            if self.conn.sock is None:
+                self.open_socket()
+            reused = self.conn_requests > 0
+            written = False
+
+            try:
+                self.conn.request(method, url, body, headers)
+                written = True
+                response = self.conn.getresponse()
+                data = response.read()
+            except socket.timeout:
+                self.conn.close()
+                raise timeout_error("{}: no reply after {}s".format(self.address(), self.read_timeout)) from None
+            except (ConnectionResetError, BrokenPipeError) as e:
+                # RemoteDisconnected is a ConnectionResetError too. On a reused
+                # connection this is the device closing an idle keep-alive socket.
+                # Once the request is written the device may have carried it out,
+                # so only a status read is sent again, never a switch.
+                self.conn.close()
+                if reused and attempt == 0 and (not written or op == "get_status"):
+                    self.reconnects += 1
+                    self.emit("reconnect", op)
+                    continue
+                raise connection_error("{}: {}".format(self.address(), e)) from None
+            except (OSError, http.client.HTTPException) as e:
+                self.conn.close()
+                raise connection_error("{}: {}".format(self.address(), e)) from None
+
+            self.conn_requests += 1
+            return response, data
+
+    def check_status(self, response):
+        if response.status in (http.client.UNAUTHORIZED, http.client.FORBIDDEN):
+            raise auth_error("{}: access denied, status={}".format(self.address(), response.status), response.status)
+        if response.status != http.client.OK:
+            raise response_error("{}: unexpected status={}".format(self.address(), response.status), response.status)
+
+class sp8h(http_device):
+    """
+    A Python class to access Smart Power 8H power switch.
+    This mimics web access because we don't know how to use API interface.
+    For now, this library only supports turn on/off directly via http interface.
+    """
+
+    POWER_OFF = 2
+    POWER_ON = 1
+    POWER_RST = 3
+    ACTION_NAMES = {POWER_ON: 'on', POWER_OFF: 'off', POWER_RST: 'reset'}
+
+    LOGIN_STS_OK = b'0'
+    LOGIN_STS_FAIL = b'1'
+    LOGIN_STS_FULL = b'2'
+
+    LOGIN_URL = "/login_auth.csp"
+    LOGOUT_URL = "/logout.csp"
+    POWER_CTL_URL = "/power_monitor_frame.csp"
+    POWER_STS_URL = POWER_CTL_URL
+
+    def __init__(self):
+        super().__init__()
+        self.cookie_db = cookies.SimpleCookie()
+        self.user = ""
+        self.passwd = ""
+        self.is_login = False
+        self.session_cache = None
+        self.session_reused = False
+        self.session_expires = None
+        self.renew_session = True
+        self.status_connections = 2
+        self.status_readers = []
+
     def store_cookies(self, cookie_str=""):
         """
         Parse cookie raw string and store them.
@@ -66,9 +826,57 @@ class sp8h:
         if cookie_str is not None:
             self.cookie_db.load(cookie_str)
 
+    def cookie_str(self):
+        return self.cookie_db.output(attrs=[], header="", sep=";").strip()
+
     def login(self):
         """
         Log in SP8H, needs to configure parameters and connect to server via connect() first.
+        With a session_cache set, a still valid cached session is reused instead.
+        """
+        if self.session_cache is None:
+            return self.login_device()
+
+        with self.session_cache:
+            entry = self.session_cache.entry(self.target_url, self.port, self.user)
+            if entry is not None:
+                if not self.is_connected:
+                    self.connect()
+                self.cookie_db = cookies.SimpleCookie()
+                self.store_cookies(entry[0])
+                self.session_expires = entry[1]
+                self.is_login = True
+                self.session_reused = True
+                return
+
+            self.login_device()
+            self.session_reused = False
+            self.session_expires = self.session_cache.store(self.target_url, self.port, self.user, self.cookie_str())
+
+    def keep_session(self):
+        """
+        Push the expiry of the cached session out after a successful request, but
+        only once it is past half its lifetime: not every request takes the cache
+        lock and rewrites the file.
+        """
+        if self.session_cache is None:
+            return
+        if self.session_expires is not None and self.session_expires - time.time() > self.session_cache.ttl / 2:
+            return
+        self.session_expires = self.session_cache.store(self.target_url, self.port, self.user, self.cookie_str())
+
+    def refresh_session(self):
+        """
+        Replace a session the device rejected with a new one.
+        """
+        if self.session_cache is not None:
+            self.session_cache.invalidate(self.target_url, self.port, self.user, self.cookie_str())
+        self.is_login = False
+        self.login()
+
+    def login_device(self):
+        """
+        Send the login request to the device.
         """
         # TODO: Check parameters if valid
 
@@ -80,28 +888,18 @@ class sp8h:
         if not self.is_connected:
             self.connect()
 
-        if not self.is_connected:
-            sys.exit('Connection failed!')
-
         self.http_params = urllib.parse.urlencode({'auth_user': self.user, 'auth_passwd': self.passwd})
         self.http_header = {"Content-type": "application/x-www-form-urlencoded"}
 
-        try:
-            self.conn.request("POST", self.LOGIN_URL, self.http_params, self.http_header)
-            response = self.conn.getresponse()
-        except (OSError, ConnectionResetError) as e:
-            sys.exit('Error:' + str(e))
-
-        if response.status != http.client.OK:
-            sys.exit("Failed to login, status={}".format(response.status))
-
-        data = response.read()
+        response, data = self.request("POST", self.LOGIN_URL, self.http_params, self.http_header, "login")
+        self.check_status(response)
 
         if data == self.LOGIN_STS_FAIL:
-            sys.exit("Failed to login.")
+            raise auth_error("{}: failed to login".format(self.address()))
         elif data == self.LOGIN_STS_FULL:
-            sys.exit("Failed to login, too much login users")
+            raise session_full_error("{}: failed to login, too much login users".format(self.address()))
 
+        self.cookie_db = cookies.SimpleCookie()
         self.store_cookies(response.getheader("Set-Cookie"))
 
         #DBG: print cookie
@@ -122,32 +920,53 @@ class sp8h:
 
         self.http_params = ""
 
-        try:
-            self.conn.request("GET", url, self.http_params, self.http_header)
-            response = self.conn.getresponse()
-        except (OSError, ConnectionResetError) as e:
-            sys.exit('Error:' + str(e))
+        response, data = self.request("GET", url, self.http_params, self.http_header, "logout")
+        self.check_status(response)
 
-        if response.status != http.client.OK:
-            sys.exit("Failed to login, status={}".format(response.status))
+        if self.session_cache is not None:
+            self.session_cache.invalidate(self.target_url, self.port, self.user, self.cookie_str())
+            self.session_expires = None
 
         self.is_login = False
 
+    def session_request(self, url, params, op="request"):
+        """
+        Send a request with the session cookie and return the response body.
+        A session the device rejects ("TimeOut" or an auth failure) is
+        refreshed and the request sent once more.
+        """
+        for attempt in range(2):
+            self.http_header = {"Cookie": self.cookie_db.output(header="", sep=";")}
+
+            #DBG: print http header
+            #print(self.http_header)
+
+            response, data = self.request("GET", url, params, self.http_header, op)
+            expired = data == b"TimeOut" or response.status in (http.client.UNAUTHORIZED, http.client.FORBIDDEN)
+
+            if data == b"TimeOut":
+                self.emit("timeout_response", op)
+            if expired and attempt == 0 and self.renew_session:
+                self.emit("retry", op)
+                self.refresh_session()
+                continue
+            if expired:
+                raise auth_error("{}: session rejected after login".format(self.address()), response.status)
+
+            self.check_status(response)
+            self.keep_session()
+            return data
+
     def switch(self, machin_id=0, power_id=0, action=1):
         """
         Turn On/Off the power port.
         """
 
         if not self.is_login:
-            sys.exit("Login first!")
+            raise auth_error("Login first!")
 
         if action != self.POWER_ON and action != self.POWER_OFF and action != self.POWER_RST:
-            sys.exit("Invalid action detected!")
-
-        self.http_header = {"Cookie": self.cookie_db.output(header="", sep=";")}
-
-        #DBG: print http header
-        #print(self.http_header)
+            raise ValueError("Invalid action detected!")
 
         self.http_params = urllib.parse.urlencode({'srm_no': machin_id, 'power_id': power_id, 'status': action})
         #DBG: print http params
@@ -155,14 +974,24 @@ class sp8h:
 
         url = '{url}?{params}'.format(url=self.POWER_CTL_URL, params=self.http_params)
 
-        try:
-            self.conn.request("GET", url, self.http_params, self.http_header)
-            response = self.conn.getresponse()
-        except (OSError, ConnectionResetError) as e:
-            sys.exit('Error:' + str(e))
+        self.invalidate_status(machin_id)
+        self.traced_switch(machin_id, {power_id: action}, lambda: self.session_request(url, self.http_params, "switch"))
 
-        if response.status != http.client.OK:
-            sys.exit("Failed to login, status={}".format(response.status))
+    def switch_state(self, machin_id, desired, selected=None, interval=0.7):
+        """
+        Bring the ports of a machine to desired, a port_state; only the ports in
+        selected (all if None) are looked at, and only those that differ from the
+        current status are switched, interval seconds apart.
+        Returns a port_state of the switched ports.
+        """
+        selected = selected if selected is not None else port_state.all(desired.ports)
+        changes = (self.get_status(machin_id).state ^ desired) & selected
+
+        for (i, pid) in enumerate(changes):
+            if i:
+                time.sleep(interval)
+            self.switch(machin_id, pid, self.POWER_ON if pid in desired else self.POWER_OFF)
+        return changes
 
     def get_status(self, machin_id=0):
         """
@@ -170,52 +999,103 @@ class sp8h:
         """
 
         if not self.is_login:
-            sys.exit("Login first!")
+            raise auth_error("Login first!")
 
-        self.http_header = {"Cookie": self.cookie_db.output(header="", sep=";")}
+        return self.cached_status(machin_id, lambda: self.read_status(machin_id))
 
-        #DBG: print http header
-        #print(self.http_header)
+    def status_reader(self):
+        """
+        One more connection to the device on the session of this one, it never logs in itself.
+        """
+        reader = sp8h()
+        reader.target_url = self.target_url
+        reader.port = self.port
+        reader.connect_timeout = self.connect_timeout
+        reader.read_timeout = self.read_timeout
+        reader.hooks = self.hooks
+        reader.health = self.health
+        reader.breaker = self.breaker
+        reader.renew_session = False
+        reader.is_login = True
+        reader.connect()
+        return reader
+
+    def get_status_all(self, machin_ids):
+        """
+        Get the status of several machines, returns {machin_id: status}.
+        The reads are spread over up to status_connections keep-alive connections
+        sharing the login session, the extra ones are kept for the next call.
+        A machine whose read the device rejects is read again on this connection,
+        which renews the session.
+        """
+        if not self.is_login:
+            raise auth_error("Login first!")
+
+        machin_ids = list(dict.fromkeys(machin_ids))
+        workers = max(1, min(self.status_connections, len(machin_ids)))
+        while len(self.status_readers) < workers - 1:
+            self.status_readers.append(self.status_reader())
 
+        result = {}
+        errors = []
+        cookie_str = self.cookie_str()
+
+        def read(reader, mids):
+            try:
+                for mid in mids:
+                    result[mid] = self.cached_status(mid, lambda: reader.read_status(mid))
+            except auth_error:
+                pass
+            except power_ctrl_error as e:
+                errors.append(e)
+
+        import threading
+        threads = []
+        for (i, reader) in enumerate(self.status_readers[:workers - 1]):
+            reader.cookie_db = cookies.SimpleCookie()
+            reader.store_cookies(cookie_str)
+            t = threading.Thread(target=read, args=(reader, machin_ids[i + 1::workers]))
+            t.start()
+            threads.append(t)
+        for mid in machin_ids[::workers]:
+            result[mid] = self.get_status(mid)
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0]
+        # The reads a reader could not do with the old session.
+        for mid in machin_ids:
+            if mid not in result:
+                result[mid] = self.get_status(mid)
+        return dict((mid, result[mid]) for mid in machin_ids)
+
+    def disconnect(self):
+        for reader in self.status_readers:
+            reader.disconnect()
+        self.status_readers = []
+        super().disconnect()
+
+    def read_status(self, machin_id):
         self.http_params = urllib.parse.urlencode({'srm_no': machin_id})
         #DBG: print http params
         #print(self.http_params)
 
         url = '{url}?{params}'.format(url=self.POWER_STS_URL, params=self.http_params)
 
-        try:
-            self.conn.request("GET", url, self.http_params, self.http_header)
-            response = self.conn.getresponse()
-        except (OSError, ConnectionResetError) as e:
-            sys.exit('Error:' + str(e))
-
-        if response.status != http.client.OK:
-            sys.exit("Failed to login, status={}".format(response.status))
-
-        html_data = response.read().decode("utf-8")
+        html_data = self.session_request(url, self.http_params, "get_status")
 
         #For Debug
         #print(html_data)
 
-        merge_list = []
-        if len(html_data) > 0 and html_data != "TimeOut":
-            try:
-                #Parse power status.
-                status_list = html_data.split("],[")[1][1:-1].split("','")
-                #print(status_list)
+        if not self.tracing():
+            return parse_sp8h_status(html_data)
+        start = time.perf_counter()
+        status_data = parse_sp8h_status(html_data)
+        self.emit("parse", "get_status", elapsed=time.perf_counter() - start)
+        return status_data
 
-                #Parse power ampere.
-                ampere_list = html_data.split("],[")[2][1:-3].split("','")
-                #print(ampere_list)
-
-                merge_list = [list(a) for a in zip(status_list, ampere_list)]
-                #print(merge_list)
-            except (ValueError, IndexError) as e:
-                sys.exit('Error:' + str(e))
-
-        return merge_list
-
-class aw2401:
+class aw2401(http_device):
     """
     A python class to access cloud power AW-2401.
     This mimics web access because we don't know how to use API interface.
@@ -225,71 +1105,47 @@ class aw2401:
 
     POWER_OFF = 0
     POWER_ON = 1
+    ACTION_NAMES = {POWER_ON: 'on', POWER_OFF: 'off'}
 
     POWER_CTL_URL = "/set_port_mode.html"
     POWER_STS_URL = "/get_port_mode.html"
 
-    def __init__(self):
-        self.port = 80
-        self.target_url = ""
-        self.http_header = {}
-        self.http_params = {}
-        self.pwr1_sel = False
-        self.pwr2_sel = False
-        self.pwr3_sel = False
-        self.pwr4_sel = False
-        self.is_connected = False
+    PORTS = 4
 
-    def eprint(self, *args, **kwargs):
+    def switch(self, pwr_list, action=1):
         """
-        Print error message to stderr.
+        Turn On/Off the power port, pwr_list is a list of power ids or a port_state.
+        Only the given ports are changed, the others are left as they are.
         """
-        print(*args, file=sys.stderr, **kwargs)
 
-    def connect(self):
-        """
-        Connect to target AW-2401.
-        """
+        if action != self.POWER_ON and action != self.POWER_OFF:
+            raise ValueError("Invalid action detected!")
 
-        #TODO: check parameters if valid.
-        self.conn = http.client.HTTPConnection(self.target_url, self.port)
-        self.is_connected = True
+        self.set_port_mode(dict((pwr, action) for pwr in pwr_list))
 
-    def disconnect(self):
+    def set_state(self, desired, selected=None):
         """
-        Disconnect from target AW-2401.
+        Set every port in selected (all if None) on or off as in desired, a port_state, in one request.
         """
-        if self.is_connected:
-            self.conn.close()
-            self.is_connected = False
+        selected = selected if selected is not None else port_state.all(self.PORTS)
+        self.set_port_mode(dict((pwr, self.POWER_ON if pwr in desired else self.POWER_OFF) for pwr in selected))
 
-    def switch(self, pwr_list, action=1):
+    def set_port_mode(self, modes):
         """
-        Turn On/Off the power port.
+        Switch several ports in one request, modes is a dict {power_id: action}.
+        Ports not in modes are left as they are.
         """
-
-        if action != self.POWER_ON and action != self.POWER_OFF:
-            sys.exit("Invalid action detected!")
+        for action in modes.values():
+            if action != self.POWER_ON and action != self.POWER_OFF:
+                raise ValueError("Invalid action detected!")
 
         self.http_header = {"Content-type": "application/x-www-form-urlencoded"}
 
         #DBG: print http header
         #print(self.http_header)
 
-        for pwr in pwr_list:
-            if pwr == 1:
-                self.pwr1_sel = True
-            if pwr == 2:
-                self.pwr2_sel = True
-            if pwr == 3:
-                self.pwr3_sel = True
-            if pwr == 4:
-                self.pwr4_sel = True
-
-        self.http_params = urllib.parse.urlencode({'portMode1': 'jj' if not self.pwr1_sel else 'on' if action == 1 else 'off', \
-                                                   'portMode2': 'jj' if not self.pwr2_sel else 'on' if action == 1 else 'off', \
-                                                   'portMode3': 'jj' if not self.pwr3_sel else 'on' if action == 1 else 'off', \
-                                                   'portMode4': 'jj' if not self.pwr4_sel else 'on' if action == 1 else 'off'})
+        self.http_params = urllib.parse.urlencode(dict(('portMode{}'.format(i), 'jj' if i not in modes else 'on' if modes[i] == self.POWER_ON else 'off')
+                                                       for i in range(1, self.PORTS + 1)))
 
         #DBG: print http params
         #print(self.http_params)
@@ -299,44 +1155,33 @@ class aw2401:
         #DBG: print http url
         #print(url)
 
-        try:
-            self.conn.request("GET", url, self.http_params, self.http_header)
-            response = self.conn.getresponse()
-        except (OSError, ConnectionResetError) as e:
-            sys.exit('Error:' + str(e))
+        self.invalidate_status(0)
+        self.traced_switch(0, modes, lambda: self.send_port_mode(url))
 
-        if response.status != http.client.OK:
-            sys.exit("Failed to login, status={}".format(response.status))
+    def send_port_mode(self, url):
+        response, data = self.request("GET", url, self.http_params, self.http_header, "switch")
+        self.check_status(response)
 
     def get_status(self):
         """
         Get the status of power port.
         """
+        return self.cached_status(0, self.read_status)
 
+    def read_status(self):
         self.http_header = {"Content-type": "application/x-www-form-urlencoded"}
 
         url = self.POWER_STS_URL
 
-        try:
-            self.conn.request("GET", url, "", self.http_header)
-            response = self.conn.getresponse()
-        except (OSError, ConnectionResetError) as e:
-            sys.exit('Error:' + str(e))
-
-        if response.status != http.client.OK:
-            sys.exit("Failed to login, status={}".format(response.status))
-
-        html_data = response.read()
+        response, html_data = self.request("GET", url, "", self.http_header, "get_status")
+        self.check_status(response)
 
         #For Debug
         #print(html_data)
 
-        soup = BeautifulSoup(html_data, "html.parser")
-        foundTags = soup.find_all('input')
-        #print(foundTags)
-        power_state = []
-        for inpTag in foundTags:
-             #print(inpTag['value'])
-             power_state.append(inpTag['value'])
-
-        return power_state
+        if not self.tracing():
+            return parse_aw2401_status(html_data)
+        start = time.perf_counter()
+        status_data = parse_aw2401_status(html_data)
+        self.emit("parse", "get_status", elapsed=time.perf_counter() - start)
+        return status_data
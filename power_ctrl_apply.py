@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+import json
+import threading
+import time
+from power_ctrl import power_ctrl_error, port_state
+from power_ctrl_converge import sp8h_converger
+from power_ctrl_daemon import device_session
+from power_ctrl_sequence import sp8h_sequencer
+
+STATES = {'on': '1', 'off': '0'}
+STATE_NAMES = {'1': 'on', '0': 'off'}
+
+# Device fields that override the power on budget, see sp8h_sequencer.
+BUDGET_FIELDS = ('machine_budget', 'device_budget', 'port_load', 'inrush')
+
+class port_change:
+    """
+    A port whose current state differs from the desired one.
+    """
+
+    def __init__(self, machine_id, power_id, current, desired):
+        self.machine_id = machine_id
+        self.power_id = power_id
+        self.current = current
+        self.desired = desired
+        self.done = False
+        self.attempts = 0
+        self.elapsed = None
+        self.reason = None
+
+    def __str__(self):
+        return '{}power_id {}: {} -> {}'.format(
+            'machine {}, '.format(self.machine_id) if self.machine_id else '',
+            self.power_id, STATE_NAMES.get(self.current, self.current), STATE_NAMES[self.desired])
+
+def load_state(path):
+    """
+    Read a desired state file, e.g.
+    {"devices": [{"name": "rack1", "type": "sp8h", "ip": "10.0.0.1", "user": "admin", "passwd": "admin",
+                  "machines": {"1": {"1": "on", "2": "off"}, "2": {"8": "on"}}},
+                 {"name": "lab", "type": "aw2401", "ip": "10.0.0.2", "ports": {"1": "on", "4": "off"}}]}
+    A device takes the same fields as in the daemon configuration.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+def desired_ports(conf):
+    """
+    Return {machine_id: {power_id: '1' or '0'}} of one device, an AW-2401 has machine 0 only.
+    """
+    if conf.get("type", "sp8h") == "sp8h":
+        machines = conf.get("machines", {})
+    else:
+        machines = {0: conf.get("ports", {})}
+
+    result = {}
+    for (mid, ports) in machines.items():
+        result[int(mid)] = {}
+        for (pid, value) in ports.items():
+            if value not in STATES:
+                raise ValueError("{}: invalid state {!r} for power_id {}".format(conf.get("name", conf.get("ip")), value, pid))
+            result[int(mid)][int(pid)] = STATES[value]
+    return result
+
+class device_plan:
+    """
+    Bring the ports of one device to their desired state.
+    diff() reads the status once per machine, apply() switches only the ports that differ.
+    on_change, if set, is called with each port_change as soon as it is done or failed.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.session = device_session(conf)
+        self.name = self.session.name
+        self.desired = desired_ports(conf)
+        self.checked = 0
+        self.changes = []
+        self.error = None
+        self.on_change = None
+
+    def report(self, c):
+        if self.on_change is not None:
+            self.on_change(self, c)
+
+    def diff(self):
+        for (mid, ports) in sorted(self.desired.items()):
+            status_data = self.session.get_status(mid)
+            for pid in sorted(ports):
+                if pid < 1 or pid > len(status_data):
+                    raise power_ctrl_error("{}: machine {} has no power_id {}".format(self.name, mid, pid))
+            self.checked += len(ports)
+
+            have = status_data.state
+            want = port_state.from_ids([pid for (pid, w) in ports.items() if w == '1'], have.ports)
+            for pid in (have ^ want) & port_state.from_ids(ports, have.ports):
+                self.changes.append(port_change(mid, pid, '1' if pid in have else '0', ports[pid]))
+
+    def apply(self, interval=0.7, poll_interval=0.2, deadline=5.0, retry=0, budget=None):
+        """
+        With a budget, a dict of sp8h_sequencer options, SP8H ports are powered on by the sequencer.
+        """
+        budget = dict(budget or {}, **{k: self.conf[k] for k in BUDGET_FIELDS if k in self.conf})
+        sequence = self.session.kind == "sp8h" and 'machine_budget' in budget
+
+        # Off first, so there is the most headroom for power on.
+        for want in ('0', '1'):
+            if want == '1' and sequence:
+                group = [c for c in self.changes if c.desired == want]
+                if group:
+                    self.sequence(self.session.scheduler, group, budget, interval, poll_interval, deadline)
+                continue
+            for mid in sorted(set(c.machine_id for c in self.changes)):
+                group = [c for c in self.changes if c.machine_id == mid and c.desired == want]
+                if group:
+                    self.switch(self.session.scheduler, mid, group, interval, poll_interval, deadline, retry)
+
+    def sequence(self, dev, group, budget, interval, poll_interval, deadline):
+        ports = {}
+        for c in group:
+            ports.setdefault(c.machine_id, []).append(c.power_id)
+
+        changes = dict(((c.machine_id, c.power_id), c) for c in group)
+
+        def started(r):
+            c = changes[(r.machine_id, r.power_id)]
+            c.done = r.state == 'on'
+            c.attempts = 1 if r.sent_at is not None else 0
+            c.elapsed = r.elapsed
+            if r.state == 'skipped':
+                c.reason = 'over budget'
+            self.report(c)
+
+        sequencer = sp8h_sequencer(dev, gap=interval, poll_interval=poll_interval, settle_timeout=deadline, **budget)
+        sequencer.on_result = started
+        sequencer.run(ports)
+
+    def switch(self, dev, machine_id, group, interval, poll_interval, deadline, retry):
+        action = dev.POWER_ON if group[0].desired == '1' else dev.POWER_OFF
+
+        if self.session.kind == "sp8h":
+            changes = dict((c.power_id, c) for c in group)
+
+            def converged(r):
+                c = changes[r.power_id]
+                c.done = r.converged
+                c.attempts = r.attempts
+                c.elapsed = r.elapsed
+                self.report(c)
+
+            converger = sp8h_converger(dev, interval, poll_interval, deadline)
+            converger.on_result = converged
+            converger.run(machine_id, [c.power_id for c in group], action, retry)
+            return
+
+        # One AW-2401 request switches any number of ports, then read back until they follow.
+        for attempt in range(retry + 1):
+            pending = [c for c in group if not c.done]
+            dev.switch([c.power_id for c in pending], action)
+            sent_at = time.monotonic()
+            for c in pending:
+                c.attempts += 1
+                if c.attempts > 1:
+                    dev.emit("port_resend", "switch", machine=c.machine_id, port=c.power_id, action=dev.ACTION_NAMES[action], attempt=c.attempts)
+            end = sent_at + deadline
+            while pending:
+                time.sleep(poll_interval)
+                status_data = dev.get_status()
+                for c in pending:
+                    c.done = status_data[c.power_id - 1][0] == c.desired
+                    if c.done:
+                        c.elapsed = time.monotonic() - sent_at
+                        self.verified(dev, c, action)
+                pending = [c for c in pending if not c.done]
+                if time.monotonic() >= end:
+                    break
+            if not pending:
+                break
+
+        for c in group:
+            if not c.done:
+                self.verified(dev, c, action)
+
+    def verified(self, dev, c, action):
+        dev.emit("port_verify", "switch", machine=c.machine_id, port=c.power_id, action=dev.ACTION_NAMES[action],
+                 attempt=c.attempts, ok=c.done, elapsed=c.elapsed)
+        self.report(c)
+
+def run_parallel(func, items, jobs=16, timeout=None):
+    """
+    Call func(item) for every item on up to jobs threads, and return the set of
+    items done within timeout seconds. They are daemon threads, so an item stuck
+    past the timeout does not hold up the exit.
+    """
+    queue = list(items)
+    finished = set()
+    lock = threading.Lock()
+    all_done = threading.Event()
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                item = queue.pop(0)
+            func(item)
+            with lock:
+                finished.add(item)
+                if len(finished) == len(items):
+                    all_done.set()
+
+    for i in range(min(max(1, jobs), len(items))):
+        threading.Thread(target=worker, daemon=True).start()
+    if items:
+        all_done.wait(timeout)
+    with lock:
+        return set(finished)
+
+def plan_fleet(state, jobs=16, dry_run=False, interval=0.7, poll_interval=0.2, deadline=5.0, retry=0, budget=None,
+               on_change=None, on_done=None, timeout=None):
+    """
+    Diff, and unless dry_run apply, every device of a desired state.
+    Devices are handled in parallel, up to jobs at a time, and a failing
+    device does not stop the others. Returns a device_plan per device.
+    on_change(plan, change) is called as each port is done or failed (for every
+    planned change with dry_run), on_done(plan) as each device is finished.
+    With a timeout, plan_fleet returns after that many seconds even if some
+    devices are not done; they get an error and are left to finish in the
+    background.
+    """
+    plans = [device_plan(conf) for conf in state.get("devices", [])]
+
+    def run(plan):
+        plan.on_change = on_change
+        try:
+            plan.diff()
+            if dry_run:
+                for c in plan.changes:
+                    plan.report(c)
+            else:
+                plan.apply(interval, poll_interval, deadline, retry, budget)
+        except power_ctrl_error as e:
+            plan.error = str(e)
+        finally:
+            with plan.session.lock:
+                plan.session.close()
+        if on_done is not None:
+            on_done(plan)
+        return plan
+
+    finished = run_parallel(run, plans, jobs, timeout)
+    for plan in plans:
+        if plan not in finished:
+            plan.error = "not done after {}s".format(timeout)
+    return plans
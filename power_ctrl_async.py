@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+import asyncio
+import http.client
+import sys
+import time
+import urllib.parse
+from http import cookies
+from power_ctrl import sp8h
+from power_ctrl import aw2401
+from power_ctrl import http_device
+from power_ctrl import power_ctrl_error
+from power_ctrl import connection_error
+from power_ctrl import timeout_error
+from power_ctrl import response_error
+from power_ctrl import auth_error
+from power_ctrl import session_full_error
+from power_ctrl import parse_sp8h_status
+from power_ctrl import parse_aw2401_status
+
+class async_http_response:
+    """
+    A fully read HTTP response, with the parts of http.client.HTTPResponse we use.
+    """
+
+    def __init__(self, status, headers, data):
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+    def getheader(self, name, default=None):
+        """
+        Return the header value, multiple headers are joined by ', ' like http.client.
+        """
+        values = [v for (k, v) in self.headers if k.lower() == name.lower()]
+        if not values:
+            return default
+        return ', '.join(values)
+
+    def read(self):
+        return self.data
+
+class async_http_connection:
+    """
+    A minimal HTTP/1.1 client connection on top of asyncio streams.
+    It keeps the socket open between requests like http.client.HTTPConnection,
+    and like http_device sends a request once more if the device has dropped
+    a reused connection.
+    """
+
+    def __init__(self, host, port=80, connect_timeout=http_device.CONNECT_TIMEOUT, read_timeout=http_device.READ_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.reader = None
+        self.writer = None
+        self.requests = 0
+        self.reconnects = 0
+
+    def address(self):
+        return "{}:{}".format(self.host, self.port)
+
+    async def open(self):
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise timeout_error("{}: connect timed out after {}s".format(self.address(), self.connect_timeout)) from None
+        except OSError as e:
+            raise connection_error("{}: {}".format(self.address(), e)) from None
+        self.requests = 0
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, url, body="", headers=None):
+        """
+        Send one request and read the whole response.
+        """
+        for attempt in range(2):
+            if self.writer is None:
+                await self.open()
+            reused = self.requests > 0
+
+            try:
+                response = await asyncio.wait_for(self.exchange(method, url, body, headers), self.read_timeout)
+            except asyncio.TimeoutError:
+                await self.close()
+                raise timeout_error("{}: no reply after {}s".format(self.address(), self.read_timeout)) from None
+            except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError) as e:
+                await self.close()
+                if reused and attempt == 0:
+                    self.reconnects += 1
+                    continue
+                raise connection_error("{}: {}".format(self.address(), e)) from None
+            except (OSError, http.client.HTTPException) as e:
+                await self.close()
+                raise connection_error("{}: {}".format(self.address(), e)) from None
+
+            self.requests += 1
+            return response
+
+    async def exchange(self, method, url, body, headers):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        lines = ['{} {} HTTP/1.1'.format(method, url), 'Host: {}'.format(self.host)]
+        for (k, v) in (headers or {}).items():
+            lines.append('{}: {}'.format(k, v))
+        if body or method in ("POST", "PUT"):
+            lines.append('Content-Length: {}'.format(len(body)))
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode("latin-1") + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Remote end closed connection without response')
+        try:
+            version, status = status_line.decode("latin-1").split(None, 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line)
+
+        resp_headers = []
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, _, v = line.decode("latin-1").partition(':')
+            resp_headers.append((k.strip(), v.strip()))
+        response = async_http_response(status, resp_headers, b'')
+
+        length = response.getheader('Content-Length')
+        if (response.getheader('Transfer-Encoding') or '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            response.data = b''.join(chunks)
+        elif length is not None:
+            response.data = await self.reader.readexactly(int(length))
+        else:
+            # No length given, the body ends when the device closes the socket.
+            response.data = await self.reader.read()
+            await self.close()
+
+        if (response.getheader('Connection') or '').lower() == 'close' or version == 'HTTP/1.0':
+            await self.close()
+
+        return response
+
+def check_status(conn, response):
+    """
+    Raise the error matching a non-OK response, like http_device.check_status().
+    """
+    if response.status in (http.client.UNAUTHORIZED, http.client.FORBIDDEN):
+        raise auth_error("{}: access denied, status={}".format(conn.address(), response.status), response.status)
+    if response.status != http.client.OK:
+        raise response_error("{}: unexpected status={}".format(conn.address(), response.status), response.status)
+
+class async_sp8h:
+    """
+    An asyncio counterpart of sp8h, with the same login/switch/get_status/logout semantics.
+    """
+
+    POWER_OFF = sp8h.POWER_OFF
+    POWER_ON = sp8h.POWER_ON
+    POWER_RST = sp8h.POWER_RST
+
+    LOGIN_STS_OK = sp8h.LOGIN_STS_OK
+    LOGIN_STS_FAIL = sp8h.LOGIN_STS_FAIL
+    LOGIN_STS_FULL = sp8h.LOGIN_STS_FULL
+
+    LOGIN_URL = sp8h.LOGIN_URL
+    LOGOUT_URL = sp8h.LOGOUT_URL
+    POWER_CTL_URL = sp8h.POWER_CTL_URL
+    POWER_STS_URL = sp8h.POWER_STS_URL
+
+    def __init__(self, target_url="", user="", passwd="", port=80):
+        self.port = port
+        self.target_url = target_url
+        self.http_header = {}
+        self.http_params = {}
+        self.cookie_db = cookies.SimpleCookie()
+        self.user = user
+        self.passwd = passwd
+        self.connect_timeout = http_device.CONNECT_TIMEOUT
+        self.read_timeout = http_device.READ_TIMEOUT
+        self.is_connected = False
+        self.is_login = False
+
+    def eprint(self, *args, **kwargs):
+        """
+        Print error message to stderr.
+        """
+        print(*args, file=sys.stderr, **kwargs)
+
+    async def connect(self):
+        """
+        Connect to target SP8H.
+        """
+        self.conn = async_http_connection(self.target_url, self.port, self.connect_timeout, self.read_timeout)
+        await self.conn.open()
+        self.is_connected = True
+
+    async def disconnect(self):
+        """
+        Disconnect from target SP8H.
+        """
+        if self.is_connected:
+            await self.conn.close()
+            self.is_connected = False
+
+    def store_cookies(self, cookie_str=""):
+        """
+        Parse cookie raw string and store them.
+        """
+        if cookie_str is not None:
+            self.cookie_db.load(cookie_str)
+
+    async def _request(self, method, url, params, header):
+        response = await self.conn.request(method, url, params, header)
+        check_status(self.conn, response)
+        return response
+
+    async def session_request(self, url, params):
+        """
+        Like sp8h.session_request(), an expired session is replaced and the request sent once more.
+        """
+        for attempt in range(2):
+            self.http_header = {"Cookie": self.cookie_db.output(header="", sep=";")}
+            response = await self.conn.request("GET", url, params, self.http_header)
+            expired = response.read() == b"TimeOut" or response.status in (http.client.UNAUTHORIZED, http.client.FORBIDDEN)
+
+            if expired and attempt == 0:
+                await self.login()
+                continue
+            if expired:
+                raise auth_error("{}: session rejected after login".format(self.conn.address()), response.status)
+
+            check_status(self.conn, response)
+            return response
+
+    async def login(self):
+        """
+        Log in SP8H, connects to server first if needed.
+        """
+
+        # If logged in, restart a new session.
+        if self.is_login:
+            await self.disconnect()
+            await self.connect()
+
+        if not self.is_connected:
+            await self.connect()
+
+        self.http_params = urllib.parse.urlencode({'auth_user': self.user, 'auth_passwd': self.passwd})
+        self.http_header = {"Content-type": "application/x-www-form-urlencoded"}
+
+        response = await self._request("POST", self.LOGIN_URL, self.http_params, self.http_header)
+        data = response.read()
+
+        if data == self.LOGIN_STS_FAIL:
+            raise auth_error("{}: failed to login".format(self.conn.address()))
+        elif data == self.LOGIN_STS_FULL:
+            raise session_full_error("{}: failed to login, too much login users".format(self.conn.address()))
+
+        self.cookie_db = cookies.SimpleCookie()
+        self.store_cookies(response.getheader("Set-Cookie"))
+        self.is_login = True
+
+    async def logout(self):
+        """
+        logout SP8H
+        """
+        if not self.is_login:
+            self.eprint("Login first!")
+            return False
+
+        self.http_header = {"Cookie": self.cookie_db.output(header="", sep=";")}
+        self.http_params = ""
+
+        await self._request("GET", self.LOGOUT_URL, self.http_params, self.http_header)
+        self.is_login = False
+
+    async def switch(self, machin_id=0, power_id=0, action=1):
+        """
+        Turn On/Off the power port.
+        """
+
+        if not self.is_login:
+            raise auth_error("Login first!")
+
+        if action != self.POWER_ON and action != self.POWER_OFF and action != self.POWER_RST:
+            raise ValueError("Invalid action detected!")
+
+        self.http_params = urllib.parse.urlencode({'srm_no': machin_id, 'power_id': power_id, 'status': action})
+
+        url = '{url}?{params}'.format(url=self.POWER_CTL_URL, params=self.http_params)
+        await self.session_request(url, self.http_params)
+
+    async def get_status(self, machin_id=0):
+        """
+        Get the status of power port.
+        """
+
+        if not self.is_login:
+            raise auth_error("Login first!")
+
+        self.http_params = urllib.parse.urlencode({'srm_no': machin_id})
+
+        url = '{url}?{params}'.format(url=self.POWER_STS_URL, params=self.http_params)
+        response = await self.session_request(url, self.http_params)
+
+        return parse_sp8h_status(response.read())
+
+class async_aw2401:
+    """
+    An asyncio counterpart of aw2401, with the same switch/get_status semantics.
+    """
+
+    POWER_OFF = aw2401.POWER_OFF
+    POWER_ON = aw2401.POWER_ON
+
+    POWER_CTL_URL = aw2401.POWER_CTL_URL
+    POWER_STS_URL = aw2401.POWER_STS_URL
+
+    def __init__(self, target_url="", port=80):
+        self.port = port
+        self.target_url = target_url
+        self.http_header = {}
+        self.http_params = {}
+        self.connect_timeout = http_device.CONNECT_TIMEOUT
+        self.read_timeout = http_device.READ_TIMEOUT
+        self.is_connected = False
+
+    def eprint(self, *args, **kwargs):
+        """
+        Print error message to stderr.
+        """
+        print(*args, file=sys.stderr, **kwargs)
+
+    async def connect(self):
+        """
+        Connect to target AW-2401.
+        """
+        self.conn = async_http_connection(self.target_url, self.port, self.connect_timeout, self.read_timeout)
+        await self.conn.open()
+        self.is_connected = True
+
+    async def disconnect(self):
+        """
+        Disconnect from target AW-2401.
+        """
+        if self.is_connected:
+            await self.conn.close()
+            self.is_connected = False
+
+    async def _request(self, url, params):
+        if not self.is_connected:
+            await self.connect()
+
+        response = await self.conn.request("GET", url, params, self.http_header)
+        check_status(self.conn, response)
+        return response
+
+    async def switch(self, pwr_list, action=1):
+        """
+        Turn On/Off the power port.
+        """
+
+        if action != self.POWER_ON and action != self.POWER_OFF:
+            raise ValueError("Invalid action detected!")
+
+        self.http_header = {"Content-type": "application/x-www-form-urlencoded"}
+
+        mode = 'on' if action == self.POWER_ON else 'off'
+        self.http_params = urllib.parse.urlencode({'portMode{}'.format(i): mode if i in pwr_list else 'jj' for i in range(1, 5)})
+
+        url = '{url}?{params}'.format(url=self.POWER_CTL_URL, params=self.http_params)
+        await self._request(url, self.http_params)
+
+    async def get_status(self):
+        """
+        Get the status of power port.
+        """
+
+        self.http_header = {"Content-type": "application/x-www-form-urlencoded"}
+
+        response = await self._request(self.POWER_STS_URL, "")
+
+        return parse_aw2401_status(response.read())
+
+class fleet_result:
+    """
+    The outcome of one operation on one device.
+    """
+
+    def __init__(self, device, value=None, error=None, elapsed=0.0):
+        self.device = device
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return 'fleet_result(device={}, ok={}, elapsed={:.3f})'.format(self.device.target_url, self.ok, self.elapsed)
+
+class fleet:
+    """
+    Fan operations out across many devices.
+    At most max_concurrency operations run at once, and at most
+    per_device_concurrency of them on the same device.
+    """
+
+    def __init__(self, max_concurrency=64, per_device_concurrency=1):
+        self.max_concurrency = max_concurrency
+        self.per_device_concurrency = per_device_concurrency
+
+    async def run_async(self, jobs):
+        """
+        Run a list of (device, operation) jobs, operation is an async function taking the device.
+        Results are returned in job order, a failing device never stops the others.
+        """
+        global_sem = asyncio.Semaphore(self.max_concurrency)
+        device_sem = {}
+
+        async def run_one(device, operation):
+            key = (device.target_url, device.port)
+            if key not in device_sem:
+                device_sem[key] = asyncio.Semaphore(self.per_device_concurrency)
+
+            async with device_sem[key]:
+                async with global_sem:
+                    start = time.monotonic()
+                    try:
+                        value = await operation(device)
+                    except power_ctrl_error as e:
+                        return fleet_result(device, error=str(e), elapsed=time.monotonic() - start)
+                    except Exception as e:
+                        # Anything else, e.g. a ValueError of a bad page, also only fails this device.
+                        return fleet_result(device, error='{}: {}'.format(type(e).__name__, e), elapsed=time.monotonic() - start)
+                    return fleet_result(device, value=value, elapsed=time.monotonic() - start)
+
+        return await asyncio.gather(*[run_one(device, operation) for (device, operation) in jobs])
+
+    def run(self, jobs):
+        """
+        Blocking wrapper around run_async().
+        """
+        return asyncio.run(self.run_async(jobs))
+
+def sp8h_switch_op(machine_ids, power_ids, action, interval=0.7):
+    """
+    Build a fleet operation that logs in, switches the ports and logs out.
+    The interval between two switches only delays this device, not the fleet.
+    """
+    async def operation(dev):
+        await dev.login()
+        try:
+            for mid in machine_ids:
+                for pid in power_ids:
+                    await asyncio.sleep(interval)
+                    await dev.switch(mid, pid, action)
+        finally:
+            if dev.is_login:
+                await dev.logout()
+            await dev.disconnect()
+
+    return operation
+
+def sp8h_cycle_op(machine_ids, power_ids, off_time=5.0, interval=0.7):
+    """
+    Build a fleet operation that powers ports off, waits off_time and powers them on again.
+    """
+    async def operation(dev):
+        await dev.login()
+        try:
+            for action in (dev.POWER_OFF, dev.POWER_ON):
+                for mid in machine_ids:
+                    for pid in power_ids:
+                        await asyncio.sleep(interval)
+                        await dev.switch(mid, pid, action)
+                if action == dev.POWER_OFF:
+                    await asyncio.sleep(off_time)
+        finally:
+            if dev.is_login:
+                await dev.logout()
+            await dev.disconnect()
+
+    return operation
+
+def aw2401_switch_op(power_ids, action):
+    """
+    Build a fleet operation that switches the AW-2401 ports in one request.
+    """
+    async def operation(dev):
+        try:
+            await dev.switch(power_ids, action)
+        finally:
+            await dev.disconnect()
+
+    return operation
+
+def aw2401_status_op():
+    """
+    Build a fleet operation that returns the AW-2401 port states.
+    """
+    async def operation(dev):
+        try:
+            return await dev.get_status()
+        finally:
+            await dev.disconnect()
+
+    return operation
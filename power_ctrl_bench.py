@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from power_ctrl import sp8h
+from power_ctrl import aw2401
+from power_ctrl import power_ctrl_error
+from power_ctrl import parse_sp8h_status
+from power_ctrl import parse_aw2401_status
+from power_ctrl_async import async_sp8h
+from power_ctrl_async import async_aw2401
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PHASES = {
+    "sp8h": ("login", "switch", "get_status", "logout"),
+    "aw2401": ("switch", "get_status"),
+}
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+def summary(kind, mode, devices, metric, samples, wall, errors=0):
+    """
+    One machine readable result record, times are in seconds.
+    """
+    return {
+        "kind": kind,
+        "mode": mode,
+        "devices": devices,
+        "metric": metric,
+        "count": len(samples),
+        "errors": errors,
+        "mean": sum(samples) / len(samples) if samples else 0.0,
+        "p50": percentile(samples, 50),
+        "p95": percentile(samples, 95),
+        "max": max(samples) if samples else 0.0,
+        "wall": wall,
+        "throughput": len(samples) / wall if wall > 0 else 0.0,
+    }
+
+class simulator:
+    """
+    Run power_ctrl_sim.py in its own process, so it does not share the GIL with the benchmark.
+    """
+
+    def __init__(self, sp8h_count, aw2401_count, base_port, latency, settle_delay):
+        cmd = [sys.executable, os.path.join(HERE, "power_ctrl_sim.py"),
+               "--sp8h", str(sp8h_count), "--aw2401", str(aw2401_count), "--base-port", str(base_port),
+               "--latency", str(latency), "--settle-delay", str(settle_delay)]
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        self.devices = {"sp8h": [], "aw2401": []}
+        for i in range(sp8h_count + aw2401_count):
+            kind, addr = self.proc.stdout.readline().split()
+            host, port = addr.rsplit(":", 1)
+            self.devices[kind].append((host, int(port)))
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+def sync_device(kind, addr):
+    if kind == "sp8h":
+        dev = sp8h()
+        dev.user = "admin"
+        dev.passwd = "admin"
+    else:
+        dev = aw2401()
+    dev.target_url, dev.port = addr
+    dev.connect()
+    return dev
+
+def async_device(kind, addr):
+    if kind == "sp8h":
+        return async_sp8h(addr[0], "admin", "admin", addr[1])
+    return async_aw2401(addr[0], addr[1])
+
+def sync_op(kind, phase, dev, i):
+    if phase == "login":
+        dev.login()
+    elif phase == "logout":
+        dev.logout()
+    elif phase == "switch":
+        if kind == "sp8h":
+            dev.switch(1, i % 8 + 1, dev.POWER_ON)
+        else:
+            dev.switch([i % 4 + 1], dev.POWER_ON)
+    elif kind == "sp8h":
+        dev.get_status(1)
+    else:
+        dev.get_status()
+
+async def async_op(kind, phase, dev, i):
+    if phase == "login":
+        await dev.login()
+    elif phase == "logout":
+        await dev.logout()
+    elif phase == "switch":
+        if kind == "sp8h":
+            await dev.switch(1, i % 8 + 1, dev.POWER_ON)
+        else:
+            await dev.switch([i % 4 + 1], dev.POWER_ON)
+    elif kind == "sp8h":
+        await dev.get_status(1)
+    else:
+        await dev.get_status()
+
+def timed_sync(kind, phase, dev, ops, samples):
+    """
+    Run ops requests of one phase on one device, return the number of errors.
+    """
+    count = 1 if phase in ("login", "logout") else ops
+    for i in range(count):
+        start = time.perf_counter()
+        try:
+            sync_op(kind, phase, dev, i)
+        except power_ctrl_error:
+            return 1
+        samples.append(time.perf_counter() - start)
+    return 0
+
+async def timed_async(kind, phase, dev, ops, samples):
+    count = 1 if phase in ("login", "logout") else ops
+    for i in range(count):
+        start = time.perf_counter()
+        try:
+            await async_op(kind, phase, dev, i)
+        except (power_ctrl_error, OSError):
+            return 1
+        samples.append(time.perf_counter() - start)
+    return 0
+
+def bench_sync(kind, addrs, ops, threads):
+    """
+    Sequential mode with threads=1, else a thread pool of that size.
+    """
+    devs = [sync_device(kind, addr) for addr in addrs]
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        for phase in PHASES[kind]:
+            samples = []
+            start = time.perf_counter()
+            if threads <= 1:
+                errors = sum(timed_sync(kind, phase, dev, ops, samples) for dev in devs)
+            else:
+                errors = sum(pool.map(lambda dev: timed_sync(kind, phase, dev, ops, samples), devs))
+            results[phase] = (samples, time.perf_counter() - start, errors)
+    for dev in devs:
+        dev.disconnect()
+    return results
+
+def bench_async(kind, addrs, ops, concurrency):
+    async def run():
+        devs = [async_device(kind, addr) for addr in addrs]
+        sem = asyncio.Semaphore(concurrency)
+        results = {}
+
+        async def one(phase, dev, samples):
+            async with sem:
+                return await timed_async(kind, phase, dev, ops, samples)
+
+        for phase in PHASES[kind]:
+            samples = []
+            start = time.perf_counter()
+            errors = sum(await asyncio.gather(*[one(phase, dev, samples) for dev in devs]))
+            results[phase] = (samples, time.perf_counter() - start, errors)
+        for dev in devs:
+            await dev.disconnect()
+        return results
+
+    return asyncio.run(run())
+
+def bench_cli(kind, addr, runs):
+    """
+    End-to-end runtime of power_ctrl_cli.py, including process start and its sleeps.
+    """
+    cli = [sys.executable, os.path.join(HERE, "power_ctrl_cli.py"), kind, "-i", addr[0], "--port", str(addr[1])]
+    if kind == "sp8h":
+        cases = {"cli_switch": ["-m", "1", "-p", "1", "-s", "on"], "cli_status": ["-m", "1", "-g"]}
+    else:
+        cases = {"cli_switch": ["-p", "1", "-s", "on"], "cli_status": ["-g"]}
+
+    results = {}
+    for (metric, extra) in cases.items():
+        samples = []
+        errors = 0
+        for i in range(runs):
+            start = time.perf_counter()
+            ret = subprocess.call(cli + extra, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            samples.append(time.perf_counter() - start)
+            errors += ret != 0
+        results[metric] = (samples, sum(samples), errors)
+    return results
+
+SP8H_FRAME = b"[['Port1','Port2','Port3','Port4','Port5','Port6','Port7','Port8'],['1','0','1','1','0','0','1','0'],['0.42','0.00','1.13','0.87','0.00','0.00','0.25','0.00']]"
+AW2401_PAGE = ''.join('<tr><td>Port{0}</td><td><input type="text" name="port{0}" value="{1}" readonly></td></tr>'.format(
+    i, 'on' if i % 2 else 'off') for i in range(1, 5)).join(('<html><body><table>', '</table></body></html>')).encode("utf-8")
+
+def legacy_sp8h_parse(data):
+    """
+    The string splitting parser sp8h.get_status() used before parse_sp8h_status().
+    """
+    html_data = data.decode("utf-8")
+    status_list = html_data.split("],[")[1][1:-1].split("','")
+    ampere_list = html_data.split("],[")[2][1:-3].split("','")
+    return [list(a) for a in zip(status_list, ampere_list)]
+
+def legacy_aw2401_parse(data):
+    """
+    The BeautifulSoup parser aw2401.get_status() used before parse_aw2401_status().
+    """
+    from bs4 import BeautifulSoup
+    return [tag['value'] for tag in BeautifulSoup(data, "html.parser").find_all('input')]
+
+def bench_parse(number):
+    """
+    Compare the status parsers on a typical page, one record per parser.
+    """
+    cases = [("sp8h", "legacy", legacy_sp8h_parse, SP8H_FRAME),
+             ("sp8h", "fast", parse_sp8h_status, SP8H_FRAME),
+             ("aw2401", "legacy", legacy_aw2401_parse, AW2401_PAGE),
+             ("aw2401", "fast", parse_aw2401_status, AW2401_PAGE)]
+    records = []
+    for (kind, metric, func, data) in cases:
+        try:
+            samples = [t / number for t in timeit.repeat(lambda: func(data), number=number, repeat=5)]
+        except ImportError:
+            continue
+        records.append(summary(kind, "parse", 1, metric, samples, sum(samples)))
+    return records
+
+def compare(records, baseline, tolerance):
+    """
+    Return the records whose p50 got slower than the baseline by more than tolerance.
+    """
+    def key(r):
+        return (r["kind"], r["mode"], r["devices"], r["metric"])
+
+    old = {key(r): r for r in baseline}
+    slower = []
+    for r in records:
+        b = old.get(key(r))
+        if b and b["p50"] > 0 and r["p50"] > b["p50"] * (1 + tolerance):
+            slower.append((r, b))
+    return slower
+
+def main():
+    """
+    Benchmark the drivers and the CLI against simulated devices.
+    """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--kind'         , type=str   , help="Device types", nargs='+', choices=['sp8h', 'aw2401'], default=['sp8h', 'aw2401'])
+    parser.add_argument('--devices'      , '-n', type=int, help="Device counts", nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--mode'         , type=str   , help="Execution modes", nargs='+', choices=['sequential', 'threaded', 'async'], default=['sequential', 'threaded', 'async'])
+    parser.add_argument('--ops'          , type=int   , help="Switch and status requests per device", default=4)
+    parser.add_argument('--threads'      , type=int   , help="Worker threads of the threaded mode", default=64)
+    parser.add_argument('--concurrency'  , type=int   , help="Concurrent devices of the async mode", default=64)
+    parser.add_argument('--cli-runs'     , type=int   , help="End-to-end CLI runs, 0 to skip", default=3)
+    parser.add_argument('--latency'      , type=int   , help="Simulated response latency(ms)", default=0)
+    parser.add_argument('--settle-delay' , type=int   , help="Simulated settle delay(ms)", default=500)
+    parser.add_argument('--base-port'    , type=int   , help="First simulator port", default=18000)
+    parser.add_argument('--output'       , '-o', type=str, help="Write JSON results to this file instead of stdout")
+    parser.add_argument('--baseline'     , '-b', type=str, help="Fail if p50 is slower than in this result file")
+    parser.add_argument('--tolerance'    , type=float , help="Allowed slowdown against the baseline", default=0.25)
+    parser.add_argument('--parse'        , type=int   , help="Only time the status parsers, this many calls per sample", default=0)
+    args = parser.parse_args()
+
+    if args.parse:
+        records = bench_parse(args.parse)
+    else:
+        records = bench_devices(args)
+
+    out = json.dumps(records, indent=1)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        sys.stdout.write(out + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(records, json.load(f), args.tolerance)
+        for (r, b) in slower:
+            sys.stderr.write('Regression: {kind} {mode} x{devices} {metric}: '.format(**r) +
+                             'p50 {:.6f}s, baseline {:.6f}s\n'.format(r["p50"], b["p50"]))
+        if slower:
+            sys.exit(1)
+
+def bench_devices(args):
+    count = max(args.devices)
+    sim = simulator(count if 'sp8h' in args.kind else 0, count if 'aw2401' in args.kind else 0,
+                    args.base_port, args.latency, args.settle_delay)
+    records = []
+    try:
+        for kind in args.kind:
+            for n in args.devices:
+                addrs = sim.devices[kind][:n]
+                for mode in args.mode:
+                    if mode == "sequential":
+                        results = bench_sync(kind, addrs, args.ops, 1)
+                    elif mode == "threaded":
+                        results = bench_sync(kind, addrs, args.ops, args.threads)
+                    else:
+                        results = bench_async(kind, addrs, args.ops, args.concurrency)
+                    for (metric, (samples, wall, errors)) in results.items():
+                        records.append(summary(kind, mode, n, metric, samples, wall, errors))
+                    sys.stderr.write('{} {} x{}: done\n'.format(kind, mode, n))
+
+            if args.cli_runs:
+                for (metric, (samples, wall, errors)) in bench_cli(kind, sim.devices[kind][0], args.cli_runs).items():
+                    records.append(summary(kind, "cli", 1, metric, samples, wall, errors))
+    finally:
+        sim.stop()
+
+    return records
+
+if __name__ == "__main__":
+    main()
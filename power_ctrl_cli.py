@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
+import time
+STARTUP = [('cli', time.perf_counter())]
+STARTUP_CPU = time.process_time()
+import os
 import signal
 import sys
-import time
 import argparse
 from ipaddress import ip_address
-from power_ctrl import sp8h
-from power_ctrl import aw2401
+
+# Device drivers and their dependencies are imported by the command that uses them,
+# so a run only pays for what it needs.
+
+# request_metrics of the run with --timings.
+TIMINGS = None
+
+# jsonl_writer and retry_counter of the run with --format jsonl.
+RECORDS = None
+RETRIES = None
 
 class power_ctrl_cliparser(argparse.ArgumentParser):
     """
@@ -17,30 +28,85 @@ class power_ctrl_cliparser(argparse.ArgumentParser):
         self.print_help()
         sys.exit(2)
 
-def main():
+class jsonl_writer:
     """
-    A CLI parser to control power switch.
+    Write one JSON object per line, flushed at once so a pipe reader gets every
+    record as it happens. Can be called from many threads.
     """
 
-    o_sp8h = sp8h()
+    def __init__(self, out):
+        import json
+        import threading
+        self.out = out
+        self.dumps = json.dumps
+        self.lock = threading.Lock()
+
+    def __call__(self, event, **fields):
+        record = {'event': event, 'time': round(time.time(), 3)}
+        record.update(fields)
+        line = self.dumps(record) + '\n'
+        with self.lock:
+            self.out.write(line)
+            self.out.flush()
+
+class retry_counter:
+    """
+    A power_ctrl hook counting the reconnects and session retries per device.
+    """
 
-    def signal_handler(sig, frame):
-        sys.stdout.write('You pressed Ctrl+C!')
-        o_sp8h.logout()
-        sys.stdout.write('\nLogout sp8h.')
-        o_sp8h.disconnect()
-        sys.stdout.write('\nDisconnect sp8h.\n')
-        sys.exit(0)
+    def __init__(self):
+        self.counts = {}
 
-    signal.signal(signal.SIGINT, signal_handler)
+    def __call__(self, event):
+        if event['event'] in ('reconnect', 'retry'):
+            self.counts[event['device']] = self.counts.get(event['device'], 0) + 1
 
-    parser = power_ctrl_cliparser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    def get(self, device):
+        return self.counts.get(device, 0)
 
-    subparsers = parser.add_subparsers(title='Support devices', dest='device', help="device")
+def status_records(device, machine_id, status_data, latency, retries=None):
+    """
+    Write a status record per port of one get_status() result.
+    """
+    for (i, (state, ampere)) in enumerate(status_data, 1):
+        RECORDS('status', device=device, machine=machine_id, port=i, state='on' if state == '1' else 'off',
+                ampere=float(ampere) if ampere is not None else None, latency=round(latency, 4), retries=retries)
+
+def startup_mark(name):
+    STARTUP.append((name, time.perf_counter()))
+
+def timed_sleep(seconds, phase):
+    start = time.perf_counter()
+    time.sleep(seconds)
+    if TIMINGS is not None:
+        TIMINGS.observe(phase, time.perf_counter() - start)
+
+def timings_report():
+    """
+    Print where the time of the run went to stderr.
+    """
+    TIMINGS.observe('total', time.perf_counter() - STARTUP[0][1])
+    sys.stderr.write('Timings:\n')
+    TIMINGS.timings_report(sys.stderr)
 
+def startup_report():
+    """
+    Print where the start up time went to stderr.
+    """
+    sys.stderr.write('Startup report:\n')
+    sys.stderr.write('  {:<22s} {:8.1f} ms cpu\n'.format('interpreter start', STARTUP_CPU * 1000))
+    for (prev, cur) in zip(STARTUP, STARTUP[1:]):
+        sys.stderr.write('  {:<22s} {:8.1f} ms\n'.format(cur[0], (cur[1] - prev[1]) * 1000))
+    sys.stderr.write('  {:<22s} {:8d}\n'.format('modules loaded', len(sys.modules)))
+    heavy = [m for m in ('http.client', 'ssl', 'json', 'asyncio', 'bs4') if m in sys.modules]
+    sys.stderr.write('  {:<22s} {}\n'.format('heavy modules', ', '.join(heavy) if heavy else 'none'))
+    sys.stderr.write('  Run with "python -X importtime" for a per module breakdown.\n')
+
+def add_sp8h_parser(subparsers):
     #sp8h command
     sp8h_parser = subparsers.add_parser('sp8h', help="Target is a SP8H device.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     sp8h_parser.add_argument('--device-ip'      , '-i', type=ip_address , help="Device ip address", required=True)
+    sp8h_parser.add_argument('--port'           , type=int              , help="Device http port", default=80)
     sp8h_parser.add_argument('--user'           , '-U', type=str        , help="Username for login SP8H", default='admin')
     sp8h_parser.add_argument('--passwd'         , '-P', type=str        , help="Password for login SP8H", default='admin')
     sp8h_parser.add_argument('--machine-id'     , '-m', type=int        , help="Select machine id", nargs='+', choices=range(1,5), required=True)
@@ -49,25 +115,212 @@ def main():
     sp8h_parser.add_argument('--get-status'     , '-g', help="Get power status", action="store_true")
     sp8h_parser.add_argument('--interval'       , '-I', type=int        , help="Interval time(ms) for each operation", default=700)
     sp8h_parser.add_argument('--retry'          , '-r', type=int        , help="Number of retry", default=0)
-    sp8h_parser.add_argument('--retry-interval' , '-t', type=int        , help="Retry interval time(s)", default=5)
+    sp8h_parser.add_argument('--retry-interval' , '-t', type=float      , help="Time(s) to wait for ports to converge before a retry", default=5)
+    sp8h_parser.add_argument('--poll-interval'  , type=int              , help="Minimum interval time(ms) between status read backs", default=200)
+    sp8h_parser.add_argument('--session-cache'  , '-c', help="Reuse a cached login session and keep it for the next run", action="store_true")
+    sp8h_parser.add_argument('--session-file'   , type=str              , help="Session cache file, ~/.cache/power_ctrl/sessions.json if not given")
+    sp8h_parser.add_argument('--session-ttl'    , type=int              , help="Session cache lifetime(s)", default=300)
+    sp8h_parser.add_argument('--connect-timeout', type=float            , help="Time(s) to wait for the device to accept a connection", default=5)
+    sp8h_parser.add_argument('--read-timeout'   , type=float            , help="Time(s) to wait for the device to reply", default=10)
+    sp8h_parser.add_argument('--status-connections', type=int           , help="Connections used to read the status of several machines in parallel", default=2)
+    sp8h_parser.add_argument('--daemon-socket'  , '-D', type=str        , help="Send the requests through the power_ctrl daemon on this socket")
     sp8h_parser.add_argument('--verbose'        , '-v', help="Increase output verbosity", action="store_true")
 
+def add_aw2401_parser(subparsers):
     #aw2401 command
     aw2401_parser = subparsers.add_parser('aw2401', help="Target is an AW2401 device.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     aw2401_parser.add_argument('--device-ip'    , '-i', type=ip_address , help="Device ip address", required=True)
+    aw2401_parser.add_argument('--port'         , type=int              , help="Device http port", default=80)
     aw2401_parser.add_argument('--power-id'     , '-p', type=int        , help="Select power id", nargs='+', choices=range(1,5))
     aw2401_parser.add_argument('--power-status' , '-s', type=str        , help="Set power status", choices=['on', 'off'])
     aw2401_parser.add_argument('--get-status'   , '-g', help="Get power status", action="store_true")
+    aw2401_parser.add_argument('--connect-timeout', type=float          , help="Time(s) to wait for the device to accept a connection", default=5)
+    aw2401_parser.add_argument('--read-timeout' , type=float            , help="Time(s) to wait for the device to reply", default=10)
+    aw2401_parser.add_argument('--daemon-socket', '-D', type=str        , help="Send the requests through the power_ctrl daemon on this socket")
     aw2401_parser.add_argument('--verbose'      , '-v', help="Increase output verbosity", action="store_true")
 
+def add_telemetry_parser(subparsers):
+    #telemetry command
+    telemetry_parser = subparsers.add_parser('telemetry', help="Sample port states and currents of many devices into a ring buffer.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    telemetry_parser.add_argument('--config'    , '-C', type=str        , help="Device configuration file (json), like for the daemon", required=True)
+    telemetry_parser.add_argument('--interval'  , '-i', type=float      , help="Time(s) between two samples", default=10)
+    telemetry_parser.add_argument('--capacity'  , '-n', type=int        , help="Samples kept per machine", default=8640)
+    telemetry_parser.add_argument('--duration'  , '-d', type=float      , help="Time(s) to sample, until Ctrl+C if not given")
+    telemetry_parser.add_argument('--csv'       , type=str              , help="Export the samples to this csv file")
+    telemetry_parser.add_argument('--npy'       , type=str              , help="Export the samples as one .npy file per machine into this directory")
+    telemetry_parser.add_argument('--verbose'   , '-v', help="Increase output verbosity", action="store_true")
+
+def add_watch_parser(subparsers):
+    watch_parser = subparsers.add_parser('watch', help="Watch a device and print what changes", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    watch_parser.add_argument('--type'          , '-T', type=str        , help="Device type", choices=['sp8h', 'aw2401'], default='sp8h')
+    watch_parser.add_argument('--device-ip'     , '-i', type=ip_address , help="Device ip address", required=True)
+    watch_parser.add_argument('--port'          , type=int              , help="Device http port", default=80)
+    watch_parser.add_argument('--user'          , '-U', type=str        , help="Username for login SP8H", default='admin')
+    watch_parser.add_argument('--passwd'        , '-P', type=str        , help="Password for login SP8H", default='admin')
+    watch_parser.add_argument('--machine-id'    , '-m', type=int        , help="Select SP8H machine id", nargs='+', choices=range(1,5), default=[1])
+    watch_parser.add_argument('--min-interval'  , type=float            , help="Time(s) between two reads after a change", default=0.5)
+    watch_parser.add_argument('--max-interval'  , type=float            , help="Longest time(s) between two reads of a quiet device", default=10)
+    watch_parser.add_argument('--backoff'       , type=float            , help="Growth of the interval after each read without change", default=1.5)
+    watch_parser.add_argument('--threshold'     , type=float            , help="Smallest current change(A) that is printed", default=0.1)
+    watch_parser.add_argument('--duration'      , '-d', type=float      , help="Time(s) to watch, until Ctrl+C if not given")
+    watch_parser.add_argument('--connect-timeout', type=float           , help="Time(s) to wait for the device to accept a connection", default=5)
+    watch_parser.add_argument('--read-timeout'  , type=float            , help="Time(s) to wait for the device to reply", default=10)
+    watch_parser.add_argument('--verbose'       , '-v', help="Increase output verbosity", action="store_true")
+
+def add_journal_parser(subparsers):
+    journal_parser = subparsers.add_parser('journal', help="Search the journal of switches", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    journal_parser.add_argument('--file'        , '-f', type=str        , help="Journal file, --journal or $POWER_CTRL_JOURNAL if not given")
+    journal_parser.add_argument('--device'      , '-i', type=str        , help="Only this device, ip:port", dest='device_name')
+    journal_parser.add_argument('--machine-id'  , '-m', type=int        , help="Only this machine of --device, 0 for an AW-2401")
+    journal_parser.add_argument('--power-id'    , '-p', type=int        , help="Only this power id of --device")
+    journal_parser.add_argument('--since'       , type=str              , help="From this time: seconds since the epoch, \"YYYY-MM-DD[ HH:MM[:SS]]\" or an age like 30m, 2h, 7d")
+    journal_parser.add_argument('--until'       , type=str              , help="Until this time, same forms as --since")
+    journal_parser.add_argument('--limit'       , '-n', type=int        , help="Show the newest n entries only, 0 for all", default=50)
+    journal_parser.add_argument('--devices'     , help="List the devices in the journal", action="store_true")
+    journal_parser.add_argument('--verbose'     , '-v', help="Increase output verbosity", action="store_true")
+
+def add_daemon_parser(subparsers):
+    #daemon command
+    daemon_parser = subparsers.add_parser('daemon', help="Keep warm device sessions and serve them on a unix socket.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    daemon_parser.add_argument('--config'       , '-C', type=str        , help="Daemon configuration file (json)", required=True)
+    daemon_parser.add_argument('--socket'       , '-S', type=str        , help="Unix socket path, overrides the configuration")
+    daemon_parser.add_argument('--verbose'      , '-v', help="Increase output verbosity", action="store_true")
+
+def add_apply_parser(subparsers):
+    #apply command
+    apply_parser = subparsers.add_parser('apply', help="Bring many devices to a desired state, only switching ports that differ.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    apply_parser.add_argument('--file'          , '-f', type=str        , help="Desired state file (json)", required=True)
+    apply_parser.add_argument('--dry-run'       , '-n', help="Only print the ports that would be switched", action="store_true")
+    apply_parser.add_argument('--jobs'          , '-j', type=int        , help="Number of devices handled in parallel", default=16)
+    apply_parser.add_argument('--interval'      , '-I', type=int        , help="Interval time(ms) between two SP8H switches", default=700)
+    apply_parser.add_argument('--retry'         , '-r', type=int        , help="Number of retry", default=0)
+    apply_parser.add_argument('--retry-interval', '-t', type=float      , help="Time(s) to wait for ports to converge before a retry", default=5)
+    apply_parser.add_argument('--poll-interval' , type=int              , help="Minimum interval time(ms) between status read backs", default=200)
+    apply_parser.add_argument('--budget'        , '-b', type=float      , help="Power on SP8H ports in batches, keeping each machine under this current(A)")
+    apply_parser.add_argument('--device-budget' , type=float            , help="Current(A) budget of a whole SP8H, with --budget")
+    apply_parser.add_argument('--port-load'     , type=float            , help="Expected load(A) of a port, with --budget", default=1.0)
+    apply_parser.add_argument('--inrush'        , type=float            , help="Inrush current of a port at power on, times its load, with --budget", default=3.0)
+    apply_parser.add_argument('--timeout'       , type=float            , help="Give up on the devices that are not done after this time(s)")
+    apply_parser.add_argument('--verbose'       , '-v', help="Increase output verbosity", action="store_true")
+
+def add_reset_parser(subparsers):
+    #reset command
+    reset_parser = subparsers.add_parser('reset', help="Reset many ports across devices in parallel and confirm each reset.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    reset_parser.add_argument('--file'          , '-f', type=str        , help="Reset file (json)", required=True)
+    reset_parser.add_argument('--jobs'          , '-j', type=int        , help="Number of devices handled in parallel", default=16)
+    reset_parser.add_argument('--deadline'      , '-t', type=float      , help="Time(s) for the whole run, ports not reset by then are skipped", default=60)
+    reset_parser.add_argument('--interval'      , '-I', type=int        , help="Interval time(ms) between two SP8H resets", default=700)
+    reset_parser.add_argument('--poll-interval' , type=int              , help="Minimum interval time(ms) between status read backs", default=200)
+    reset_parser.add_argument('--settle-timeout', type=float            , help="Time(s) for a port to go off and on again", default=10)
+    reset_parser.add_argument('--off-time'      , type=float            , help="Time(s) an AW-2401 port is kept off", default=1)
+    reset_parser.add_argument('--verbose'       , '-v', help="Increase output verbosity", action="store_true")
+
+class prescan_parser(argparse.ArgumentParser):
+    """
+    Raise ValueError instead of exiting, the full parser reports the error.
+    """
+
+    def error(self, message):
+        raise ValueError(message)
+
+def add_global_arguments(parser):
+    parser.add_argument('--startup-report', help="Print where the start up time went", action="store_true")
+    parser.add_argument('--timings', help="Print the time spent per request type and in sleeps", action="store_true")
+    parser.add_argument('--journal', type=str, help="Record switches and read backs in this journal file, $POWER_CTRL_JOURNAL if not given",
+                        default=os.environ.get('POWER_CTRL_JOURNAL'))
+    parser.add_argument('--format', type=str, help="Output format, jsonl writes a JSON record per port event or status sample as it happens",
+                        choices=['text', 'jsonl'], default='text')
+
+def selected_command(argv):
+    """
+    The command name of argv, or None if there is none (or not a known one).
+    The global options are parsed first, so their values are not taken for it.
+    """
+    prescan = prescan_parser(add_help=False)
+    add_global_arguments(prescan)
+    try:
+        (known, rest) = prescan.parse_known_args(argv)
+    except ValueError:
+        return None
+    for a in rest:
+        if not a.startswith('-'):
+            return a if a in COMMANDS else None
+    return None
+
+def main():
+    """
+    A CLI parser to control power switch.
+    """
+    startup_mark('cli imports')
+
+    parser = power_ctrl_cliparser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_global_arguments(parser)
+
+    subparsers = parser.add_subparsers(title='Support devices', dest='device', help="device")
+
+    # Only build the sub parser of the selected command, all of them for help and errors.
+    selected = selected_command(sys.argv[1:])
+    for name in [selected] if selected else COMMANDS:
+        COMMANDS[name][0](subparsers)
+
     #print(parser.parse_args())
     args = parser.parse_args()
+    startup_mark('argument parsing')
 
     #for debug
     #print(args)
     if not args.device:
         parser.error('the following arguments are required: sp8h or aw2401')
 
+    if args.timings:
+        global TIMINGS
+        from power_ctrl_metrics import request_metrics
+        TIMINGS = request_metrics().install()
+        TIMINGS.observe('startup', time.perf_counter() - STARTUP[0][1])
+
+    if args.format == 'jsonl':
+        global RECORDS, RETRIES
+        import power_ctrl
+        RECORDS = jsonl_writer(sys.stdout)
+        RETRIES = retry_counter()
+        power_ctrl.HOOKS.append(RETRIES)
+        # Only the records go to stdout, every other message to stderr.
+        sys.stdout = sys.stderr
+
+    journal = None
+    if args.journal and args.device not in ('journal', 'daemon'):
+        from power_ctrl_journal import operation_journal
+        user = os.environ.get('USER') or os.environ.get('LOGNAME') or 'uid {}'.format(os.getuid())
+        journal = operation_journal(args.journal, '{} {} pid {}'.format(args.device, user, os.getpid())).install()
+
+    try:
+        COMMANDS[args.device][1](parser, args)
+    except Exception as e:
+        # The drivers are imported lazily, so are their errors.
+        power_ctrl = sys.modules.get('power_ctrl')
+        if power_ctrl is None or not isinstance(e, power_ctrl.power_ctrl_error):
+            raise
+        if RECORDS is not None:
+            RECORDS('error', message=str(e))
+        sys.exit('Error: {}'.format(e))
+    finally:
+        if journal is not None:
+            journal.uninstall()
+            journal.close()
+        if args.startup_report:
+            startup_mark('run')
+            startup_report()
+        if args.timings:
+            timings_report()
+
+    return
+
+def check_device_args(parser, args):
+    """
+    Checks shared by the device commands.
+    """
     if (not args.power_id and not args.power_status) and (not args.get_status):
         parser.error('the following arguments are required: --power-id/-p and --power_status/-s or --get_status/-g')
 
@@ -84,140 +337,504 @@ def main():
     if args.verbose:
         sys.stdout.write('\nPower control utility support sp8h and aw2401.\n\n')
 
-    if args.device == 'sp8h':
+def run_sp8h(parser, args):
+    check_device_args(parser, args)
 
-        if args.verbose:
-            sys.stdout.write('Device sp8h:\n')
-            sys.stdout.write('  IP: {}, user: {}, password: {}\n'.format((args.device_ip), (args.user), (args.passwd)))
-            sys.stdout.write('  interval: {}(ms), retry: {}, retry_interval: {}(s)\n'.format((args.interval), (args.retry), (args.retry_interval)))
+    if args.daemon_socket:
+        from power_ctrl_daemon import daemon_client
+        from power_ctrl_daemon import daemon_sp8h
+        o_sp8h = daemon_sp8h(daemon_client(args.daemon_socket), '{}:{}'.format(args.device_ip, args.port))
+    else:
+        from power_ctrl import sp8h
+        o_sp8h = sp8h()
+    startup_mark('driver import')
 
-        retry_list = []
+    device = '{}:{}'.format(args.device_ip, args.port)
 
-        if args.interval < 700:
-            parser.error('Interval did not less than 700ms')
+    # Every request goes through one scheduler, the daemon has a scheduler of its own.
+    dev = o_sp8h
+    if not args.daemon_socket:
+        from power_ctrl_scheduler import device_scheduler
+        dev = device_scheduler(o_sp8h)
 
-        o_sp8h.target_url = str(args.device_ip)
-        o_sp8h.user = args.user
-        o_sp8h.passwd = args.passwd
-        o_sp8h.connect()
-        if o_sp8h.login() == None:
-            if args.verbose:
-                sys.stdout.write('\nLogin sp8h success.\n\n')
-            if args.power_id and args.power_status:
-                if args.verbose:
-                    sys.stdout.write('Set power status for SP8H:\n')
+    def signal_handler(sig, frame):
+        sys.stdout.write('You pressed Ctrl+C!')
+        if o_sp8h.session_cache is None:
+            dev.logout()
+            sys.stdout.write('\nLogout sp8h.')
+        o_sp8h.disconnect()
+        sys.stdout.write('\nDisconnect sp8h.\n')
+        sys.exit(0)
 
-                for mid in args.machine_id:
-                    retry_count = args.retry
-                    for pid in args.power_id:
-                        if args.verbose:
-                            sys.stdout.write('  Machine: {}, power_id: {}, status: {:>3s}\n'.format((mid), (pid), (args.power_status)))
-                        # Delay for set power starus.
-                        time.sleep(args.interval/1000)
-                        o_sp8h.switch(mid, pid, 1 if args.power_status == 'on' else 2 if args.power_status == 'off' else 3)
+    signal.signal(signal.SIGINT, signal_handler)
 
-                    # Read back the power status to make sure the setting successful.
-                    # Delay for get power starus.
-                    time.sleep(1.2)
-                    status_data = o_sp8h.get_status(mid)
+    if args.verbose:
+        sys.stdout.write('Device sp8h:\n')
+        sys.stdout.write('  IP: {}, user: {}, password: {}\n'.format((args.device_ip), (args.user), (args.passwd)))
+        sys.stdout.write('  interval: {}(ms), retry: {}, retry_interval: {}(s), poll_interval: {}(ms)\n'.format((args.interval), (args.retry), (args.retry_interval), (args.poll_interval)))
+
+    if args.interval < 700:
+        parser.error('Interval did not less than 700ms')
+
+    o_sp8h.target_url = str(args.device_ip)
+    o_sp8h.port = args.port
+    o_sp8h.user = args.user
+    o_sp8h.passwd = args.passwd
+    o_sp8h.connect_timeout = args.connect_timeout
+    o_sp8h.read_timeout = args.read_timeout
+    if args.session_cache and not args.daemon_socket:
+        from power_ctrl import session_cache
+        o_sp8h.session_cache = session_cache(args.session_file, args.session_ttl)
+    o_sp8h.connect()
+    if dev.login() == None:
+        if args.verbose:
+            sys.stdout.write('\nLogin sp8h success{}.\n\n'.format(' (cached session)' if o_sp8h.session_reused else ''))
+        if args.power_id and args.power_status:
+            if args.verbose:
+                sys.stdout.write('Set power status for SP8H:\n')
+
+            from power_ctrl_converge import sp8h_converger
+            converger = sp8h_converger(dev, args.interval/1000, args.poll_interval/1000, args.retry_interval)
+            action = 1 if args.power_status == 'on' else 2 if args.power_status == 'off' else 3
+            if RECORDS is not None:
+                converger.on_result = lambda r: RECORDS('switch', device=device, machine=r.machine_id, port=r.power_id,
+                    action=args.power_status, state=None if r.state is None else 'off' if r.state == '0' else 'on', ok=r.converged,
+                    latency=None if r.elapsed is None else round(r.elapsed, 4), attempts=r.attempts)
 
+            for mid in args.machine_id:
+                if args.verbose:
                     for pid in args.power_id:
-                        idx = 1
-                        for status in status_data:
-                            if idx == pid:
-                                if status[0] is not ('1' if args.power_status == 'on' else '0'):
-                                    #sys.stdout.write('    Power control fail, power_id: {}, status: {:>3s}\n'.format((idx), 'off' if status[0] is '0' else 'on'))
-                                    retry_list.append(pid)
-                            idx=idx+1
-
-                    if args.verbose:
-                        if retry_list:
-                            sys.stdout.write('\nFail to set power status for SP8H:\n')
-                            for pid in retry_list:
-                                sys.stdout.write('  Machine: {}, power_id: {}, status: {:>3s}\n'.format((mid), (pid), (args.power_status)))
-
-                    while retry_list and retry_count > 0:
-                        retry_count=retry_count-1
-                        # Delay for each retry cycle.
-                        time.sleep(args.retry_interval)
-                        for pid in retry_list:
-                            # Delay for set power starus.
-                            time.sleep(args.interval/1000)
-                            o_sp8h.switch(mid, pid, 1 if args.power_status == 'on' else 2 if args.power_status == 'off' else 3)
-
-                        # Read back the power status to make sure the setting successful.
-                        # Delay for get power starus.
-                        time.sleep(1.2)
-                        status_data = o_sp8h.get_status(mid)
-
-                        for pid in retry_list:
-                            if len(status_data):
-                                idx = 1
-                                for status in status_data:
-                                    if idx == pid:
-                                        if status[0] is ('1' if args.power_status == 'on' else '0'):
-                                            sys.stdout.write('    Retry power control success, power_id: {}, status: {:>3s}\n'.format((idx), 'off' if status[0] is '0' else 'on'))
-                                            retry_list.remove(pid)
-                                        else:
-                                            sys.stdout.write('    Retry power control fail, power_id: {}, status: {:>3s}\n'.format((idx), 'off' if status[0] is '0' else 'on'))
-
-                                    idx=idx+1
-                            else:
-                                sys.stdout.write('    Fail to get power status!\n')
-
-                    sys.stdout.write('\n')
-                #End for loop
-
-            if args.get_status:
-                sys.stdout.write('Get power status from SP8H:\n')
-                for mid in args.machine_id:
-                    sys.stdout.write('  Machine {}:\n'.format((mid)))
-                    # Delay for get power starus.
-                    time.sleep(2.0)
-                    status_data = o_sp8h.get_status(mid)
-                    if len(status_data):
-                        i = 1
-                        for status in status_data:
-                            sys.stdout.write('    Power_id: {}, status: {:>3s}\n'.format((i), 'off' if status[0] is '0' else 'on'))
-                            i=i+1
+                        sys.stdout.write('  Machine: {}, power_id: {}, status: {:>3s}\n'.format((mid), (pid), (args.power_status)))
+
+                # Switch and poll the read back until the ports converge.
+                slept = converger.slept
+                results = converger.run(mid, args.power_id, action, args.retry)
+                if TIMINGS is not None:
+                    TIMINGS.observe('sleep: interval/read back', converger.slept - slept)
+                for r in results if RECORDS is None else []:
+                    if r.converged:
+                        if args.verbose or r.attempts > 1:
+                            sys.stdout.write('    Power control success, machine: {}, power_id: {}, status: {:>3s}, converged in {:.2f}s, attempts: {}\n'.format((mid), (r.power_id), (args.power_status), (r.elapsed), (r.attempts)))
+                    elif r.unverified:
+                        sys.stdout.write('    Power control unverified, machine: {}, power_id: {}, status:  on, off phase not seen, attempts: {}\n'.format((mid), (r.power_id), (r.attempts)))
                     else:
-                            sys.stdout.write('    Fail to get power status!\n')
+                        sys.stdout.write('    Power control fail, machine: {}, power_id: {}, status: {:>3s}, attempts: {}\n'.format((mid), (r.power_id), 'n/a' if r.state is None else 'off' if r.state == '0' else 'on', (r.attempts)))
+
+                if args.verbose:
+                    sys.stdout.write('  Settle time: {:.2f}s\n'.format(converger.settle))
 
+                sys.stdout.write('\n')
+            #End for loop
 
-        o_sp8h.logout()
+        if args.get_status:
+            sys.stdout.write('Get power status from SP8H:\n')
+            if args.power_id and args.power_status:
+                # Delay for get power starus.
+                timed_sleep(2.0, 'sleep: status delay')
+            o_sp8h.status_connections = args.status_connections
+            retries = RETRIES.get(device) if RETRIES is not None else 0
+            start = time.perf_counter()
+            status_all = dev.get_status_all(args.machine_id)
+            latency = time.perf_counter() - start
+            for mid in args.machine_id:
+                sys.stdout.write('  Machine {}:\n'.format((mid)))
+                status_data = status_all[mid]
+                if RECORDS is not None:
+                    status_records(device, mid, status_data, latency, RETRIES.get(device) - retries)
+                elif len(status_data):
+                    i = 1
+                    for status in status_data:
+                        sys.stdout.write('    Power_id: {}, status: {:>3s}\n'.format((i), 'off' if status[0] == '0' else 'on'))
+                        i=i+1
+                else:
+                        sys.stdout.write('    Fail to get power status!\n')
+
+
+    # Keep a cached session alive for the next run.
+    if o_sp8h.session_cache is None:
+        dev.logout()
         if args.verbose:
             sys.stdout.write('\nLogout sp8h.')
 
-        o_sp8h.disconnect()
+    if dev is not o_sp8h:
+        dev.close()
+    o_sp8h.disconnect()
+    if args.verbose:
+        sys.stdout.write('\nDisconnect sp8h.\n')
+
+def run_aw2401(parser, args):
+    check_device_args(parser, args)
+
+    if args.daemon_socket:
+        from power_ctrl_daemon import daemon_client
+        from power_ctrl_daemon import daemon_aw2401
+        o_aw2401 = daemon_aw2401(daemon_client(args.daemon_socket), '{}:{}'.format(args.device_ip, args.port))
+    else:
+        from power_ctrl import aw2401
+        o_aw2401 = aw2401()
+    startup_mark('driver import')
+    device = '{}:{}'.format(args.device_ip, args.port)
+
+    o_aw2401.target_url = str(args.device_ip)
+    o_aw2401.port = args.port
+    o_aw2401.connect_timeout = args.connect_timeout
+    o_aw2401.read_timeout = args.read_timeout
+    o_aw2401.connect()
+
+    # Every request goes through one scheduler, the daemon has a scheduler of its own.
+    dev = o_aw2401
+    if not args.daemon_socket:
+        from power_ctrl_scheduler import device_scheduler
+        dev = device_scheduler(o_aw2401)
+
+    if args.power_id and args.power_status:
         if args.verbose:
-            sys.stdout.write('\nDisconnect sp8h.\n')
+            sys.stdout.write('\nSet power status for AW2401:\n')
+            for pid in args.power_id:
+                sys.stdout.write('  Power_id:{}, status: {:>3s}\n'.format(pid, args.power_status))
+
+        start = time.perf_counter()
+        dev.switch(args.power_id, 1 if args.power_status == 'on' else 0)
+        if RECORDS is not None:
+            latency = round(time.perf_counter() - start, 4)
+            for pid in args.power_id:
+                RECORDS('switch', device=device, machine=0, port=pid, action=args.power_status, state=None, ok=True, latency=latency, attempts=1)
+
+    if args.get_status:
+        #sys.stdout.write(o_aw2401.get_status())
+        retries = RETRIES.get(device) if RETRIES is not None else 0
+        start = time.perf_counter()
+        status_data = dev.get_status()
+        if RECORDS is not None:
+            status_records(device, 0, status_data, time.perf_counter() - start, RETRIES.get(device) - retries)
+        else:
+            i = 1
+            sys.stdout.write('\nGet power status from AW2401:\n')
+            for status in status_data:
+                sys.stdout.write('  Power_id:{}, status: {:>3s}\n'.format(i, 'on' if status[0] == '1' else 'off'))
+                i=i+1
+
+    if dev is not o_aw2401:
+        dev.close()
+    o_aw2401.disconnect()
+
+def run_apply(parser, args):
+    from power_ctrl_apply import STATE_NAMES
+    from power_ctrl_apply import load_state
+    from power_ctrl_apply import plan_fleet
+    startup_mark('driver import')
+
+    if args.interval < 700:
+        parser.error('Interval did not less than 700ms')
 
+    try:
+        state = load_state(args.file)
+        budget = None
+        if args.budget:
+            budget = {'machine_budget': args.budget, 'device_budget': args.device_budget, 'port_load': args.port_load, 'inrush': args.inrush}
+        def on_change(plan, c):
+            if args.dry_run:
+                RECORDS('plan', device=plan.name, machine=c.machine_id, port=c.power_id,
+                        action=STATE_NAMES[c.desired], state=STATE_NAMES.get(c.current, c.current))
+            else:
+                RECORDS('switch', device=plan.name, machine=c.machine_id, port=c.power_id,
+                        action=STATE_NAMES[c.desired], state=STATE_NAMES[c.desired] if c.done else None, ok=c.done,
+                        latency=None if c.elapsed is None else round(c.elapsed, 4), attempts=c.attempts, reason=c.reason)
+
+        def on_done(plan):
+            if plan.error:
+                RECORDS('error', device=plan.name, message=plan.error)
+
+        plans = plan_fleet(state, args.jobs, args.dry_run, args.interval/1000, args.poll_interval/1000, args.retry_interval, args.retry, budget,
+                           on_change if RECORDS is not None else None, on_done if RECORDS is not None else None, args.timeout)
+    except (OSError, ValueError) as e:
+        sys.exit('Error: {}'.format(e))
+
+    if RECORDS is not None:
+        failed = sum(1 for p in plans if p.error) + sum(1 for p in plans for c in p.changes if not args.dry_run and not c.done)
+        RECORDS('done', devices=len(plans), checked=sum(p.checked for p in plans), changes=sum(len(p.changes) for p in plans), failed=failed)
+        if failed:
+            sys.exit(1)
         return
 
-    if args.device == 'aw2401':
-        o_aw2401 = aw2401()
-        o_aw2401.target_url = str(args.device_ip)
-        o_aw2401.connect()
+    failed = 0
+    for plan in plans:
+        if plan.error:
+            failed += 1
+            sys.stdout.write('{}: Error: {}\n'.format(plan.name, plan.error))
+        if not plan.changes:
+            if args.verbose and not plan.error:
+                sys.stdout.write('{}: {} port(s) already in state\n'.format(plan.name, plan.checked))
+            continue
+        sys.stdout.write('{}:\n'.format(plan.name))
+        for c in plan.changes:
+            if args.dry_run:
+                result = ''
+            elif c.done:
+                result = ', done' if c.attempts < 2 else ', done after {} attempts'.format(c.attempts)
+            else:
+                failed += 1
+                result = ', fail ({})'.format(c.reason) if c.reason else ', fail'
+            sys.stdout.write('  {}{}\n'.format(c, result))
+
+    sys.stdout.write('{} of {} port(s) on {} device(s) {}\n'.format(
+        sum(len(p.changes) for p in plans), sum(p.checked for p in plans), len(plans),
+        'to switch' if args.dry_run else 'switched'))
+    if failed:
+        sys.exit(1)
+
+def run_reset(parser, args):
+    from power_ctrl_reset import load_targets
+    from power_ctrl_reset import reset_fleet
+    startup_mark('driver import')
+
+    if args.interval < 700:
+        parser.error('Interval did not less than 700ms')
+
+    def on_result(r):
+        RECORDS('reset', device=r.device, machine=r.machine_id, port=r.power_id, result=r.result,
+                off_after=None if r.off_after is None else round(r.off_after, 4),
+                on_after=None if r.on_after is None else round(r.on_after, 4), off_seen_by=r.off_seen_by,
+                ampere_before=r.ampere_before, ampere_min=r.ampere_min, error=r.error)
+
+    start = time.monotonic()
+    try:
+        targets = load_targets(args.file)
+        resets = reset_fleet(targets, args.jobs, args.deadline, args.interval/1000, args.poll_interval/1000,
+                             args.settle_timeout, args.off_time, on_result if RECORDS is not None else None)
+    except (OSError, ValueError) as e:
+        sys.exit('Error: {}'.format(e))
+    elapsed = time.monotonic() - start
+
+    results = [r for reset in resets for r in reset.results]
+    # Back on without the off phase seen is no confirmed reset, the device may have ignored it.
+    confirmed = sum(1 for r in results if r.result == 'confirmed')
+    unverified = sum(1 for r in results if r.result == 'unverified')
+    failed = len(results) - confirmed - unverified
+
+    if RECORDS is not None:
+        RECORDS('done', devices=len(resets), ports=len(results), confirmed=confirmed, unverified=unverified,
+                failed=failed, elapsed=round(elapsed, 3))
+        if confirmed < len(results):
+            sys.exit(1)
+        return
 
-        if args.power_id and args.power_status:
-            if args.verbose:
-                sys.stdout.write('\nSet power status for AW2401:\n')
-                for pid in args.power_id:
-                    sys.stdout.write('  Power_id:{}, status: {:>3s}\n'.format(pid, args.power_status))
+    for reset in resets:
+        sys.stdout.write('{}:\n'.format(reset.name))
+        if reset.error:
+            sys.stdout.write('  Error: {}\n'.format(reset.error))
+        for r in reset.results:
+            line = '{}power_id {}: {}'.format('machine {}, '.format(r.machine_id) if r.machine_id else '', r.power_id, r.result)
+            if r.off_after is not None:
+                line += ', off after {:.2f}s'.format(r.off_after)
+                if r.off_seen_by == 'ampere':
+                    line += ' (ampere)'
+            if r.on_after is not None:
+                line += ', on after {:.2f}s'.format(r.on_after)
+            if args.verbose and r.ampere_before is not None and r.ampere_min is not None:
+                line += ', {:.2f}A -> {:.2f}A'.format(r.ampere_before, r.ampere_min)
+            if r.error and r.error != reset.error:
+                line += ' ({})'.format(r.error)
+            sys.stdout.write('  {}\n'.format(line))
+
+    sys.stdout.write('{} of {} port(s) on {} device(s) reset and confirmed in {:.2f}s{}\n'.format(
+        confirmed, len(results), len(resets), elapsed, ', {} unverified'.format(unverified) if unverified else ''))
+    if confirmed < len(results):
+        sys.exit(1)
+
+def run_telemetry(parser, args):
+    from power_ctrl_daemon import load_config
+    from power_ctrl_telemetry import telemetry_poller
+    startup_mark('driver import')
+
+    if args.interval <= 0 or args.capacity <= 0:
+        parser.error('Interval and capacity must be positive')
 
-            o_aw2401.switch(args.power_id, 1 if args.power_status == 'on' else 0)
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError) as e:
+        sys.exit('Error: {}'.format(e))
+
+    poller = telemetry_poller(config.get("devices", []), args.interval, args.capacity)
+    if RECORDS is not None:
+        poller.on_sample = lambda name, mid, when, status_data, elapsed: status_records(name, mid, status_data, elapsed)
+        poller.on_error = lambda name, e: RECORDS('error', device=name, message=str(e))
+    if args.verbose:
+        sys.stdout.write('Sampling {} device(s) every {}s\n'.format(len(poller.targets), args.interval))
+        sys.stdout.flush()
 
-        if args.get_status:
-            #sys.stdout.write(o_aw2401.get_status())
-            i = 1
-            sys.stdout.write('\nGet power status from AW2401:\n')
-            for status in o_aw2401.get_status():
-                sys.stdout.write('  Power_id:{}, status: {:>3s}\n'.format(i, status))
-                i=i+1
+    try:
+        poller.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        poller.close()
+
+    if RECORDS is not None:
+        for ((name, mid), ports) in poller.summary().items():
+            for p in ports:
+                RECORDS('summary', device=name, machine=mid, **p)
+    for ((name, mid), ports) in poller.summary().items() if RECORDS is None else []:
+        sys.stdout.write('{}{}:\n'.format(name, ' machine {}'.format(mid) if mid else ''))
+        for p in ports:
+            if p['mean'] is None:
+                sys.stdout.write('  Power_id: {}, on: {:>4.0%}\n'.format(p['port'], p['on']))
+            else:
+                sys.stdout.write('  Power_id: {}, on: {:>4.0%}, min: {:.2f}A, max: {:.2f}A, mean: {:.2f}A\n'.format(
+                    p['port'], p['on'], p['min'], p['max'], p['mean']))
+    for (name, count) in sorted(poller.errors.items()):
+        sys.stdout.write('{}: {} failed sample(s), last: {}\n'.format(name, count, poller.last_error[name]))
+    for (name, count) in sorted(poller.skipped.items()):
+        sys.stdout.write('{}: {} sample(s) skipped while the device was down\n'.format(name, count))
+    if args.verbose:
+        sys.stdout.write('{} tick(s), {} missed, {} bytes of samples\n'.format(
+            poller.ticks, poller.missed, sum(b.nbytes() for b in poller.buffers.values())))
+
+    if args.csv:
+        poller.export_csv(args.csv)
+    if args.npy:
+        poller.export_npy(args.npy)
+
+def run_watch(parser, args):
+    from power_ctrl_daemon import device_session
+    from power_ctrl_watch import status_watcher
+    startup_mark('driver import')
+
+    if args.min_interval <= 0 or args.max_interval < args.min_interval or args.backoff < 1:
+        parser.error('Need 0 < min interval <= max interval and backoff >= 1')
+
+    device = '{}:{}'.format(args.device_ip, args.port)
+    session = device_session({"type": args.type, "ip": str(args.device_ip), "port": args.port, "user": args.user, "passwd": args.passwd,
+                              "connect_timeout": args.connect_timeout, "read_timeout": args.read_timeout})
+    machines = sorted(set(args.machine_id)) if args.type == 'sp8h' else [0]
+    watcher = status_watcher(session, machines, args.min_interval, args.max_interval, args.backoff, args.threshold)
+
+    def state_name(state):
+        return None if state is None else 'on' if state == '1' else 'off'
+
+    def report(c):
+        if RECORDS is not None:
+            RECORDS('change', device=device, machine=c['machine'], port=c['port'], state=state_name(c['state']), ampere=c['ampere'],
+                    previous_state=state_name(c['previous_state']), previous_ampere=c['previous_ampere'])
+            return
+        where = '{} machine {}, power_id {}'.format(time.strftime('%H:%M:%S'), c['machine'], c['port']) if args.type == 'sp8h' else \
+                '{} power_id {}'.format(time.strftime('%H:%M:%S'), c['port'])
+        if c['previous_state'] is None:
+            change = state_name(c['state'])
+        elif c['previous_state'] != c['state']:
+            change = '{} -> {}'.format(state_name(c['previous_state']), state_name(c['state']))
+        else:
+            change = state_name(c['state'])
+        if c['ampere'] is not None:
+            change += ', {:.2f}A'.format(c['ampere']) if c['previous_ampere'] is None else ', {:.2f}A -> {:.2f}A'.format(c['previous_ampere'], c['ampere'])
+        sys.stdout.write('{}: {}\n'.format(where, change))
+        sys.stdout.flush()
+
+    def on_error(e):
+        if RECORDS is not None:
+            RECORDS('error' if e is not None else 'recovered', device=device, **({'message': str(e)} if e is not None else {}))
+            return
+        sys.stdout.write('{} {}\n'.format(time.strftime('%H:%M:%S'), 'Error: {}'.format(e) if e is not None else 'Device answers again'))
+        sys.stdout.flush()
+
+    # "kill -USR1" after switching a port makes the watch read the device at once.
+    signal.signal(signal.SIGUSR1, lambda sig, frame: watcher.poke())
+    signal.signal(signal.SIGTERM, lambda sig, frame: watcher.stop())
+    try:
+        watcher.run(report, args.duration, on_error)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if session.breaker is not None:
+            session.breaker.close()
+        with session.lock:
+            session.close()
 
-        o_aw2401.disconnect()
+    if args.verbose:
+        sys.stdout.write('{} read(s), {} change(s), {} request(s)\n'.format(watcher.polls, watcher.changes, session.scheduler.requests))
 
-    return
+def parse_when(value):
+    """
+    Seconds since the epoch from "1700000000", "2026-10-17 06:00[:00]", "2026-10-17" or an age like "30m".
+    """
+    if value is None:
+        return None
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value[-1:] in units and value[:-1].replace('.', '', 1).isdigit():
+        return time.time() - float(value[:-1]) * units[value[-1]]
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise ValueError('Invalid time: {}'.format(value))
+
+def run_journal(parser, args):
+    from power_ctrl_journal import operation_journal
+    startup_mark('driver import')
+
+    path = args.file or args.journal
+    if not path:
+        parser.error('the following arguments are required: --file/-f')
+    if (args.machine_id is not None or args.power_id is not None) and not args.device_name:
+        parser.error('--machine-id and --power-id need --device')
+
+    try:
+        start = parse_when(args.since)
+        end = parse_when(args.until)
+        journal = operation_journal(path, writable=False)
+    except (OSError, ValueError) as e:
+        sys.exit('Error: {}'.format(e))
+
+    if args.devices:
+        for name in journal.devices():
+            sys.stdout.write('{}\n'.format(name))
+        journal.close()
+        return
+
+    begin = time.perf_counter()
+    entries = journal.query(args.device_name, args.machine_id, args.power_id, start, end, args.limit or None)
+    elapsed = time.perf_counter() - begin
+    for e in entries:
+        if RECORDS is not None:
+            RECORDS('journal', **e.as_dict())
+        else:
+            sys.stdout.write('{}\n'.format(e))
+    if args.verbose:
+        sys.stdout.write('{} of {} record(s) in {:.1f}ms\n'.format(len(entries), len(journal), elapsed * 1000))
+    journal.close()
+
+def run_daemon(parser, args):
+    from power_ctrl_daemon import load_config
+    from power_ctrl_daemon import power_ctrl_daemon
+
+    config = load_config(args.config)
+    if args.socket:
+        config['socket'] = args.socket
+
+    daemon = power_ctrl_daemon(config)
+    if args.verbose:
+        sys.stdout.write('Serving {} device(s) on {}\n'.format(len(set(daemon.sessions.values())), daemon.socket_path))
+        sys.stdout.flush()
+
+    # Log out of every device on kill, not only on Ctrl+C.
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    daemon.serve_forever()
+
+COMMANDS = {
+    'sp8h': (add_sp8h_parser, run_sp8h),
+    'aw2401': (add_aw2401_parser, run_aw2401),
+    'apply': (add_apply_parser, run_apply),
+    'reset': (add_reset_parser, run_reset),
+    'telemetry': (add_telemetry_parser, run_telemetry),
+    'watch': (add_watch_parser, run_watch),
+    'journal': (add_journal_parser, run_journal),
+    'daemon': (add_daemon_parser, run_daemon),
+}
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import time
+
+class port_result:
+    """
+    The outcome of switching one SP8H port.
+    A reset only converges once the port read back off after the request and then
+    on again, off_after is the time until it read off. A reset port that still reads
+    on at the deadline without having read off is unverified: the device may have
+    cycled it between two reads, so it is not reset again.
+    """
+
+    def __init__(self, machine_id, power_id, expected, reset=False):
+        self.machine_id = machine_id
+        self.power_id = power_id
+        self.expected = expected
+        self.reset = reset
+        self.off_after = None
+        self.state = None
+        self.converged = False
+        self.unverified = False
+        self.elapsed = None
+        self.attempts = 0
+        self.sent_at = 0.0
+        self.timeout_at = 0.0
+
+    def __repr__(self):
+        return 'port_result(machine_id={}, power_id={}, converged={}, unverified={}, elapsed={}, attempts={})'.format(
+            self.machine_id, self.power_id, self.converged, self.unverified, self.elapsed, self.attempts)
+
+class sp8h_converger:
+    """
+    Switch SP8H ports and poll get_status() until they reach the requested state,
+    instead of sleeping a fixed time before every readback.
+
+    The ports are switched interval apart and the ones in flight are read back
+    in between, so each port is watched from its own request on. The time each
+    port takes to settle is measured, and the first poll after a switch is
+    scheduled from a running average of it, so a fast device is read back as soon
+    as it is done and a slow one is not polled in vain.
+
+    on_result, if set, is called with each port_result as soon as it converged or
+    was unverified, or once it failed its last attempt.
+    """
+
+    # Weight of the newest measurement in the settle time average.
+    SETTLE_WEIGHT = 0.3
+
+    def __init__(self, dev, interval=0.7, poll_interval=0.2, deadline=5.0, settle=1.2):
+        self.dev = dev
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self.deadline = deadline
+        self.settle = settle
+        self.last_switch = 0.0
+        self.last_poll = 0.0
+        self.slept = 0.0
+        self.on_result = None
+
+    def expected_state(self, action):
+        """
+        The status string a port reads back once the action is done, a reset ends powered on.
+        """
+        return '0' if action == self.dev.POWER_OFF else '1'
+
+    def trace(self, event, r, action, **fields):
+        """
+        Pass a "port_resend" or "port_verify" event to the hooks of the device, see http_device.emit().
+        """
+        emit = getattr(self.dev, 'emit', None)
+        if emit is not None:
+            emit(event, "switch", machine=r.machine_id, port=r.power_id, action=self.dev.ACTION_NAMES.get(action, action),
+                 attempt=r.attempts, **fields)
+
+    def wait_until(self, when):
+        delay = when - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+            self.slept += delay
+
+    def measure(self, elapsed):
+        """
+        Fold one observed settle time into the running average.
+        """
+        self.settle = (1 - self.SETTLE_WEIGHT) * self.settle + self.SETTLE_WEIGHT * elapsed
+
+    def first_poll(self, r):
+        """
+        Seconds from the request to the first read of a port. A reset is read every
+        poll_interval until it read off, its off phase can be shorter than the
+        settle time.
+        """
+        if r.reset and r.off_after is None:
+            return self.poll_interval
+        return self.settle
+
+    def send(self, machine_id, r, action):
+        # Keep the switch requests at least interval apart.
+        self.wait_until(self.last_switch + self.interval)
+        self.dev.switch(machine_id, r.power_id, action)
+        r.sent_at = self.last_switch = time.monotonic()
+        r.timeout_at = r.sent_at + self.deadline
+        r.off_after = None
+        r.attempts += 1
+        if r.attempts > 1:
+            self.trace("port_resend", r, action)
+
+    def update(self, r, state, now, action, settled):
+        """
+        Take one read of a port in flight, returns True once it is done: converged,
+        unverified or past its deadline. Adds the settle time it showed to settled.
+        """
+        r.state = state
+        if r.reset and r.off_after is None:
+            # A port already on reads '1' before the device cycled it.
+            if r.state == '0':
+                r.off_after = now - r.sent_at
+                settled.append(r.off_after)
+            elif now >= r.timeout_at and r.state == '1':
+                # Never seen off, the off phase may have fallen between two reads:
+                # resetting it again would cycle the machine twice.
+                r.unverified = True
+                r.elapsed = now - r.sent_at
+                self.trace("port_verify", r, action, ok=False, elapsed=r.elapsed)
+                if self.on_result is not None:
+                    self.on_result(r)
+                return True
+            return now >= r.timeout_at
+        if r.state == r.expected:
+            r.converged = True
+            r.elapsed = now - r.sent_at
+            # A reset counts with the time until it read off, the time it stays
+            # off is up to the device.
+            if not r.reset:
+                settled.append(r.elapsed)
+            self.trace("port_verify", r, action, ok=True, elapsed=r.elapsed)
+            if self.on_result is not None:
+                self.on_result(r)
+            return True
+        return now >= r.timeout_at
+
+    def switch(self, machine_id, pending, action):
+        """
+        Send the action to the pending ports interval apart and read back the ports
+        in flight in between, each from settle after its own request, until every
+        port is done or its deadline passed.
+        """
+        unsent = list(pending)
+        active = []
+        next_poll = {}
+
+        while unsent or active:
+            next_send = self.last_switch + self.interval if unsent else None
+            poll_at = None
+            if active:
+                poll_at = max(min(next_poll[r] for r in active), self.last_poll + self.poll_interval)
+            if poll_at is None or (next_send is not None and next_send <= poll_at):
+                r = unsent.pop(0)
+                self.send(machine_id, r, action)
+                next_poll[r] = min(r.sent_at + self.first_poll(r), r.timeout_at)
+                active.append(r)
+                continue
+
+            self.wait_until(poll_at)
+            status_data = self.dev.get_status(machine_id)
+            now = self.last_poll = time.monotonic()
+            settled = []
+            for r in list(active):
+                state = status_data[r.power_id - 1][0] if r.power_id <= len(status_data) else r.state
+                if self.update(r, state, now, action, settled):
+                    active.remove(r)
+
+            # The port switched last bounds the settle time closest.
+            if settled:
+                self.measure(min(settled))
+            for r in active:
+                # Poll faster than the average settle time, but not faster than poll_interval.
+                delay = self.poll_interval if r.reset and r.off_after is None else max(self.poll_interval, self.settle / 4)
+                next_poll[r] = min(now + delay, r.timeout_at)
+
+    def run(self, machine_id, power_ids, action, retry=0):
+        """
+        Switch the ports of one machine and return a port_result per port.
+        Ports that did not converge before the deadline are switched again, up to retry times,
+        but not a reset that was never seen off.
+        """
+        results = [port_result(machine_id, pid, self.expected_state(action), action == self.dev.POWER_RST) for pid in power_ids]
+        pending = list(results)
+
+        for attempt in range(retry + 1):
+            self.switch(machine_id, pending, action)
+            pending = [r for r in pending if not r.converged and not r.unverified]
+            if not pending:
+                break
+
+        for r in pending:
+            self.trace("port_verify", r, action, ok=False, elapsed=None)
+            if self.on_result is not None:
+                self.on_result(r)
+        return results
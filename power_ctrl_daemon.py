@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+import json
+import os
+import socket
+import threading
+import time
+from power_ctrl import power_ctrl_error
+from power_ctrl import connection_error
+from power_ctrl import circuit_breaker
+from power_ctrl import device_health
+from power_ctrl import probe_port
+from power_ctrl_scheduler import device_scheduler
+
+DEFAULT_SOCKET = "/tmp/power_ctrl.sock"
+
+class device_session:
+    """
+    A warm connection to one configured device.
+    All requests to the device go through lock, so there is only ever one
+    session and one request in flight per device. scheduler is the one
+    device_scheduler of the device, which spaces, prioritizes and merges its
+    requests; switch() and get_status() and anything driving the device, like
+    apply, reset and watch, go through it. dev is the driver, kept for the life
+    of the session and connected (and logged in) by open().
+    health outlives the sessions, and unless "breaker_threshold" is 0 a
+    circuit_breaker makes requests fail fast while the device is down.
+    """
+
+    def __init__(self, conf, status_cache=None):
+        self.conf = conf
+        self.status_cache = status_cache
+        self.kind = conf.get("type", "sp8h")
+        self.name = conf.get("name", "{}:{}".format(conf["ip"], conf.get("port", 80)))
+        self.lock = threading.Lock()
+        self.opened = False
+        self.last_used = 0.0
+        self.health = device_health()
+        self.breaker = None
+        if conf.get("breaker_threshold", 3):
+            self.breaker = circuit_breaker(self.health, self.probe, conf.get("breaker_threshold", 3),
+                                           conf.get("breaker_backoff", 1.0), conf.get("breaker_max_backoff", 60.0))
+        self.dev = self.new_device()
+        self.scheduler = device_scheduler(self.dev, self.kind, conf.get("spacing"), conf.get("switch_spacing"),
+                                          conf.get("merge_window", 0.05), execute=self.call)
+
+    def new_device(self):
+        from power_ctrl import sp8h
+        from power_ctrl import aw2401
+
+        if self.kind == "sp8h":
+            dev = sp8h()
+            dev.user = self.conf.get("user", "admin")
+            dev.passwd = self.conf.get("passwd", "admin")
+        else:
+            dev = aw2401()
+        dev.target_url = self.conf["ip"]
+        dev.port = self.conf.get("port", 80)
+        dev.connect_timeout = self.conf.get("connect_timeout", dev.connect_timeout)
+        dev.read_timeout = self.conf.get("read_timeout", dev.read_timeout)
+        dev.status_cache = self.status_cache
+        dev.health = self.health
+        dev.breaker = self.breaker
+        return dev
+
+    def open(self):
+        self.dev.connect()
+        if self.kind == "sp8h":
+            self.dev.login()
+        self.opened = True
+
+    def close(self):
+        if not self.opened:
+            return
+        try:
+            if self.kind == "sp8h" and self.dev.is_login:
+                self.dev.logout()
+            self.dev.disconnect()
+        except power_ctrl_error:
+            pass
+        if self.kind == "sp8h":
+            self.dev.is_login = False
+        self.opened = False
+
+    def probe(self):
+        probe_port(self.conf["ip"], self.conf.get("port", 80), self.conf.get("connect_timeout", 5.0))
+
+    def is_down(self):
+        return self.breaker is not None and self.breaker.is_open()
+
+    def call(self, func, retry=True):
+        """
+        Run func(dev) on the warm session. The driver itself reconnects a dropped
+        socket and renews an expired SP8H session, anything else failing gets
+        one more try on a new session if retry. A device that does not accept a
+        new connection gets no second try, it would only wait out another timeout.
+        """
+        if self.breaker is not None:
+            self.breaker.check(self.name)
+        with self.lock:
+            for attempt in range(2):
+                opening = not self.opened
+                try:
+                    if opening:
+                        self.open()
+                    result = func(self.dev)
+                except power_ctrl_error as e:
+                    self.close()
+                    if attempt or not retry or (opening and isinstance(e, connection_error)):
+                        raise
+                    continue
+                self.last_used = time.monotonic()
+                return result
+
+    def switch(self, machine_id, power_ids, action):
+        if self.kind == "sp8h":
+            futures = [self.scheduler.submit_switch(machine_id, pid, action) for pid in power_ids]
+        else:
+            futures = [self.scheduler.submit_switch(power_ids, action)]
+        for f in futures:
+            f.result()
+
+    def get_status(self, machine_id):
+        return self.scheduler.get_status(machine_id if self.kind == "sp8h" else 0)
+
+    def keepalive(self, idle):
+        """
+        Touch an idle SP8H session before the device times it out.
+        """
+        if self.kind == "sp8h" and self.opened and time.monotonic() - self.last_used > idle:
+            try:
+                # Past the status cache, it must reach the device.
+                self.scheduler.read_status(1)
+            except power_ctrl_error:
+                pass
+
+class power_ctrl_daemon:
+    """
+    Serve switch/status requests for a configured set of devices on a Unix
+    domain socket, one JSON object per line in each direction.
+    """
+
+    def __init__(self, config):
+        self.socket_path = config.get("socket", DEFAULT_SOCKET)
+        self.keepalive = config.get("keepalive", 60)
+        self.status_cache = None
+        if config.get("status_ttl"):
+            from power_ctrl import status_cache
+            self.status_cache = status_cache(config["status_ttl"], config.get("status_entries", 1024))
+        self.metrics = None
+        self.metrics_port = config.get("metrics_port")
+        if self.metrics_port:
+            from power_ctrl_metrics import request_metrics
+            self.metrics = request_metrics().install()
+        self.journal = None
+        if config.get("journal"):
+            from power_ctrl_journal import operation_journal
+            self.journal = operation_journal(config["journal"], "daemon pid {}".format(os.getpid())).install()
+        self.sessions = {}
+        for conf in config.get("devices", []):
+            s = device_session(conf, self.status_cache)
+            self.sessions[s.name] = s
+            # Also reachable by ip and ip:port.
+            self.sessions.setdefault("{}:{}".format(conf["ip"], conf.get("port", 80)), s)
+            self.sessions.setdefault(conf["ip"], s)
+        self.stopping = threading.Event()
+
+    def find(self, name):
+        s = self.sessions.get(name)
+        if s is None:
+            raise power_ctrl_error("Unknown device: {}".format(name))
+        return s
+
+    def handle(self, req):
+        op = req.get("op")
+        if op == "ping":
+            return {"ok": True}
+        if op == "devices":
+            names = sorted(set(s.name for s in self.sessions.values()))
+            return {"ok": True, "devices": [{"name": n, "type": self.sessions[n].kind} for n in names]}
+        if op == "stats":
+            schedulers = dict((s.name, {"requests": s.scheduler.requests, "coalesced": s.scheduler.coalesced, "merged": s.scheduler.merged})
+                              for s in set(self.sessions.values()))
+            return {"ok": True, "status_cache": self.status_cache.stats() if self.status_cache else None, "schedulers": schedulers}
+        if op == "health":
+            return {"ok": True, "health": dict((s.name, dict(s.health.as_dict(), breaker=s.breaker.as_dict() if s.breaker else None))
+                                               for s in set(self.sessions.values()))}
+
+        s = self.find(req.get("device"))
+        if op == "switch":
+            s.switch(req.get("machine_id", 0), req["power_id"], req["action"])
+            return {"ok": True}
+        if op == "status":
+            return {"ok": True, "status": [list(p) for p in s.get_status(req.get("machine_id", 0))]}
+        return {"ok": False, "error": "Unknown op: {}".format(op)}
+
+    def serve_client(self, conn):
+        with conn:
+            f = conn.makefile("rwb")
+            for line in f:
+                try:
+                    reply = self.handle(json.loads(line))
+                except power_ctrl_error as e:
+                    reply = {"ok": False, "error": str(e)}
+                except (ValueError, KeyError, TypeError) as e:
+                    reply = {"ok": False, "error": "Bad request: {}".format(e)}
+                f.write(json.dumps(reply).encode("utf-8") + b"\n")
+                f.flush()
+
+    def keepalive_loop(self):
+        while not self.stopping.wait(self.keepalive / 2):
+            for s in set(self.sessions.values()):
+                s.keepalive(self.keepalive)
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            # Only a stale socket is removed, not the one of a daemon still running.
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                os.unlink(self.socket_path)
+            else:
+                raise power_ctrl_error("{}: another daemon is listening on it".format(self.socket_path))
+            finally:
+                probe.close()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        server.listen(64)
+
+        threading.Thread(target=self.keepalive_loop, daemon=True).start()
+        metrics_server = None
+        if self.metrics is not None:
+            from power_ctrl_metrics import serve_metrics
+            metrics_server = serve_metrics(self.metrics, self.metrics_port)
+        try:
+            while not self.stopping.is_set():
+                conn, addr = server.accept()
+                threading.Thread(target=self.serve_client, args=(conn,), daemon=True).start()
+        finally:
+            self.stopping.set()
+            server.close()
+            if metrics_server is not None:
+                metrics_server.shutdown()
+            os.unlink(self.socket_path)
+            for s in set(self.sessions.values()):
+                if s.breaker is not None:
+                    s.breaker.close()
+                with s.lock:
+                    s.close()
+            if self.journal is not None:
+                self.journal.uninstall()
+                self.journal.close()
+
+class daemon_client:
+    """
+    Talk to a running power_ctrl_daemon.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.socket_path = socket_path
+        self.sock = None
+        self.f = None
+
+    def request(self, **req):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(self.socket_path)
+            except OSError as e:
+                self.sock = None
+                raise connection_error('Cannot reach daemon at {}: {}'.format(self.socket_path, e)) from None
+            self.f = self.sock.makefile("rwb")
+
+        self.f.write(json.dumps(req).encode("utf-8") + b"\n")
+        self.f.flush()
+        line = self.f.readline()
+        if not line:
+            self.close()
+            raise connection_error('Daemon closed the connection')
+        reply = json.loads(line)
+        if not reply.get("ok"):
+            raise power_ctrl_error(reply.get("error", "Daemon request failed"))
+        return reply
+
+    def close(self):
+        if self.sock is not None:
+            self.f.close()
+            self.sock.close()
+            self.sock = None
+
+class daemon_sp8h:
+    """
+    Drop-in for sp8h that sends switch/get_status through the daemon.
+    Login and logout are the daemon's business, so they do nothing here.
+    """
+
+    POWER_OFF = 2
+    POWER_ON = 1
+    POWER_RST = 3
+
+    def __init__(self, client, device):
+        self.client = client
+        self.device = device
+        self.session_cache = None
+        self.session_reused = True
+        self.is_login = False
+
+    def connect(self):
+        self.client.request(op="ping")
+
+    def disconnect(self):
+        self.client.close()
+
+    def login(self):
+        self.is_login = True
+
+    def logout(self):
+        self.is_login = False
+
+    def switch(self, machin_id=0, power_id=0, action=1):
+        self.client.request(op="switch", device=self.device, machine_id=machin_id, power_id=[power_id], action=action)
+
+    def get_status_all(self, machin_ids):
+        return dict((mid, self.get_status(mid)) for mid in machin_ids)
+
+    def get_status(self, machin_id=0):
+        return self.client.request(op="status", device=self.device, machine_id=machin_id)["status"]
+
+class daemon_aw2401:
+    """
+    Drop-in for aw2401 that sends switch/get_status through the daemon.
+    """
+
+    POWER_OFF = 0
+    POWER_ON = 1
+
+    def __init__(self, client, device):
+        self.client = client
+        self.device = device
+
+    def connect(self):
+        self.client.request(op="ping")
+
+    def disconnect(self):
+        self.client.close()
+
+    def switch(self, pwr_list, action=1):
+        self.client.request(op="switch", device=self.device, power_id=list(pwr_list), action=action)
+
+    def get_status(self):
+        return self.client.request(op="status", device=self.device)["status"]
+
+def load_config(path):
+    """
+    Read the daemon configuration, e.g.
+    {"socket": "/tmp/power_ctrl.sock", "keepalive": 60, "status_ttl": 2, "metrics_port": 9464,
+     "devices": [{"name": "rack1", "type": "sp8h", "ip": "10.0.0.1", "user": "admin", "passwd": "admin",
+                  "spacing": 0.1, "switch_spacing": 0.7, "merge_window": 0.05},
+                 {"name": "lab", "type": "aw2401", "ip": "10.0.0.2"}]}
+    """
+    with open(path) as f:
+        return json.load(f)
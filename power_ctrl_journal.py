@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+import mmap
+import os
+import struct
+import threading
+import time
+
+KINDS = {1: 'switch', 2: 'resend', 3: 'verify'}
+ACTIONS = {1: 'on', 2: 'off', 3: 'reset'}
+RESULTS = {0: 'sent', 1: 'confirmed', 2: 'unconfirmed', 3: 'error'}
+KIND_CODES = dict((name, code) for (code, name) in KINDS.items())
+ACTION_CODES = dict((name, code) for (code, name) in ACTIONS.items())
+RESULT_CODES = dict((name, code) for (code, name) in RESULTS.items())
+
+# Time, previous record of the device + 1, device, source, machine, port, kind,
+# action, result, attempt, elapsed(s, NaN if unknown).
+RECORD = struct.Struct('<dIIHBBBBBxHf2x')
+MAGIC = b'PCJRNL01'
+HEADER = struct.Struct('<8sIIQ')
+MAX_DEVICES = 65536
+# Source ids are stored in 16 bits.
+MAX_SOURCES = 65536
+HEADS_OFFSET = 4096
+DATA_OFFSET = HEADS_OFFSET + 4 * MAX_DEVICES
+GROW = 32768
+
+class journal_entry:
+    __slots__ = ('time', 'device', 'source', 'machine', 'port', 'kind', 'action', 'result', 'attempt', 'elapsed')
+
+    def __init__(self, **fields):
+        for (k, v) in fields.items():
+            setattr(self, k, v)
+
+    def as_dict(self):
+        fields = dict((k, getattr(self, k)) for k in self.__slots__)
+        if fields['elapsed'] != fields['elapsed']:
+            fields['elapsed'] = None
+        return fields
+
+    def __str__(self):
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.time)) + '.{:03d}'.format(int(self.time * 1000) % 1000)
+        where = '{} machine {}, power_id {}'.format(self.device, self.machine, self.port) if self.machine else \
+                '{} power_id {}'.format(self.device, self.port)
+        what = '{} {} {}'.format(self.kind, self.action, self.result)
+        if self.attempt > 1:
+            what += ', attempt {}'.format(self.attempt)
+        if self.elapsed == self.elapsed:
+            what += ', {:.2f}s'.format(self.elapsed)
+        return '{} {}: {} ({})'.format(when, where, what, self.source)
+
+class operation_journal:
+    """
+    An append-only journal of port switches, resends and read back results.
+
+    Records are fixed size and written into a memory-mapped file. The header
+    holds the record count and, per device, the number of its newest record;
+    every record points to the previous one of its device. Records are in time
+    order, so a time range is found by bisection and the history of a device
+    by following its chain, neither reads the records in between. Device and
+    source names are kept in a "<path>.names" file next to it.
+
+    It is a hook for power_ctrl.HOOKS (or dev.hooks): install() records the
+    "port_switch", "port_resend" and "port_verify" events of every device.
+    Several processes can append to the same journal.
+    """
+
+    def __init__(self, path, source=None, writable=True):
+        self.path = path
+        self.writable = writable
+        self.source = source if source is not None else 'pid {}'.format(os.getpid())
+        self.lock = threading.Lock()
+        self.names = {'d': [], 's': []}
+        self.ids = {'d': {}, 's': {}}
+        self.names_size = 0
+        self.map = None
+        self.errors = 0
+        self.last_error = None
+
+        if writable and not os.path.exists(path):
+            with open(path, 'ab'):
+                pass
+        self.f = open(path, 'r+b' if writable else 'rb')
+        if writable:
+            with self:
+                if os.fstat(self.f.fileno()).st_size == 0:
+                    self.f.truncate(DATA_OFFSET + GROW * RECORD.size)
+                    self.f.write(HEADER.pack(MAGIC, 1, RECORD.size, 0))
+                    self.f.flush()
+        self.remap()
+        (magic, version, size, count) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or size != RECORD.size:
+            raise ValueError('{}: not a power_ctrl journal'.format(path))
+
+    def __enter__(self):
+        """
+        Hold the locks that serialize the writers of all threads and processes.
+        """
+        self.lock.acquire()
+        if os.name == "nt":
+            import msvcrt
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if os.name == "nt":
+            import msvcrt
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        self.lock.release()
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        size = os.fstat(self.f.fileno()).st_size
+        self.map = mmap.mmap(self.f.fileno(), size, access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ)
+
+    def __len__(self):
+        return HEADER.unpack_from(self.map, 0)[3]
+
+    def load_names(self):
+        """
+        Read the names other processes added since the last call.
+        """
+        try:
+            with open(self.path + '.names', 'rb') as f:
+                f.seek(self.names_size)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # Only whole lines, a writer may be in the middle of one.
+        data = data[:data.rfind(b'\n') + 1]
+        self.names_size += len(data)
+        for line in data.decode('utf-8').splitlines():
+            (kind, name) = line.split('\t', 1)
+            self.names[kind].append(name)
+            self.ids[kind][name] = len(self.names[kind])
+
+    def name_id(self, kind, name):
+        """
+        The id of a device ('d') or source ('s') name, added if new. Call with the file lock held.
+        """
+        if name not in self.ids[kind]:
+            self.load_names()
+        if name not in self.ids[kind]:
+            if kind == 'd' and len(self.names['d']) + 1 >= MAX_DEVICES:
+                raise ValueError('{}: more than {} devices'.format(self.path, MAX_DEVICES - 1))
+            if kind == 's' and len(self.names['s']) + 1 >= MAX_SOURCES:
+                raise ValueError('{}: more than {} sources'.format(self.path, MAX_SOURCES - 1))
+            line = '{}\t{}\n'.format(kind, name.replace('\n', ' ').replace('\t', ' ')).encode('utf-8')
+            with open(self.path + '.names', 'ab') as f:
+                f.write(line)
+            self.names_size += len(line)
+            self.names[kind].append(name)
+            self.ids[kind][name] = len(self.names[kind])
+        return self.ids[kind][name]
+
+    def name(self, kind, i):
+        if i > len(self.names[kind]):
+            self.load_names()
+        return self.names[kind][i - 1] if 0 < i <= len(self.names[kind]) else None
+
+    def append(self, device, machine, port, kind, action, result, attempt=1, elapsed=None, when=None):
+        """
+        Add one record, kind, action and result are names from KINDS, ACTIONS and RESULTS.
+        """
+        kind = KIND_CODES[kind]
+        action = ACTION_CODES.get(action, 0)
+        result = RESULT_CODES[result]
+        elapsed = float('nan') if elapsed is None else elapsed
+        when = time.time() if when is None else when
+
+        with self:
+            count = len(self)
+            end = DATA_OFFSET + (count + 1) * RECORD.size
+            if end > len(self.map):
+                if end > os.fstat(self.f.fileno()).st_size:
+                    self.f.truncate(DATA_OFFSET + (count + GROW) * RECORD.size)
+                self.remap()
+
+            dev_id = self.name_id('d', device)
+            src_id = self.name_id('s', self.source)
+            # Keep the file in time order for bisection, even if the clock steps back.
+            if count:
+                when = max(when, RECORD.unpack_from(self.map, DATA_OFFSET + (count - 1) * RECORD.size)[0])
+            prev = struct.unpack_from('<I', self.map, HEADS_OFFSET + 4 * dev_id)[0]
+            RECORD.pack_into(self.map, DATA_OFFSET + count * RECORD.size,
+                             when, prev, dev_id, src_id, machine, port, kind, action, result, attempt, elapsed)
+            struct.pack_into('<I', self.map, HEADS_OFFSET + 4 * dev_id, count + 1)
+            struct.pack_into('<Q', self.map, 16, count + 1)
+
+    def __call__(self, event):
+        kind = event['event']
+        if kind not in ('port_switch', 'port_resend', 'port_verify'):
+            return
+        # A journal that cannot be written must not stop the switching.
+        try:
+            if kind == 'port_switch':
+                result = 'sent' if event['error'] is None else 'error'
+                for port in event['ports']:
+                    self.append(event['device'], event['machine'], port, 'switch', event['action'], result)
+            elif kind == 'port_resend':
+                self.append(event['device'], event['machine'], event['port'], 'resend', event['action'], 'sent', event['attempt'])
+            else:
+                self.append(event['device'], event['machine'], event['port'], 'verify', event['action'],
+                            'confirmed' if event['ok'] else 'unconfirmed', event['attempt'], event['elapsed'])
+        except (OSError, ValueError, struct.error) as e:
+            self.errors += 1
+            self.last_error = str(e)
+
+    def install(self):
+        import power_ctrl
+        power_ctrl.HOOKS.append(self)
+        return self
+
+    def uninstall(self):
+        import power_ctrl
+        power_ctrl.HOOKS.remove(self)
+
+    def close(self):
+        if self.map is not None:
+            if self.writable:
+                self.map.flush()
+            self.map.close()
+            self.map = None
+        self.f.close()
+
+    def time_at(self, i):
+        return RECORD.unpack_from(self.map, DATA_OFFSET + i * RECORD.size)[0]
+
+    def bisect(self, when, count):
+        """
+        Index of the first record written at or after when.
+        """
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time_at(mid) < when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def entry(self, i):
+        (when, prev, dev_id, src_id, machine, port, kind, action, result, attempt, elapsed) = \
+            RECORD.unpack_from(self.map, DATA_OFFSET + i * RECORD.size)
+        return journal_entry(time=when, device=self.name('d', dev_id), source=self.name('s', src_id), machine=machine, port=port,
+                             kind=KINDS.get(kind), action=ACTIONS.get(action), result=RESULTS.get(result), attempt=attempt, elapsed=elapsed)
+
+    def query(self, device=None, machine=None, port=None, start=None, end=None, limit=None):
+        """
+        Return the journal_entry list of a device, machine, port and time range [start, end),
+        oldest first; with limit only the newest limit entries. machine and port need
+        a device: they are found on its chain, a port of every device would mean
+        reading the whole time range.
+        """
+        if device is None and (machine is not None or port is not None):
+            raise ValueError('machine and port need a device')
+        if len(self.map) < DATA_OFFSET + len(self) * RECORD.size:
+            self.remap()
+        count = len(self)
+
+        if device is None:
+            # Bisection over the time ordered records.
+            lo = 0 if start is None else self.bisect(start, count)
+            hi = count if end is None else self.bisect(end, count)
+            if limit is not None:
+                lo = max(lo, hi - limit)
+            return [self.entry(i) for i in range(lo, hi)]
+
+        self.load_names()
+        dev_id = self.ids['d'].get(device)
+        if dev_id is None:
+            return []
+        # The chain of the device, newest first.
+        found = []
+        i = struct.unpack_from('<I', self.map, HEADS_OFFSET + 4 * dev_id)[0]
+        while i:
+            (when, prev, dev_i, src_id, machine_i, port_i) = struct.unpack_from('<dIIHBB', self.map, DATA_OFFSET + (i - 1) * RECORD.size)
+            if start is not None and when < start:
+                break
+            if (end is None or when < end) and (machine is None or machine_i == machine) and (port is None or port_i == port):
+                found.append(i - 1)
+                if limit is not None and len(found) >= limit:
+                    break
+            i = prev
+        return [self.entry(i) for i in reversed(found)]
+
+    def devices(self):
+        self.load_names()
+        return list(self.names['d'])
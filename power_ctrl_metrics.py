@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import threading
+from bisect import bisect_left
+
+class histogram:
+    """
+    Latency histogram with fixed buckets (seconds), like a Prometheus histogram.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def cumulative(self):
+        total = 0
+        for (le, n) in zip(self.BUCKETS + (float('inf'),), self.counts):
+            total += n
+            yield (le, total)
+
+class request_metrics:
+    """
+    A hook for power_ctrl.HOOKS (or dev.hooks) that aggregates the request events
+    of every device: latency histograms per device and operation, status codes,
+    errors, reconnects, session retries, "TimeOut" answers and parse time.
+    observe() adds phases that are not requests, like deliberate sleeps.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.parse = {}
+        self.responses = {}
+        self.errors = {}
+        self.counters = {}
+        self.phases = {}
+
+    def __call__(self, event):
+        with self.lock:
+            kind = event['event']
+            key = (event['device'], event['op'])
+            if kind == 'request':
+                self.latency.setdefault(key, histogram()).observe(event['elapsed'])
+                self.phases.setdefault(event['op'], histogram()).observe(event['elapsed'])
+                if event['error'] is None:
+                    k = key + (event['status'],)
+                    self.responses[k] = self.responses.get(k, 0) + 1
+                else:
+                    k = key + (event['error'],)
+                    self.errors[k] = self.errors.get(k, 0) + 1
+            elif kind == 'parse':
+                self.parse.setdefault(key, histogram()).observe(event['elapsed'])
+                self.phases.setdefault('parse', histogram()).observe(event['elapsed'])
+            else:
+                k = (event['device'], kind)
+                self.counters[k] = self.counters.get(k, 0) + 1
+
+    def observe(self, phase, elapsed):
+        with self.lock:
+            self.phases.setdefault(phase, histogram()).observe(elapsed)
+
+    def install(self):
+        """
+        Collect the events of every device.
+        """
+        import power_ctrl
+        power_ctrl.HOOKS.append(self)
+        return self
+
+    def uninstall(self):
+        import power_ctrl
+        power_ctrl.HOOKS.remove(self)
+
+    def timings_report(self, out):
+        """
+        Write count, total, mean and max time per phase.
+        """
+        with self.lock:
+            out.write('  {:<24s} {:>6s} {:>10s} {:>10s} {:>10s}\n'.format('phase', 'count', 'total(ms)', 'mean(ms)', 'max(ms)'))
+            for (name, h) in self.phases.items():
+                out.write('  {:<24s} {:>6d} {:>10.2f} {:>10.2f} {:>10.2f}\n'.format(
+                    name, h.count, h.sum * 1000, h.sum * 1000 / h.count if h.count else 0.0, h.max * 1000))
+
+    def prometheus_text(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        def labels(**kv):
+            return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for (k, v) in kv.items())
+
+        def hist_lines(name, hists, label_names):
+            lines = ['# TYPE {} histogram'.format(name)]
+            for (key, h) in sorted(hists.items()):
+                kv = dict(zip(label_names, key))
+                for (le, n) in h.cumulative():
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels(**kv), '+Inf' if le == float('inf') else le, n))
+                lines.append('{}_sum{{{}}} {}'.format(name, labels(**kv), h.sum))
+                lines.append('{}_count{{{}}} {}'.format(name, labels(**kv), h.count))
+            return lines
+
+        def counter_lines(name, counts, label_names):
+            lines = ['# TYPE {} counter'.format(name)]
+            for (key, n) in sorted(counts.items(), key=lambda kv: tuple(str(k) for k in kv[0])):
+                lines.append('{}{{{}}} {}'.format(name, labels(**dict(zip(label_names, key))), n))
+            return lines
+
+        with self.lock:
+            lines = []
+            lines += hist_lines('power_ctrl_request_duration_seconds', self.latency, ('device', 'op'))
+            lines += hist_lines('power_ctrl_parse_duration_seconds', self.parse, ('device', 'op'))
+            lines += counter_lines('power_ctrl_responses_total', self.responses, ('device', 'op', 'status'))
+            lines += counter_lines('power_ctrl_request_errors_total', self.errors, ('device', 'op', 'error'))
+            for (kind, name) in (('reconnect', 'power_ctrl_reconnects_total'), ('retry', 'power_ctrl_session_retries_total'),
+                                 ('timeout_response', 'power_ctrl_timeout_responses_total')):
+                lines += counter_lines(name, dict(((d,), n) for ((d, k), n) in self.counters.items() if k == kind), ('device',))
+            return '\n'.join(lines) + '\n'
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """
+    Serve metrics.prometheus_text() on http://host:port/metrics from a background thread.
+    """
+    import http.server
+
+    class metrics_handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), metrics_handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
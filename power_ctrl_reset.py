@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+import json
+import time
+from power_ctrl import power_ctrl_error
+from power_ctrl_apply import run_parallel
+from power_ctrl_daemon import device_session
+from power_ctrl_sequence import MIN_GAP
+
+# A port counts as off when its current falls under this share of the current before the reset.
+DROP = 0.2
+# Currents below this(A) are too small to see a drop in.
+MIN_AMPERE = 0.05
+
+class port_reset:
+    """
+    The outcome of resetting one port.
+    result is 'pending', 'confirmed' (seen off, then on again), 'unverified' (on again,
+    but the off phase fell between two reads), 'failed' (not back on before the
+    settle timeout or the deadline), 'error' or 'skipped' (not sent before the deadline).
+    off_after and on_after are the seconds from the request until the port read off
+    and on again; off_seen_by is 'state', or 'ampere' if only the current showed it.
+    """
+
+    def __init__(self, device, machine_id, power_id):
+        self.device = device
+        self.machine_id = machine_id
+        self.power_id = power_id
+        self.result = 'pending'
+        self.sent_at = None
+        self.timeout_at = None
+        self.off_after = None
+        self.on_after = None
+        self.off_seen_by = None
+        self.ampere_before = None
+        self.ampere_min = None
+        self.error = None
+
+    def __repr__(self):
+        return 'port_reset(device={}, machine_id={}, power_id={}, result={}, off_after={}, on_after={})'.format(
+            self.device, self.machine_id, self.power_id, self.result, self.off_after, self.on_after)
+
+class device_reset:
+    """
+    Reset ports of one device and confirm each reset from get_status(): the port
+    has to read off, or its current drop, and then read on again.
+
+    SP8H ports get the reset action interval seconds apart, and the machines with
+    resets in flight are read every poll_interval seconds in between, so the off
+    phase of one port is watched while the next is sent; interval is at least
+    MIN_GAP, the polls would wait behind a closer switch. An AW-2401 has no reset,
+    its ports are switched off in one request and on again off_time seconds after
+    they read off; they are switched on whatever happened in between, at the
+    latest at the deadline, and get settle_timeout from then to read on again.
+    """
+
+    def __init__(self, conf, ports, interval=0.7, poll_interval=0.2, settle_timeout=10.0, off_time=1.0):
+        self.session = device_session(conf)
+        self.name = self.session.name
+        self.interval = max(interval, MIN_GAP)
+        self.poll_interval = poll_interval
+        self.settle_timeout = settle_timeout
+        self.off_time = off_time
+        self.results = [port_reset(self.name, mid, pid) for (mid, pids) in sorted(ports.items()) for pid in pids]
+        self.on_result = None
+        self.last_switch = 0.0
+        self.last_poll = 0.0
+        self.switched_off = False
+        self.switched_on = False
+        self.error = None
+
+    def finish(self, dev, r, result):
+        r.result = result
+        emit = getattr(dev, 'emit', None)
+        if emit is not None and r.sent_at is not None:
+            emit("port_verify", "switch", machine=r.machine_id, port=r.power_id, action='reset', attempt=1,
+                 ok=result == 'confirmed', elapsed=r.on_after)
+        if self.on_result is not None:
+            self.on_result(r)
+
+    def read(self, dev, machines):
+        """
+        Read the status of machines, returns {machine_id: status}.
+        """
+        self.last_poll = time.monotonic()
+        if self.session.kind != "sp8h":
+            return {0: dev.get_status()}
+        return dev.get_status_all(machines)
+
+    def update(self, dev, r, state, ampere, now):
+        ampere = float(ampere) if ampere is not None else None
+        if ampere is not None:
+            r.ampere_min = ampere if r.ampere_min is None else min(r.ampere_min, ampere)
+
+        if r.off_after is None:
+            dropped = ampere is not None and r.ampere_before is not None and r.ampere_before >= MIN_AMPERE and \
+                      ampere <= r.ampere_before * DROP
+            if state == '0' or dropped:
+                r.off_after = now - r.sent_at
+                r.off_seen_by = 'state' if state == '0' else 'ampere'
+                if self.session.kind != "sp8h" and not self.switched_on:
+                    # Kept off until the on switch, which starts a new timeout.
+                    r.timeout_at = None
+        elif state == '1' and r.on_after is None:
+            r.on_after = now - r.sent_at
+            self.finish(dev, r, 'confirmed')
+            return
+
+        if r.timeout_at is not None and now > r.timeout_at:
+            if r.off_after is None and state == '1':
+                r.on_after = now - r.sent_at
+                self.finish(dev, r, 'unverified')
+            else:
+                self.finish(dev, r, 'failed')
+
+    def poll(self, dev, active):
+        status = self.read(dev, sorted(set(r.machine_id for r in active)))
+        now = time.monotonic()
+        for r in active:
+            status_data = status[r.machine_id]
+            if r.power_id > len(status_data):
+                r.error = 'no power_id {}'.format(r.power_id)
+                self.finish(dev, r, 'error')
+                continue
+            (state, ampere) = status_data[r.power_id - 1]
+            self.update(dev, r, state, ampere, now)
+
+    def before(self, dev):
+        """
+        Take the currents before the reset, to see them drop.
+        """
+        status = self.read(dev, sorted(set(r.machine_id for r in self.results)))
+        for r in self.results:
+            status_data = status[r.machine_id]
+            if r.power_id <= len(status_data) and status_data[r.power_id - 1][1] is not None:
+                r.ampere_before = float(status_data[r.power_id - 1][1])
+
+    def wait_until(self, when, deadline):
+        delay = min(when, deadline) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def run(self, dev, deadline):
+        """
+        Reset the ports through dev, the session's scheduler, until done or the deadline
+        (time.monotonic()). A port is marked sent before its request, so it is never reset twice.
+        """
+        if all(r.ampere_before is None for r in self.results):
+            self.before(dev)
+        if self.session.kind == "sp8h":
+            self.run_sp8h(dev, deadline)
+        else:
+            self.run_aw2401(dev, deadline)
+
+    def run_sp8h(self, dev, deadline):
+        while True:
+            unsent = [r for r in self.results if r.sent_at is None and r.result == 'pending']
+            active = [r for r in self.results if r.sent_at is not None and r.result == 'pending']
+            if not unsent and not active:
+                return
+            if time.monotonic() >= deadline:
+                return
+
+            next_send = self.last_switch + self.interval if unsent else None
+            next_poll = self.last_poll + self.poll_interval if active else None
+            if next_poll is None or (next_send is not None and next_send <= next_poll):
+                self.wait_until(next_send, deadline)
+                if time.monotonic() >= deadline:
+                    return
+                r = unsent[0]
+                # Marked as sent first: after an error it is not sent again, only watched.
+                r.sent_at = time.monotonic()
+                r.timeout_at = r.sent_at + self.settle_timeout
+                dev.switch(r.machine_id, r.power_id, dev.POWER_RST)
+                self.last_switch = time.monotonic()
+            else:
+                self.wait_until(next_poll, deadline)
+                if time.monotonic() >= deadline:
+                    return
+                self.poll(dev, active)
+
+    def run_aw2401(self, dev, deadline):
+        unsent = [r for r in self.results if r.sent_at is None and r.result == 'pending']
+        if unsent and time.monotonic() < deadline:
+            now = time.monotonic()
+            for r in unsent:
+                r.sent_at = now
+                r.timeout_at = now + self.settle_timeout
+            try:
+                dev.switch([r.power_id for r in unsent], dev.POWER_OFF)
+            except power_ctrl_error:
+                # The request may have reached the device, they are switched on again below.
+                self.switched_off = True
+                raise
+            self.switched_off = True
+
+        try:
+            # Wait until every port read off, or gave up on it, then keep them off for off_time.
+            while not self.switched_on and time.monotonic() < deadline:
+                waiting = [r for r in self.results if r.result == 'pending' and r.off_after is None]
+                if not waiting:
+                    break
+                self.wait_until(self.last_poll + self.poll_interval, deadline)
+                self.poll(dev, [r for r in self.results if r.result == 'pending'])
+            off = [r for r in self.results if r.off_after is not None]
+            if off and not self.switched_on:
+                self.wait_until(max(r.sent_at + r.off_after for r in off) + self.off_time, deadline)
+        finally:
+            # A reset never leaves a port off: every port switched off goes on again,
+            # also after an error, the settle timeout or the deadline.
+            if self.switched_off and not self.switched_on:
+                dev.switch([r.power_id for r in self.results if r.sent_at is not None], dev.POWER_ON)
+                self.switched_on = True
+                for r in self.results:
+                    if r.result == 'pending':
+                        r.timeout_at = time.monotonic() + self.settle_timeout
+
+        while any(r.result == 'pending' for r in self.results) and time.monotonic() < deadline:
+            self.wait_until(self.last_poll + self.poll_interval, deadline)
+            self.poll(dev, [r for r in self.results if r.result == 'pending'])
+
+def load_targets(path):
+    """
+    Read a reset file, e.g.
+    {"devices": [{"name": "rack1", "type": "sp8h", "ip": "10.0.0.1", "machines": {"1": [1, 2], "2": [8]}},
+                 {"name": "lab", "type": "aw2401", "ip": "10.0.0.2", "ports": [1, 4]}]}
+    A device takes the same fields as in the daemon configuration.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+def target_ports(conf):
+    """
+    Return {machine_id: [power_id, ...]} of one device, an AW-2401 has machine 0 only.
+    """
+    if conf.get("type", "sp8h") == "sp8h":
+        return dict((int(mid), [int(pid) for pid in pids]) for (mid, pids) in conf.get("machines", {}).items())
+    return {0: [int(pid) for pid in conf.get("ports", [])]}
+
+def reset_fleet(targets, jobs=16, deadline=60.0, interval=0.7, poll_interval=0.2, settle_timeout=10.0, off_time=1.0, on_result=None):
+    """
+    Reset the ports of every device of a reset file, up to jobs devices at a time,
+    and return a device_reset per device once all are done, or after deadline
+    seconds. Ports still pending then are 'failed', those not sent 'skipped'.
+    A request in flight at the deadline is waited for (up to its timeouts), so
+    no AW-2401 is left with ports switched off.
+    on_result(port_reset) is called as each port is done.
+    """
+    end = time.monotonic() + deadline
+    resets = [device_reset(conf, target_ports(conf), interval, poll_interval, settle_timeout, off_time)
+              for conf in targets.get("devices", [])]
+
+    def run(reset):
+        reset.on_result = on_result
+        try:
+            reset.run(reset.session.scheduler, end)
+        except power_ctrl_error as e:
+            reset.error = str(e)
+        finally:
+            with reset.session.lock:
+                reset.session.close()
+
+    run_parallel(run, resets, jobs)
+
+    for reset in resets:
+        for r in reset.results:
+            if r.result != 'pending':
+                continue
+            if reset.error is not None:
+                r.result = 'error'
+                r.error = reset.error
+            else:
+                r.result = 'failed' if r.sent_at is not None else 'skipped'
+            if on_result is not None:
+                on_result(r)
+    return resets
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from power_ctrl import power_ctrl_error
+
+PRIO_SWITCH = 0
+PRIO_STATUS = 1
+
+class scheduled_job:
+    def __init__(self, priority, seq, func, not_before=0.0, is_switch=False):
+        self.priority = priority
+        self.seq = seq
+        self.func = func
+        self.not_before = not_before
+        self.is_switch = is_switch
+        self.future = Future()
+        self.waiters = 1
+        self.key = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class device_scheduler:
+    """
+    Send every request to one device from a single worker thread.
+
+    - Two requests are at least spacing seconds apart, two switches at least
+      switch_spacing.
+    - Switches go ahead of status reads, which are routine polling.
+    - A status read of a machine that is already queued is answered by that one.
+    - AW-2401 port changes queued within merge_window seconds go out as one
+      set_port_mode request, the later change of a port wins.
+
+    It has the switch/get_status of the device it wraps and blocks until the
+    request was sent; submit_switch/submit_status return a Future instead.
+    login(), logout(), get_status_all(), read_status() and set_port_mode() are
+    queued as well, so nothing reaches the device past it; other attributes,
+    like POWER_ON or emit(), are the device's.
+    execute(func, retry) runs func(dev), device_session passes its own to reopen
+    a failed session and, if retry, try once more; a switch is never retried.
+    The worker thread ends when the queue is empty and starts with the next job.
+    """
+
+    SPACING = {'sp8h': 0.1, 'aw2401': 0.05}
+    SWITCH_SPACING = {'sp8h': 0.7, 'aw2401': 0.05}
+
+    def __init__(self, dev, kind=None, spacing=None, switch_spacing=None, merge_window=0.05, execute=None):
+        self.dev = dev
+        self.kind = kind if kind else 'sp8h' if hasattr(dev, 'POWER_RST') else 'aw2401'
+        self.spacing = spacing if spacing is not None else self.SPACING[self.kind]
+        self.switch_spacing = switch_spacing if switch_spacing is not None else self.SWITCH_SPACING[self.kind]
+        self.merge_window = merge_window
+        self.execute = execute if execute else lambda func, retry: func(self.dev)
+
+        self.cond = threading.Condition()
+        self.queue = []
+        self.seq = itertools.count()
+        self.pending_status = {}
+        self.pending_modes = None
+        self.last_request = 0.0
+        self.last_switch = 0.0
+        self.worker = None
+        self.closed = False
+
+        self.requests = 0
+        self.coalesced = 0
+        self.merged = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getattr__(self, name):
+        # Constants like POWER_ON come from the device.
+        if name == 'dev' or self.__dict__.get('dev') is None:
+            raise AttributeError(name)
+        return getattr(self.dev, name)
+
+    def push(self, job):
+        if self.closed:
+            raise power_ctrl_error("Scheduler closed")
+        heapq.heappush(self.queue, job)
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+        self.cond.notify()
+
+    def submit(self, func, priority=PRIO_SWITCH, is_switch=False):
+        """
+        Queue func(dev) and return a Future of its result.
+        """
+        with self.cond:
+            job = scheduled_job(priority, next(self.seq), func, is_switch=is_switch)
+            self.push(job)
+            return job.future
+
+    def submit_status(self, machin_id=0):
+        with self.cond:
+            job = self.pending_status.get(machin_id)
+            if job is not None:
+                job.waiters += 1
+                self.coalesced += 1
+                return job.future
+
+            if self.kind == 'sp8h':
+                func = lambda dev: dev.get_status(machin_id)
+            else:
+                func = lambda dev: dev.get_status()
+            job = scheduled_job(PRIO_STATUS, next(self.seq), func)
+            job.key = machin_id
+            self.pending_status[machin_id] = job
+            self.push(job)
+            return job.future
+
+    def submit_switch(self, *args, **kwargs):
+        """
+        Queue a switch, same arguments as the switch() of the device.
+        """
+        if self.kind == 'aw2401':
+            return self.submit_port_mode(*args, **kwargs)
+        return self.submit(lambda dev: dev.switch(*args, **kwargs), PRIO_SWITCH, True)
+
+    def submit_port_mode(self, pwr_list, action=1):
+        return self.submit_modes(dict((pid, action) for pid in pwr_list))
+
+    def submit_modes(self, modes):
+        """
+        Queue an AW-2401 {power_id: action} change, merged with the one already queued.
+        """
+        with self.cond:
+            job = self.pending_modes
+            if job is not None:
+                job.modes.update(modes)
+                job.waiters += 1
+                self.merged += 1
+                return job.future
+
+            job = scheduled_job(PRIO_SWITCH, next(self.seq), None, time.monotonic() + self.merge_window, True)
+            job.modes = dict(modes)
+            job.func = lambda dev: dev.set_port_mode(job.modes)
+            self.pending_modes = job
+            self.push(job)
+            return job.future
+
+    def switch(self, *args, **kwargs):
+        return self.submit_switch(*args, **kwargs).result()
+
+    def set_port_mode(self, modes):
+        return self.submit_modes(modes).result()
+
+    def get_status(self, machin_id=0):
+        return self.submit_status(machin_id).result()
+
+    def get_status_all(self, machin_ids):
+        return self.submit(lambda dev: dev.get_status_all(machin_ids), PRIO_STATUS).result()
+
+    def read_status(self, machin_id):
+        return self.submit(lambda dev: dev.read_status(machin_id), PRIO_STATUS).result()
+
+    def login(self):
+        return self.submit(lambda dev: dev.login()).result()
+
+    def logout(self):
+        # Behind the requests queued before it.
+        return self.submit(lambda dev: dev.logout(), PRIO_STATUS).result()
+
+    def ready_at(self, job):
+        when = max(job.not_before, self.last_request + self.spacing)
+        if job.is_switch:
+            when = max(when, self.last_switch + self.switch_spacing)
+        return when
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.queue:
+                        self.worker = None
+                        return
+                    # A job queued while waiting may be more urgent, so look again after every wait.
+                    job = self.queue[0]
+                    delay = self.ready_at(job) - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+
+                heapq.heappop(self.queue)
+                if self.pending_status.get(job.key) is job:
+                    del self.pending_status[job.key]
+                if self.pending_modes is job:
+                    self.pending_modes = None
+
+            try:
+                result = self.execute(job.func, not job.is_switch)
+            except Exception as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+
+            with self.cond:
+                self.requests += 1
+                self.last_request = time.monotonic()
+                if job.is_switch:
+                    self.last_switch = self.last_request
+
+    def close(self):
+        """
+        Refuse new requests and wait until the queued ones are sent.
+        """
+        with self.cond:
+            self.closed = True
+            worker = self.worker
+        if worker is not None and worker is not threading.current_thread():
+            worker.join()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import time
+
+# The SP8H needs its switch requests at least 700ms apart, like the CLI --interval.
+MIN_GAP = 0.7
+
+class port_start:
+    """
+    The outcome of powering on one SP8H port.
+    state is 'pending', 'settling', 'on', 'skipped' (does not fit the budget) or 'failed'.
+    """
+
+    def __init__(self, machine_id, power_id):
+        self.machine_id = machine_id
+        self.power_id = power_id
+        self.state = 'pending'
+        self.sent_at = None
+        self.elapsed = None
+        self.ampere = None
+        self.peak = 0.0
+        self.last_reading = None
+
+    def __repr__(self):
+        return 'port_start(machine_id={}, power_id={}, state={}, ampere={}, peak={})'.format(
+            self.machine_id, self.power_id, self.state, self.ampere, self.peak)
+
+class sp8h_sequencer:
+    """
+    Power on SP8H ports in batches, as fast as a current budget allows.
+
+    Before each batch the status of the machine is read, and only as many ports
+    as fit the headroom of the machine and of the whole device are switched on.
+    A port is counted at inrush times its expected load until its ampere reading
+    stops changing, the next batch of a machine waits for that.
+    The expected load is port_load, or the largest load seen on the device so far
+    if that is more. Two switch requests are at least gap seconds apart, never less
+    than MIN_GAP.
+    on_result, if set, is called with each port_start once it is on, failed or skipped.
+    """
+
+    def __init__(self, dev, machine_budget=10.0, device_budget=None, port_load=1.0, inrush=3.0,
+                 gap=MIN_GAP, poll_interval=0.2, settle_timeout=5.0, tolerance=0.05):
+        self.dev = dev
+        self.machine_budget = machine_budget
+        self.device_budget = device_budget
+        self.port_load = port_load
+        self.inrush = inrush
+        self.gap = max(gap, MIN_GAP)
+        self.poll_interval = poll_interval
+        self.settle_timeout = settle_timeout
+        self.tolerance = tolerance
+        self.last_request = 0.0
+        self.last_switch = 0.0
+        self.current = {}
+        self.on_result = None
+
+    def report(self, results, reported):
+        emit = getattr(self.dev, 'emit', None)
+        for r in results:
+            if r.state not in ('pending', 'settling') and r not in reported:
+                reported.add(r)
+                if emit is not None and r.sent_at is not None:
+                    emit("port_verify", "switch", machine=r.machine_id, port=r.power_id, action='on', attempt=1,
+                         ok=r.state == 'on', elapsed=r.elapsed)
+                if self.on_result is not None:
+                    self.on_result(r)
+
+    def wait_until(self, when):
+        delay = when - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def expected_load(self, results):
+        seen = [r.ampere for r in results if r.state == 'on' and r.ampere is not None]
+        return max([self.port_load] + seen)
+
+    def read(self, machine_id, ports):
+        """
+        Read the status of one machine, update its ports and return the machine current.
+        """
+        self.wait_until(self.last_request + self.poll_interval)
+        status_data = self.dev.get_status(machine_id)
+        now = self.last_request = time.monotonic()
+
+        total = 0.0
+        for (state, ampere) in status_data:
+            total += float(ampere) if ampere is not None else 0.0
+
+        for r in ports:
+            if r.power_id > len(status_data):
+                r.state = 'failed'
+                continue
+            (state, ampere) = status_data[r.power_id - 1]
+            reading = float(ampere) if ampere is not None else None
+
+            if r.state == 'pending' and state == '1':
+                # Already on, nothing to switch.
+                r.state = 'on'
+                r.ampere = reading
+            elif r.state == 'settling':
+                if reading is not None:
+                    r.peak = max(r.peak, reading)
+                if state == '1':
+                    stable = reading is None or (r.last_reading is not None and
+                             abs(reading - r.last_reading) <= max(self.tolerance, self.tolerance * reading))
+                    if stable:
+                        r.state = 'on'
+                        r.ampere = reading
+                        r.elapsed = now - r.sent_at
+                if r.state == 'settling' and now - r.sent_at > self.settle_timeout:
+                    r.state = 'on' if state == '1' else 'failed'
+                    r.ampere = reading
+                    r.elapsed = now - r.sent_at
+                r.last_reading = reading
+
+        return total
+
+    def reserve(self, ports, load):
+        """
+        Current of switched ports the reading does not show yet.
+        """
+        reserve = 0.0
+        for r in ports:
+            if r.state == 'settling':
+                reserve += max(0.0, self.inrush * load - (r.last_reading or 0.0))
+        return reserve
+
+    def run(self, ports):
+        """
+        Power on ports, a dict {machine_id: [power_id, ...]}, and return a port_start per port.
+        """
+        machines = {mid: [port_start(mid, pid) for pid in pids] for (mid, pids) in ports.items()}
+        results = [r for mid in sorted(machines) for r in machines[mid]]
+        reported = set()
+
+        while any(r.state in ('pending', 'settling') for r in results):
+            for mid in sorted(machines):
+                if any(r.state in ('pending', 'settling') for r in machines[mid]):
+                    self.current[mid] = self.read(mid, machines[mid])
+            self.report(results, reported)
+
+            load = self.expected_load(results)
+            cost = self.inrush * load
+            device_used = sum(self.current.values()) + self.reserve(results, load)
+            progress = any(r.state == 'settling' for r in results)
+
+            for mid in sorted(machines):
+                if any(r.state == 'settling' for r in machines[mid]):
+                    continue
+                pending = [r for r in machines[mid] if r.state == 'pending']
+                machine_used = self.current.get(mid, 0.0)
+
+                batch = []
+                for r in pending:
+                    if machine_used + cost > self.machine_budget:
+                        break
+                    if self.device_budget is not None and device_used + cost > self.device_budget:
+                        break
+                    batch.append(r)
+                    machine_used += cost
+                    device_used += cost
+
+                if not batch and pending and not progress:
+                    # Nothing is settling, so the headroom will not grow any more.
+                    pending[0].state = 'skipped'
+                    progress = True
+
+                for r in batch:
+                    self.wait_until(self.last_switch + self.gap)
+                    self.dev.switch(mid, r.power_id, self.dev.POWER_ON)
+                    r.sent_at = self.last_request = self.last_switch = time.monotonic()
+                    r.state = 'settling'
+                    progress = True
+
+        self.report(results, reported)
+        return results
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+import argparse
+import http.server
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+from http import cookies
+
+class sim_config:
+    """
+    Behavior of a simulated device.
+    Times are in seconds, rates are probabilities per request.
+    """
+
+    def __init__(self, **kwargs):
+        self.latency = 0.0
+        self.settle_delay = 0.5
+        self.reset_time = 1.0
+        self.session_timeout = 300.0
+        self.max_login_users = 4
+        self.user = "admin"
+        self.passwd = "admin"
+        self.machines = 4
+        self.ports = 8
+        self.load = (0.1, 1.5)
+        self.inrush = 1.0
+        self.inrush_time = 0.3
+        self.drop_rate = 0.0
+        self.stale_rate = 0.0
+        self.stuck_ports = ()
+        self.ignore_reset = False
+        self.seed = None
+
+        for (k, v) in kwargs.items():
+            if not hasattr(self, k):
+                raise TypeError("unknown simulator option: {}".format(k))
+            setattr(self, k, v)
+
+class sim_port:
+    """
+    One simulated power port. A switch only shows up in the status after settle_delay.
+    Right after power on the port draws inrush times its load, decaying to the load
+    over inrush_time.
+    """
+
+    def __init__(self, load, inrush=1.0, inrush_time=0.0):
+        self.state = '0'
+        self.load = load
+        self.inrush = inrush
+        self.inrush_time = inrush_time
+        self.on_at = 0.0
+        self.changes = []
+
+    def set(self, state, when):
+        # A new command overrides changes still pending after it.
+        self.changes = [c for c in self.changes if c[0] <= when]
+        self.changes.append((when, state))
+
+    def update(self, now):
+        while self.changes and self.changes[0][0] <= now:
+            (when, state) = self.changes.pop(0)
+            if state == '1' and self.state != '1':
+                self.on_at = when
+            self.state = state
+
+    def ampere(self, now=None):
+        if self.state != '1':
+            return '0.00'
+        since = (time.monotonic() if now is None else now) - self.on_at
+        if since < self.inrush_time:
+            return '{:.2f}'.format(self.load * (1 + (self.inrush - 1) * (1 - since / self.inrush_time)))
+        return '{:.2f}'.format(self.load)
+
+class sim_sp8h:
+    """
+    State of a simulated Smart Power 8H: sessions and machines of power ports.
+    """
+
+    kind = "sp8h"
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.rand = random.Random(config.seed)
+        self.machines = {mid: [sim_port(self.rand.uniform(*config.load), config.inrush, config.inrush_time) for pid in range(config.ports)]
+                         for mid in range(1, config.machines + 1)}
+        self.stale = {}
+        self.sessions = {}
+        self.requests = 0
+        self.logins = 0
+
+    def expire_sessions(self, now):
+        for (sid, last_seen) in list(self.sessions.items()):
+            if now - last_seen > self.config.session_timeout:
+                del self.sessions[sid]
+
+    def login(self, params):
+        with self.lock:
+            now = time.monotonic()
+            self.expire_sessions(now)
+            if params.get('auth_user') != self.config.user or params.get('auth_passwd') != self.config.passwd:
+                return b'1', None
+            if len(self.sessions) >= self.config.max_login_users:
+                return b'2', None
+            sid = '{:016x}'.format(self.rand.getrandbits(64))
+            self.sessions[sid] = now
+            self.logins += 1
+            return b'0', 'sessionid={}; path=/'.format(sid)
+
+    def logout(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+        return b''
+
+    def touch(self, sid):
+        now = time.monotonic()
+        self.expire_sessions(now)
+        if sid not in self.sessions:
+            return False
+        self.sessions[sid] = now
+        return True
+
+    def status_frame(self, mid):
+        ports = self.machines[mid]
+        frame = [["Port{}".format(i) for i in range(1, len(ports) + 1)],
+                 [p.state for p in ports],
+                 [p.ampere() for p in ports]]
+        return ('[' + ','.join('[' + ','.join("'{}'".format(v) for v in row) + ']' for row in frame) + ']').encode("utf-8")
+
+    def power_monitor(self, sid, params):
+        with self.lock:
+            if not self.touch(sid):
+                return b'TimeOut'
+
+            try:
+                mid = int(params.get('srm_no', 0))
+            except ValueError:
+                mid = 0
+            if mid not in self.machines:
+                return b''
+
+            now = time.monotonic()
+            for p in self.machines[mid]:
+                p.update(now)
+
+            if 'status' in params:
+                try:
+                    pid = int(params.get('power_id', 0))
+                    action = int(params['status'])
+                except ValueError:
+                    return b''
+                if 1 <= pid <= len(self.machines[mid]) and pid not in self.config.stuck_ports and \
+                   not (action == 3 and self.config.ignore_reset):
+                    # Keep what the status read before, so stale reads can return it.
+                    self.stale[mid] = self.status_frame(mid)
+                    port = self.machines[mid][pid - 1]
+                    if action == 1:
+                        port.set('1', now + self.config.settle_delay)
+                    elif action == 2:
+                        port.set('0', now + self.config.settle_delay)
+                    elif action == 3:
+                        port.set('0', now + self.config.settle_delay)
+                        port.set('1', now + self.config.settle_delay + self.config.reset_time)
+
+            if mid in self.stale and self.rand.random() < self.config.stale_rate:
+                return self.stale[mid]
+            return self.status_frame(mid)
+
+class sim_aw2401:
+    """
+    State of a simulated Cloud AW-2401 with four ports and no login.
+    """
+
+    kind = "aw2401"
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.rand = random.Random(config.seed)
+        self.ports = [sim_port(self.rand.uniform(*config.load)) for pid in range(4)]
+        self.stale = None
+        self.requests = 0
+
+    def status_page(self):
+        rows = ''.join('<tr><td>Port{0}</td><td><input type="text" name="port{0}" value="{1}" readonly></td></tr>'.format(
+            i, 'on' if p.state == '1' else 'off') for (i, p) in enumerate(self.ports, 1))
+        return '<html><body><table>{}</table></body></html>'.format(rows).encode("utf-8")
+
+    def get_port_mode(self):
+        with self.lock:
+            now = time.monotonic()
+            for p in self.ports:
+                p.update(now)
+            if self.stale is not None and self.rand.random() < self.config.stale_rate:
+                return self.stale
+            return self.status_page()
+
+    def set_port_mode(self, params):
+        with self.lock:
+            now = time.monotonic()
+            for p in self.ports:
+                p.update(now)
+            self.stale = self.status_page()
+            for (i, p) in enumerate(self.ports, 1):
+                if i in self.config.stuck_ports:
+                    continue
+                mode = params.get('portMode{}'.format(i), 'jj')
+                if mode == 'on':
+                    p.set('1', now + self.config.settle_delay)
+                elif mode == 'off':
+                    p.set('0', now + self.config.settle_delay)
+            return b'<html><body>OK</body></html>'
+
+class sim_handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the SP8H/AW-2401 web pages the drivers use.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def session_id(self):
+        c = cookies.SimpleCookie()
+        try:
+            c.load(self.headers.get('Cookie', ''))
+        except cookies.CookieError:
+            return None
+        return c['sessionid'].value if 'sessionid' in c else None
+
+    def reply(self, body, cookie=None):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        if cookie is not None:
+            self.send_header("Set-Cookie", cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        device = self.server.device
+        config = device.config
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode("utf-8") if length else ""
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+
+        with device.lock:
+            device.requests += 1
+            drop = device.rand.random() < config.drop_rate
+
+        if config.latency:
+            time.sleep(config.latency)
+
+        if drop:
+            # Drop the connection without an answer.
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+
+        if device.kind == "sp8h":
+            if url.path == "/login_auth.csp" and method == "POST":
+                data, cookie = device.login(dict(urllib.parse.parse_qsl(body)))
+                return self.reply(data, cookie)
+            if url.path == "/logout.csp":
+                return self.reply(device.logout(self.session_id()))
+            if url.path == "/power_monitor_frame.csp":
+                return self.reply(device.power_monitor(self.session_id(), params))
+        else:
+            if url.path == "/get_port_mode.html":
+                return self.reply(device.get_port_mode())
+            if url.path == "/set_port_mode.html":
+                return self.reply(device.set_port_mode(params))
+
+        self.send_error(404)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+class sim_server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class sim_device:
+    """
+    A simulated device listening on its own port.
+    """
+
+    def __init__(self, kind="sp8h", config=None, host="127.0.0.1", port=0, verbose=False):
+        config = config if config else sim_config()
+        self.state = sim_sp8h(config) if kind == "sp8h" else sim_aw2401(config)
+        self.server = sim_server((host, port), sim_handler)
+        self.server.device = self.state
+        self.server.verbose = verbose
+        self.host = host
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.2}, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class sim_fleet:
+    """
+    Many simulated devices of one kind, each on its own port.
+    With base_port 0 the ports are picked by the system.
+    """
+
+    def __init__(self, kind="sp8h", count=1, config=None, host="127.0.0.1", base_port=0, verbose=False):
+        self.devices = []
+        for i in range(count):
+            device_config = sim_config(**vars(config)) if config else sim_config()
+            if device_config.seed is not None:
+                device_config.seed += i
+            self.devices.append(sim_device(kind, device_config, host, base_port + i if base_port else 0, verbose))
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        for d in self.devices:
+            d.start()
+        return self
+
+    def stop(self):
+        # Each server takes up to a poll interval to notice, so stop them all at once.
+        threads = [threading.Thread(target=d.server.shutdown) for d in self.devices if d.thread is not None]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for d in self.devices:
+            d.server.server_close()
+
+    def addresses(self):
+        return [(d.host, d.port) for d in self.devices]
+
+def main():
+    """
+    Run simulated devices until Ctrl+C.
+    """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sp8h'            , type=int   , help="Number of SP8H devices", default=1)
+    parser.add_argument('--aw2401'          , type=int   , help="Number of AW2401 devices", default=0)
+    parser.add_argument('--host'            , type=str   , help="Listen address", default="127.0.0.1")
+    parser.add_argument('--base-port'       , type=int   , help="First listen port, 0 to pick free ports", default=8000)
+    parser.add_argument('--latency'         , type=int   , help="Response latency(ms)", default=0)
+    parser.add_argument('--settle-delay'    , type=int   , help="Time(ms) until a switch shows up in the status", default=500)
+    parser.add_argument('--reset-time'      , type=int   , help="Time(ms) a reset keeps the port off", default=1000)
+    parser.add_argument('--session-timeout' , type=int   , help="Idle time(s) until a session times out", default=300)
+    parser.add_argument('--max-login-users' , type=int   , help="Number of concurrent SP8H sessions", default=4)
+    parser.add_argument('--drop-rate'       , type=float , help="Probability to drop a connection", default=0.0)
+    parser.add_argument('--stale-rate'      , type=float , help="Probability to answer a stale status", default=0.0)
+    parser.add_argument('--inrush'          , type=float , help="Current of a port right after power on, times its load", default=1.0)
+    parser.add_argument('--inrush-time'     , type=int   , help="Time(ms) until the inrush current decayed", default=300)
+    parser.add_argument('--stuck-ports'     , type=int   , help="Power ids whose switches are ignored", nargs='+', default=[])
+    parser.add_argument('--ignore-reset'    , help="Ignore the SP8H reset action", action="store_true")
+    parser.add_argument('--seed'            , type=int   , help="Random seed")
+    parser.add_argument('--verbose'         , '-v', help="Log every request", action="store_true")
+    args = parser.parse_args()
+
+    config = sim_config(latency=args.latency/1000, settle_delay=args.settle_delay/1000, reset_time=args.reset_time/1000,
+                        session_timeout=args.session_timeout, max_login_users=args.max_login_users,
+                        drop_rate=args.drop_rate, stale_rate=args.stale_rate, seed=args.seed,
+                        inrush=args.inrush, inrush_time=args.inrush_time/1000,
+                        stuck_ports=tuple(args.stuck_ports), ignore_reset=args.ignore_reset)
+
+    fleets = [sim_fleet("sp8h", args.sp8h, config, args.host, args.base_port, args.verbose)]
+    base_port = args.base_port + args.sp8h if args.base_port else 0
+    fleets.append(sim_fleet("aw2401", args.aw2401, config, args.host, base_port, args.verbose))
+
+    for f in fleets:
+        f.start()
+        for d in f.devices:
+            sys.stdout.write('{} {}:{}\n'.format(d.state.kind, d.host, d.port))
+    sys.stdout.flush()
+
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    try:
+        signal.pause() if hasattr(signal, 'pause') else threading.Event().wait()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for f in fleets:
+            f.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+import math
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from power_ctrl import power_ctrl_error
+from power_ctrl_daemon import device_session
+
+NAN = float('nan')
+
+class ring_buffer:
+    """
+    Fixed memory history of the ports of one SP8H machine or AW-2401.
+    A sample is a time, a state byte (1 on, 0 off) and an ampere value per port,
+    kept in flat arrays of capacity samples; the oldest sample is overwritten
+    once it is full. Amperes are NaN for a device that does not report them.
+    """
+
+    def __init__(self, capacity, ports):
+        self.capacity = capacity
+        self.ports = ports
+        self.times = array('d', [0.0]) * capacity
+        self.states = bytearray(capacity * ports)
+        self.amperes = array('d', [NAN]) * (capacity * ports)
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        return self.times.itemsize * len(self.times) + len(self.states) + self.amperes.itemsize * len(self.amperes)
+
+    def append(self, when, status_data):
+        """
+        Store one get_status() result taken at when.
+        """
+        slot = (self.head + self.count) % self.capacity if self.count < self.capacity else self.head
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.head = (self.head + 1) % self.capacity
+
+        self.times[slot] = when
+        base = slot * self.ports
+        for i in range(self.ports):
+            if i < len(status_data):
+                (state, ampere) = status_data[i]
+                self.states[base + i] = 1 if state == '1' else 0
+                self.amperes[base + i] = float(ampere) if ampere is not None else NAN
+            else:
+                self.states[base + i] = 0
+                self.amperes[base + i] = NAN
+
+    def slot(self, i):
+        return (self.head + i) % self.capacity
+
+    def time_at(self, i):
+        return self.times[self.slot(i)]
+
+    def bisect(self, when):
+        """
+        Index of the first sample taken at or after when.
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time_at(mid) < when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def window(self, start=None, end=None):
+        """
+        Return the (first, last) sample index range taken in [start, end).
+        """
+        lo = 0 if start is None else self.bisect(start)
+        hi = self.count if end is None else self.bisect(end)
+        return lo, max(lo, hi)
+
+    def segments(self, lo, hi):
+        """
+        The slot ranges holding samples lo to hi, two of them if the window wraps around.
+        """
+        if lo >= hi:
+            return []
+        first = self.slot(lo)
+        last = first + (hi - lo)
+        if last <= self.capacity:
+            return [(first, last)]
+        return [(first, self.capacity), (0, last - self.capacity)]
+
+    def port_column(self, port, lo, hi):
+        """
+        The amperes of one port (0 based) in samples lo to hi, as an array.
+        """
+        column = array('d')
+        for (a, b) in self.segments(lo, hi):
+            column.extend(self.amperes[a * self.ports + port:b * self.ports:self.ports])
+        return column
+
+    def summary(self, start=None, end=None):
+        """
+        Return per port dicts of min/max/mean current and the share of samples it was on,
+        over the samples taken in [start, end). Uses numpy if it is installed.
+        """
+        lo, hi = self.window(start, end)
+        n = hi - lo
+        if n == 0:
+            return []
+
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        if numpy is not None:
+            amperes = numpy.concatenate([numpy.frombuffer(self.amperes, dtype=numpy.float64)[a * self.ports:b * self.ports]
+                                         for (a, b) in self.segments(lo, hi)]).reshape(n, self.ports)
+            states = numpy.concatenate([numpy.frombuffer(self.states, dtype=numpy.uint8)[a * self.ports:b * self.ports]
+                                        for (a, b) in self.segments(lo, hi)]).reshape(n, self.ports)
+            reported = not numpy.isnan(amperes).all()
+            mins, maxs, means = amperes.min(axis=0), amperes.max(axis=0), amperes.mean(axis=0)
+            on = states.mean(axis=0)
+            return [{'port': p + 1, 'samples': n, 'on': float(on[p]),
+                     'min': float(mins[p]) if reported else None,
+                     'max': float(maxs[p]) if reported else None,
+                     'mean': float(means[p]) if reported else None} for p in range(self.ports)]
+
+        result = []
+        for p in range(self.ports):
+            column = self.port_column(p, lo, hi)
+            on = sum(sum(self.states[a * self.ports + p:b * self.ports:self.ports]) for (a, b) in self.segments(lo, hi))
+            reported = not math.isnan(column[0])
+            result.append({'port': p + 1, 'samples': n, 'on': on / n,
+                           'min': min(column) if reported else None,
+                           'max': max(column) if reported else None,
+                           'mean': math.fsum(column) / n if reported else None})
+        return result
+
+    def rows(self, start=None, end=None):
+        """
+        Yield (time, port, state, ampere) per port and sample, oldest first.
+        """
+        lo, hi = self.window(start, end)
+        for (a, b) in self.segments(lo, hi):
+            for slot in range(a, b):
+                base = slot * self.ports
+                for p in range(self.ports):
+                    yield (self.times[slot], p + 1, self.states[base + p], self.amperes[base + p])
+
+    def export_npy(self, f, start=None, end=None):
+        """
+        Write the samples as a (samples, 1 + 2 * ports) float64 .npy matrix:
+        time, the port states, then the port amperes. numpy is not needed to write it.
+        """
+        lo, hi = self.window(start, end)
+        header = "{{'descr': '<f8', 'fortran_order': False, 'shape': ({}, {}), }}".format(hi - lo, 1 + 2 * self.ports)
+        # Magic, version 1.0 and the header length, the header padded so the data starts 64 byte aligned.
+        header += ' ' * (63 - (10 + len(header)) % 64) + '\n'
+        f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin-1'))
+
+        for (a, b) in self.segments(lo, hi):
+            for slot in range(a, b):
+                base = slot * self.ports
+                row = array('d', [self.times[slot]])
+                row.extend(self.states[base:base + self.ports])
+                row.extend(self.amperes[base:base + self.ports])
+                if sys.byteorder == 'big':
+                    row.byteswap()
+                f.write(row.tobytes())
+
+class telemetry_poller:
+    """
+    Sample the status of many devices every interval seconds into ring buffers.
+    Devices are configured like for the daemon, an SP8H entry can list the
+    machines to sample ("machines": [1, 2], default [1]). Devices are polled in
+    parallel on warm sessions, a failing device is counted and retried on the
+    next tick. A device whose circuit is open is skipped without waiting for it.
+    on_sample(name, machine_id, when, status_data, elapsed) and on_error(name, error),
+    if set, are called from the polling threads as each sample is taken or fails.
+    """
+
+    def __init__(self, devices, interval=10.0, capacity=8640, max_workers=16):
+        self.interval = interval
+        self.capacity = capacity
+        self.max_workers = max_workers
+        self.targets = []
+        for conf in devices:
+            s = device_session(conf)
+            machines = [int(m) for m in conf.get("machines", [1])] if s.kind == "sp8h" else [0]
+            self.targets.append((s, machines))
+        self.buffers = {}
+        self.errors = {}
+        self.last_error = {}
+        self.skipped = {}
+        self.ticks = 0
+        self.missed = 0
+        self.lock = threading.Lock()
+        self.on_sample = None
+        self.on_error = None
+
+    def buffer(self, name, machine_id, ports):
+        key = (name, machine_id)
+        with self.lock:
+            if key not in self.buffers:
+                self.buffers[key] = ring_buffer(self.capacity, ports)
+            return self.buffers[key]
+
+    def poll_device(self, target):
+        (s, machines) = target
+        if s.is_down():
+            with self.lock:
+                self.skipped[s.name] = self.skipped.get(s.name, 0) + 1
+            return
+        try:
+            for mid in machines:
+                start = time.monotonic()
+                status_data = s.get_status(mid)
+                when = time.time()
+                self.buffer(s.name, mid, len(status_data)).append(when, status_data)
+                if self.on_sample is not None:
+                    self.on_sample(s.name, mid, when, status_data, time.monotonic() - start)
+        except power_ctrl_error as e:
+            with self.lock:
+                self.errors[s.name] = self.errors.get(s.name, 0) + 1
+                self.last_error[s.name] = str(e)
+            if self.on_error is not None:
+                self.on_error(s.name, e)
+
+    def poll_once(self, pool=None):
+        """
+        Take one sample of every device.
+        """
+        if pool is None:
+            with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as pool:
+                return self.poll_once(pool)
+        list(pool.map(self.poll_device, self.targets))
+        self.ticks += 1
+
+    def run(self, duration=None, stop=None):
+        """
+        Poll until duration seconds passed or the stop event is set.
+        A tick that is late by more than an interval is skipped, not caught up.
+        """
+        stop = stop if stop is not None else threading.Event()
+        end = time.monotonic() + duration if duration is not None else None
+        next_tick = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as pool:
+            while not stop.is_set() and (end is None or time.monotonic() < end):
+                self.poll_once(pool)
+                next_tick += self.interval
+                late = time.monotonic() - next_tick
+                if late > 0:
+                    skipped = int(late // self.interval) + 1
+                    self.missed += skipped
+                    next_tick += skipped * self.interval
+                if end is not None and next_tick >= end:
+                    break
+                stop.wait(next_tick - time.monotonic())
+
+    def close(self):
+        for (s, machines) in self.targets:
+            if s.breaker is not None:
+                s.breaker.close()
+            with s.lock:
+                s.close()
+
+    def summary(self, start=None, end=None):
+        """
+        Return {(device, machine_id): per port summary} over [start, end).
+        """
+        return dict((key, buf.summary(start, end)) for (key, buf) in sorted(self.buffers.items()))
+
+    def export_csv(self, path, start=None, end=None):
+        with open(path, "w") as f:
+            f.write("time,device,machine,port,state,ampere\n")
+            for ((name, mid), buf) in sorted(self.buffers.items()):
+                for (when, port, state, ampere) in buf.rows(start, end):
+                    f.write("{:.3f},{},{},{},{},{}\n".format(when, name, mid, port, state, '' if math.isnan(ampere) else '{:.2f}'.format(ampere)))
+
+    def export_npy(self, directory, start=None, end=None):
+        """
+        Write one <device>_<machine>.npy per ring buffer, see ring_buffer.export_npy().
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for ((name, mid), buf) in sorted(self.buffers.items()):
+            path = os.path.join(directory, "{}_{}.npy".format(name.replace(':', '_').replace('/', '_'), mid))
+            with open(path, "wb") as f:
+                buf.export_npy(f, start, end)
+            paths.append(path)
+        return paths
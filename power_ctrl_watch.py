@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import threading
+import time
+from power_ctrl import power_ctrl_error
+
+class status_watcher:
+    """
+    Poll the status of one device on a warm session and report what changed.
+
+    The interval starts at min_interval, grows by backoff after every poll that
+    saw no change, up to max_interval, and drops back to min_interval after a
+    change or a poke(), so a switch shows up fast and a quiet device is read
+    rarely. A change is a port switching on or off, or its current moving more
+    than threshold amperes from the value last reported.
+    """
+
+    def __init__(self, session, machines, min_interval=0.5, max_interval=10.0, backoff=1.5, threshold=0.1):
+        self.session = session
+        self.machines = machines
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.threshold = threshold
+        self.interval = min_interval
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.last = {}
+        self.error = None
+        self.polls = 0
+        self.changes = 0
+
+    def poke(self):
+        """
+        Poll now and fast again, e.g. after switching a port of the device.
+        """
+        self.interval = self.min_interval
+        self.wake.set()
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+
+    def poll(self):
+        """
+        Read every machine once and return the changes as dicts with machine, port,
+        state, ampere and the previous state and ampere (None on the first poll).
+        """
+        changes = []
+        for mid in self.machines:
+            status_data = self.session.get_status(mid)
+            for (i, (state, ampere)) in enumerate(status_data, 1):
+                ampere = float(ampere) if ampere is not None else None
+                prev = self.last.get((mid, i))
+                if prev is not None and prev[0] == state and (ampere is None or prev[1] is None or abs(ampere - prev[1]) <= self.threshold):
+                    continue
+                changes.append({'machine': mid, 'port': i, 'state': state, 'ampere': ampere,
+                                'previous_state': prev[0] if prev else None, 'previous_ampere': prev[1] if prev else None})
+                self.last[(mid, i)] = (state, ampere)
+        self.polls += 1
+        return changes
+
+    def run(self, report, duration=None, on_error=None):
+        """
+        Poll until duration seconds passed or stop() is called, calling report(change)
+        for every change and on_error(error) when the device fails, None once it answers again.
+        """
+        end = time.monotonic() + duration if duration is not None else None
+        while not self.stopping.is_set() and (end is None or time.monotonic() < end):
+            try:
+                changes = self.poll()
+            except power_ctrl_error as e:
+                if self.error is None and on_error is not None:
+                    on_error(e)
+                self.error = e
+                self.interval = self.max_interval
+            else:
+                if self.error is not None and on_error is not None:
+                    on_error(None)
+                self.error = None
+                for change in changes:
+                    report(change)
+                self.changes += len(changes)
+                if changes:
+                    self.interval = self.min_interval
+                else:
+                    self.interval = min(self.interval * self.backoff, self.max_interval)
+
+            delay = self.interval if end is None else min(self.interval, end - time.monotonic())
+            self.wake.wait(max(0.0, delay))
+            self.wake.clear()
@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from power_ctrl import aw2401
+from power_ctrl import sp8h
+from power_ctrl_sim import sim_config
+from power_ctrl_sim import sim_fleet
+
+# Short device times, so a switch or reset shows up within a fraction of a second.
+FAST = {'settle_delay': 0.05, 'reset_time': 0.3, 'inrush_time': 0.05, 'seed': 1}
+
+@pytest.fixture
+def sim():
+    """
+    Start simulated devices with sim(kind, count, **sim_config options), stopped after the test.
+    """
+    fleets = []
+
+    def start(kind='sp8h', count=1, **config):
+        fleet = sim_fleet(kind, count, sim_config(**dict(FAST, **config))).start()
+        fleets.append(fleet)
+        return fleet
+
+    yield start
+    for fleet in fleets:
+        fleet.stop()
+
+def device_conf(device, name=None, **fields):
+    """
+    A device entry of a state, reset or daemon file for a simulated device.
+    """
+    conf = {'name': name or '{}:{}'.format(device.host, device.port), 'type': device.state.kind,
+            'ip': device.host, 'port': device.port}
+    conf.update(fields)
+    return conf
+
+def open_device(device):
+    """
+    A connected (and for an SP8H logged in) driver for a simulated device.
+    """
+    if device.state.kind == 'sp8h':
+        dev = sp8h()
+        dev.user = dev.passwd = 'admin'
+    else:
+        dev = aw2401()
+    dev.target_url = device.host
+    dev.port = device.port
+    dev.connect()
+    if device.state.kind == 'sp8h':
+        dev.login()
+    return dev
+
+def set_ports(device, machine_id, power_ids, state):
+    """
+    Set simulated ports on ('1') or off ('0') at once, behind the device's back.
+    """
+    if device.state.kind == 'sp8h':
+        ports = device.state.machines[machine_id]
+    else:
+        ports = device.state.ports
+    for pid in power_ids:
+        ports[pid - 1].state = state
@@ -0,0 +1,57 @@
+from conftest import device_conf
+from conftest import open_device
+from conftest import set_ports
+from power_ctrl_apply import plan_fleet
+
+def state_of(*devices):
+    return {'devices': list(devices)}
+
+def test_apply_switches_only_what_differs(sim):
+    fleet = sim('sp8h', 2)
+    set_ports(fleet.devices[0], 1, [2], '1')
+    state = state_of(*[device_conf(d, machines={'1': {'1': 'on', '2': 'on', '3': 'off'}}) for d in fleet.devices])
+
+    plans = plan_fleet(state, interval=0.05, poll_interval=0.05, deadline=2.0)
+
+    assert [p.error for p in plans] == [None, None]
+    assert [p.checked for p in plans] == [3, 3]
+    assert sorted((c.machine_id, c.power_id) for c in plans[0].changes) == [(1, 1)]
+    assert sorted((c.machine_id, c.power_id) for c in plans[1].changes) == [(1, 1), (1, 2)]
+    assert all(c.done for p in plans for c in p.changes)
+    for d in fleet.devices:
+        dev = open_device(d)
+        assert [s[0] for s in dev.get_status(1)[:3]] == ['1', '1', '0']
+        dev.logout()
+
+    # Nothing left to switch the second time.
+    plans = plan_fleet(state, interval=0.05, poll_interval=0.05, deadline=2.0)
+    assert [p.changes for p in plans] == [[], []]
+
+def test_dry_run_switches_nothing(sim):
+    device = sim('aw2401').devices[0]
+    reported = []
+
+    (plan,) = plan_fleet(state_of(device_conf(device, ports={'1': 'on', '4': 'off'})), dry_run=True,
+                         on_change=lambda plan, c: reported.append(c.power_id))
+
+    assert plan.error is None
+    assert reported == [1]
+    assert [p.state for p in device.state.ports] == ['0', '0', '0', '0']
+
+def test_aw2401_apply(sim):
+    device = sim('aw2401').devices[0]
+
+    (plan,) = plan_fleet(state_of(device_conf(device, ports={'1': 'on', '3': 'on'})), poll_interval=0.05, deadline=2.0)
+
+    assert plan.error is None
+    assert all(c.done for c in plan.changes)
+    assert [s[0] for s in open_device(device).get_status()] == ['1', '0', '1', '0']
+
+def test_unreachable_device_does_not_stop_the_others(sim):
+    device = sim('sp8h').devices[0]
+    dead = {'name': 'dead', 'type': 'sp8h', 'ip': '127.0.0.1', 'port': 1, 'machines': {'1': {'1': 'on'}}}
+
+    plans = plan_fleet(state_of(dead, device_conf(device, machines={'1': {'1': 'on'}})), interval=0.05, poll_interval=0.05)
+
+    assert plans[0].error is not None
+    assert plans[1].error is None and plans[1].changes[0].done
@@ -0,0 +1,15 @@
+from power_ctrl_async import async_aw2401
+from power_ctrl_async import aw2401_status_op
+from power_ctrl_async import fleet
+
+def test_fleet_keeps_the_other_results_when_one_device_raises(sim):
+    device = sim('aw2401').devices[0]
+
+    async def broken(dev):
+        raise ValueError('unexpected page')
+
+    results = fleet().run([(async_aw2401(device.host, device.port), broken),
+                           (async_aw2401(device.host, device.port), aw2401_status_op())])
+
+    assert results[0].error == 'ValueError: unexpected page'
+    assert results[1].ok and len(results[1].value) == 4
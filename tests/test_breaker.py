@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from conftest import device_conf
+from power_ctrl import circuit_breaker
+from power_ctrl import circuit_open_error
+from power_ctrl import connection_error
+from power_ctrl import device_health
+from power_ctrl_daemon import device_session
+from power_ctrl_sim import sim_device
+
+def wait_for(cond, timeout=3.0):
+    end = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < end
+        time.sleep(0.02)
+
+def test_opens_after_threshold_and_closes_on_a_probe():
+    health = device_health()
+    probe_ok = []
+
+    def probe():
+        if not probe_ok:
+            raise connection_error("refused")
+
+    breaker = circuit_breaker(health, probe, threshold=3, backoff=0.05, max_backoff=0.1)
+    for i in range(3):
+        breaker.check('dev')
+        health.failure(connection_error("refused"))
+        breaker.update()
+    assert breaker.state() == 'open' and breaker.trips == 1
+    with pytest.raises(circuit_open_error):
+        breaker.check('dev')
+
+    wait_for(lambda: breaker.probes >= 2)
+    assert breaker.is_open()
+    probe_ok.append(True)
+    wait_for(lambda: not breaker.is_open())
+    breaker.check('dev')
+    assert health.consecutive_failures == 0
+    breaker.close()
+
+def test_session_fails_fast_while_the_device_is_down(sim):
+    device = sim('aw2401').devices[0]
+    session = device_session(device_conf(device, breaker_threshold=2, breaker_backoff=0.05,
+                                         breaker_max_backoff=0.1, connect_timeout=0.5))
+    assert len(session.get_status(0)) == 4
+
+    # Stopped, the device refuses new connections; the open one would still be served.
+    device.stop()
+    with session.lock:
+        session.close()
+    for i in range(2):
+        if session.is_down():
+            break
+        with pytest.raises(connection_error):
+            session.get_status(0)
+    assert session.is_down()
+    start = time.monotonic()
+    with pytest.raises(circuit_open_error):
+        session.get_status(0)
+    assert time.monotonic() - start < 0.1
+
+    # Back on the same port, the next probe closes the circuit.
+    device = sim_device('aw2401', device.state.config, port=device.port).start()
+    try:
+        wait_for(lambda: not session.is_down())
+        assert len(session.get_status(0)) == 4
+    finally:
+        session.scheduler.close()
+        session.breaker.close()
+        device.stop()
@@ -0,0 +1,9 @@
+from power_ctrl_cli import selected_command
+
+def test_selected_command_skips_global_option_values():
+    assert selected_command(['--journal', 'watch', 'sp8h', '-i', '10.0.0.1', '-m', '1']) == 'sp8h'
+    assert selected_command(['--format', 'jsonl', '--timings', 'reset', '-f', 'reset.json']) == 'reset'
+    assert selected_command(['apply', '-f', 'watch']) == 'apply'
+    assert selected_command(['-h']) is None
+    assert selected_command(['--format', 'xml', 'sp8h']) is None
+    assert selected_command(['nothing']) is None
@@ -0,0 +1,62 @@
+import time
+
+from conftest import open_device
+from conftest import set_ports
+from power_ctrl_converge import sp8h_converger
+
+def test_switch_on_converges(sim):
+    device = sim('sp8h').devices[0]
+    dev = open_device(device)
+    converger = sp8h_converger(dev, interval=0.05, poll_interval=0.05, deadline=2.0, settle=0.05)
+
+    results = converger.run(1, [1, 2], dev.POWER_ON)
+
+    assert [r.converged for r in results] == [True, True]
+    assert all(r.elapsed >= 0.05 for r in results)
+    assert [s[0] for s in dev.get_status(1)[:2]] == ['1', '1']
+    dev.logout()
+
+def test_reset_waits_for_the_off_phase(sim):
+    device = sim('sp8h').devices[0]
+    set_ports(device, 1, [1], '1')
+    dev = open_device(device)
+    converger = sp8h_converger(dev, interval=0.05, poll_interval=0.05, deadline=2.0, settle=0.05)
+
+    (r,) = converger.run(1, [1], dev.POWER_RST)
+
+    # An already on port must not count as reset before the device cycled it.
+    assert r.converged
+    assert r.off_after is not None
+    assert r.elapsed >= 0.05 + 0.3
+    dev.logout()
+
+def test_ignored_reset_does_not_converge(sim):
+    device = sim('sp8h', ignore_reset=True).devices[0]
+    set_ports(device, 1, [1], '1')
+    dev = open_device(device)
+    converger = sp8h_converger(dev, interval=0.05, poll_interval=0.05, deadline=0.5, settle=0.05)
+
+    start = time.monotonic()
+    (r,) = converger.run(1, [1], dev.POWER_RST, retry=1)
+
+    # Never seen off: unverified, and not reset a second time.
+    assert not r.converged
+    assert r.unverified
+    assert r.off_after is None
+    assert r.attempts == 1
+    assert time.monotonic() - start >= 0.5
+    dev.logout()
+
+def test_reset_of_several_ports_with_the_default_settle(sim):
+    device = sim('sp8h').devices[0]
+    set_ports(device, 1, [1, 2, 3, 4], '1')
+    dev = open_device(device)
+    # The sp8h command's defaults, the device is off for 0.3s only.
+    converger = sp8h_converger(dev, interval=0.7, poll_interval=0.2, deadline=5.0)
+
+    results = converger.run(1, [1, 2, 3, 4], dev.POWER_RST, retry=1)
+
+    assert [r.converged for r in results] == [True] * 4
+    assert [r.attempts for r in results] == [1] * 4
+    assert all(r.off_after is not None for r in results)
+    dev.logout()
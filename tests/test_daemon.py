@@ -0,0 +1,70 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from conftest import device_conf
+from power_ctrl import power_ctrl_error
+from power_ctrl_daemon import daemon_aw2401
+from power_ctrl_daemon import daemon_client
+from power_ctrl_daemon import daemon_sp8h
+from power_ctrl_daemon import power_ctrl_daemon
+
+@pytest.fixture
+def daemon(sim, tmp_path):
+    """
+    A daemon serving a simulated SP8H "rack1" and AW-2401 "lab", stopped after the test.
+    """
+    rack = sim('sp8h').devices[0]
+    lab = sim('aw2401').devices[0]
+    path = str(tmp_path / 'daemon.sock')
+    d = power_ctrl_daemon({'socket': path, 'devices': [device_conf(rack, 'rack1'), device_conf(lab, 'lab')]})
+    thread = threading.Thread(target=d.serve_forever, daemon=True)
+    thread.start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    yield d
+    d.stopping.set()
+    # Wake the accept() up.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+    thread.join(5)
+
+def wait_for(predicate, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < end
+        time.sleep(0.02)
+
+def test_switch_and_status_round_trip(daemon):
+    client = daemon_client(daemon.socket_path)
+    assert client.request(op='ping')['ok']
+    assert client.request(op='devices')['devices'] == [{'name': 'lab', 'type': 'aw2401'}, {'name': 'rack1', 'type': 'sp8h'}]
+
+    rack = daemon_sp8h(client, 'rack1')
+    rack.switch(1, 2, rack.POWER_ON)
+    wait_for(lambda: [s[0] for s in rack.get_status(1)[:3]] == ['0', '1', '0'])
+    lab = daemon_aw2401(client, 'lab')
+    lab.switch([1, 4], lab.POWER_ON)
+    wait_for(lambda: [s[0] for s in lab.get_status()] == ['1', '0', '0', '1'])
+
+    stats = client.request(op='stats')['schedulers']
+    assert stats['rack1']['requests'] >= 2 and stats['lab']['requests'] >= 2
+    client.close()
+
+def test_errors_are_replies_not_disconnects(daemon):
+    client = daemon_client(daemon.socket_path)
+    with pytest.raises(power_ctrl_error, match='Unknown device'):
+        client.request(op='status', device='nowhere')
+    with pytest.raises(power_ctrl_error, match='Bad request'):
+        client.request(op='switch', device='rack1')
+    # The same connection still works.
+    assert client.request(op='ping')['ok']
+    client.close()
+
+def test_second_daemon_on_the_socket_is_refused(daemon):
+    with pytest.raises(power_ctrl_error, match='another daemon'):
+        power_ctrl_daemon({'socket': daemon.socket_path}).serve_forever()
+    assert daemon_client(daemon.socket_path).request(op='ping')['ok']
@@ -0,0 +1,85 @@
+import socket
+import threading
+
+import pytest
+
+from conftest import open_device
+from power_ctrl import aw2401
+from power_ctrl import connection_error
+from power_ctrl import timeout_error
+
+def aw2401_at(host, port, read_timeout=10):
+    dev = aw2401()
+    dev.target_url = host
+    dev.port = port
+    dev.connect_timeout = 1
+    dev.read_timeout = read_timeout
+    dev.connect()
+    return dev
+
+def serve(handle):
+    """
+    A TCP server handling every connection with handle(conn), returns its port.
+    """
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(8)
+
+    def run():
+        while True:
+            conn, addr = server.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=run, daemon=True).start()
+    return server.getsockname()[1]
+
+def test_unreachable_device_is_a_connection_error():
+    dev = aw2401_at('127.0.0.1', 1)
+    with pytest.raises(connection_error) as e:
+        dev.get_status()
+    assert not isinstance(e.value, timeout_error)
+    assert dev.health.failures == 1
+
+def test_no_reply_is_a_timeout_error():
+    port = serve(lambda conn: conn.recv(4096))
+    dev = aw2401_at('127.0.0.1', port, read_timeout=0.2)
+    with pytest.raises(timeout_error):
+        dev.get_status()
+
+def test_idle_connection_closed_by_the_device_is_opened_again():
+    requests = []
+
+    def answer_once(conn):
+        requests.append(conn.recv(4096))
+        conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nOK')
+        # Like a device ending an idle keep-alive connection.
+        conn.close()
+
+    dev = aw2401_at('127.0.0.1', serve(answer_once))
+    reconnects = []
+    dev.hooks = [lambda e: reconnects.append(e['op']) if e['event'] == 'reconnect' else None]
+    dev.switch([1], dev.POWER_ON)
+    dev.switch([2], dev.POWER_ON)
+
+    assert len(requests) == 2
+    assert reconnects == ['switch']
+
+def test_switch_dropped_after_it_was_written_is_not_sent_again(sim):
+    device = sim('aw2401').devices[0]
+    dev = open_device(device)
+    dev.get_status()
+    device.state.config.drop_rate = 1.0
+    before = device.state.requests
+
+    with pytest.raises(connection_error):
+        dev.switch([1], dev.POWER_ON)
+    assert device.state.requests - before == 1
+
+    # A status read on a kept-alive connection is sent once more.
+    device.state.config.drop_rate = 0.0
+    dev.get_status()
+    device.state.config.drop_rate = 1.0
+    before = device.state.requests
+    with pytest.raises(connection_error):
+        dev.get_status()
+    assert device.state.requests - before == 2
@@ -0,0 +1,37 @@
+import pytest
+
+import power_ctrl_journal
+from power_ctrl_journal import operation_journal
+
+def test_journal_source_ids_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(power_ctrl_journal, 'MAX_SOURCES', 3)
+    journal = operation_journal(str(tmp_path / 'journal'), 'a')
+    journal.append('rack1', 1, 1, 'switch', 'on', 'sent')
+    journal.source = 'b'
+    journal.append('rack1', 1, 1, 'switch', 'on', 'sent')
+
+    journal.source = 'c'
+    with pytest.raises(ValueError):
+        journal.append('rack1', 1, 1, 'switch', 'on', 'sent')
+    # As a hook it must never stop the switching.
+    journal({'event': 'port_switch', 'device': 'rack1', 'machine': 1, 'ports': [1], 'action': 'on', 'error': None})
+    assert journal.errors == 1
+    assert len(journal) == 2
+    journal.close()
+
+def test_journal_queries(tmp_path):
+    journal = operation_journal(str(tmp_path / 'journal'), 'cli')
+    for i in range(10):
+        journal.append('rack{}'.format(i % 2), 1, i % 3 + 1, 'switch', 'on', 'sent', when=1000.0 + i)
+    journal.append('rack0', 1, 3, 'verify', 'on', 'confirmed', elapsed=0.8, when=1010.0)
+
+    entries = journal.query('rack0', 1, 3)
+    assert [e.time for e in entries] == [1002.0, 1008.0, 1010.0]
+    assert [e.result for e in entries] == ['sent', 'sent', 'confirmed']
+    assert entries[-1].as_dict()['elapsed'] == pytest.approx(0.8)
+    assert [e.time for e in journal.query(start=1003.0, end=1006.0)] == [1003.0, 1004.0, 1005.0]
+    assert [e.time for e in journal.query('rack1', limit=2)] == [1007.0, 1009.0]
+    assert journal.query('rack9') == []
+    with pytest.raises(ValueError):
+        journal.query(port=3)
+    journal.close()
@@ -0,0 +1,54 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+from power_ctrl_cli import jsonl_writer
+
+CLI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'power_ctrl_cli.py')
+
+def run_cli(device, *args):
+    """
+    Run the CLI with --format jsonl against a simulated device, returns its records.
+    """
+    out = subprocess.run([sys.executable, CLI, '--format', 'jsonl', device.state.kind, '-i', device.host,
+                          '--port', str(device.port)] + list(args), stdout=subprocess.PIPE, check=True).stdout
+    return [json.loads(line) for line in out.decode().splitlines()]
+
+def test_writer_writes_one_object_per_line():
+    out = io.StringIO()
+    records = jsonl_writer(out)
+
+    records('status', device='rack1', port=1, state='on')
+    records('error', message='timed out')
+
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 2
+    first = json.loads(lines[0])
+    assert first['event'] == 'status' and first['device'] == 'rack1' and first['state'] == 'on'
+    assert abs(first['time'] - time.time()) < 5
+    assert json.loads(lines[1])['message'] == 'timed out'
+
+def test_aw2401_switch_and_status_records(sim):
+    device = sim('aw2401').devices[0]
+    name = '{}:{}'.format(device.host, device.port)
+
+    switched = run_cli(device, '-p', '1', '2', '-s', 'on')
+    time.sleep(0.1)
+    status = run_cli(device, '-g')
+
+    assert [(r['event'], r['device'], r['port'], r['action'], r['ok']) for r in switched] == \
+           [('switch', name, 1, 'on', True), ('switch', name, 2, 'on', True)]
+    assert [(r['event'], r['machine'], r['port'], r['state']) for r in status] == \
+           [('status', 0, 1, 'on'), ('status', 0, 2, 'on'), ('status', 0, 3, 'off'), ('status', 0, 4, 'off')]
+    assert all(r['retries'] == 0 for r in status)
+
+def test_sp8h_switch_records_are_verified(sim):
+    device = sim('sp8h').devices[0]
+
+    records = run_cli(device, '-m', '1', '-p', '1', '2', '-s', 'on', '-t', '1', '--poll-interval', '50')
+
+    assert [(r['event'], r['machine'], r['port'], r['state'], r['ok'], r['attempts']) for r in records] == \
+           [('switch', 1, 1, 'on', True, 1), ('switch', 1, 2, 'on', True, 1)]
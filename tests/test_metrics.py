@@ -0,0 +1,72 @@
+import urllib.request
+
+import pytest
+
+from conftest import open_device
+from power_ctrl import aw2401
+from power_ctrl import connection_error
+from power_ctrl_metrics import histogram
+from power_ctrl_metrics import request_metrics
+from power_ctrl_metrics import serve_metrics
+
+def test_histogram_buckets_are_cumulative():
+    h = histogram()
+    for value in (0.0005, 0.003, 0.003, 20.0):
+        h.observe(value)
+
+    buckets = dict(h.cumulative())
+    assert buckets[0.001] == 1
+    assert buckets[0.005] == 3
+    assert buckets[10.0] == 3
+    assert buckets[float('inf')] == 4
+    assert h.max == 20.0
+
+def test_hooks_see_every_request(sim):
+    device = sim('sp8h').devices[0]
+    name = '{}:{}'.format(device.host, device.port)
+    metrics = request_metrics()
+    events = []
+    dev = open_device(device)
+    dev.hooks = [metrics, events.append]
+
+    dev.get_status(1)
+    dev.switch(1, 1, dev.POWER_ON)
+    dev.logout()
+
+    assert [e['op'] for e in events if e['event'] == 'request'] == ['get_status', 'switch', 'logout']
+    assert [e['ports'] for e in events if e['event'] == 'port_switch'] == [[1]]
+    assert metrics.responses[(name, 'switch', 200)] == 1
+    assert metrics.latency[(name, 'get_status')].count == 1
+    assert metrics.parse[(name, 'get_status')].count == 1
+
+def test_failures_are_counted_and_exported():
+    metrics = request_metrics()
+    dev = aw2401()
+    dev.target_url = '127.0.0.1'
+    dev.port = 1
+    dev.hooks = [metrics]
+    dev.connect()
+    with pytest.raises(connection_error):
+        dev.get_status()
+
+    text = metrics.prometheus_text()
+    assert '# TYPE power_ctrl_request_duration_seconds histogram' in text
+    assert 'power_ctrl_request_duration_seconds_count{device="127.0.0.1:1",op="get_status"} 1' in text
+    assert 'power_ctrl_request_duration_seconds_bucket{device="127.0.0.1:1",op="get_status",le="+Inf"} 1' in text
+    assert 'power_ctrl_request_errors_total{device="127.0.0.1:1",op="get_status",error="connection_error"} 1' in text
+
+def test_metrics_endpoint(sim):
+    device = sim('aw2401').devices[0]
+    metrics = request_metrics()
+    dev = open_device(device)
+    dev.hooks = [metrics]
+    dev.get_status()
+    server = serve_metrics(metrics, 0)
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        with urllib.request.urlopen(url) as r:
+            body = r.read().decode('utf-8')
+    finally:
+        server.shutdown()
+
+    assert 'power_ctrl_responses_total{{device="{}:{}",op="get_status",status="200"}} 1'.format(device.host, device.port) in body
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+from conftest import open_device
+from conftest import set_ports
+from power_ctrl import port_state
+from power_ctrl import port_status
+
+def test_ids_and_bits():
+    s = port_state.from_ids([1, 3, 8])
+
+    assert s.bits == 0b10000101
+    assert s.ids() == [1, 3, 8] == list(s)
+    assert len(s) == 3 and s and not port_state()
+    assert 3 in s and 2 not in s and 9 not in s
+    assert port_state.all(4).ids() == [1, 2, 3, 4]
+    assert port_state(0xff, 4) == port_state.all(4)
+    with pytest.raises(ValueError):
+        port_state.from_ids([5], 4)
+
+def test_operators():
+    a = port_state.from_ids([1, 2, 3])
+    b = port_state.from_ids([3, 4])
+
+    assert (a | b).ids() == a.union(b).ids() == [1, 2, 3, 4]
+    assert (a & b).ids() == a.mask(b).ids() == [3]
+    assert (a - b).ids() == [1, 2]
+    assert (a ^ b).ids() == a.diff(b).ids() == [1, 2, 4]
+    assert (~port_state.from_ids([1, 4], 4)).ids() == [2, 3]
+    assert a == port_state.from_ids([3, 2, 1]) and a != b
+    assert len({a, port_state.from_ids([1, 2, 3]), b}) == 2
+
+def test_status_state():
+    assert port_status(b'1001').state.ids() == [1, 4]
+    assert port_status(b'1001').state.ports == 4
+
+def test_switch_state_switches_only_the_differing_selected_ports(sim):
+    device = sim('sp8h').devices[0]
+    set_ports(device, 1, [1, 2], '1')
+    dev = open_device(device)
+
+    changed = dev.switch_state(1, port_state.from_ids([2, 3, 4]), port_state.from_ids([1, 2, 3]), interval=0.05)
+    dev.logout()
+    time.sleep(0.1)
+
+    assert changed.ids() == [1, 3]
+    dev = open_device(device)
+    assert dev.get_status(1).state.ids() == [2, 3]
+    dev.logout()
+
+def test_set_state_switches_in_one_request(sim):
+    device = sim('aw2401').devices[0]
+    set_ports(device, 0, [1, 2], '1')
+    dev = open_device(device)
+    requests = device.state.requests
+
+    dev.set_state(port_state.from_ids([3, 4], 4), port_state.from_ids([2, 3], 4))
+    time.sleep(0.1)
+
+    assert device.state.requests == requests + 1
+    assert open_device(device).get_status().state.ids() == [1, 3]
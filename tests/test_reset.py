@@ -0,0 +1,84 @@
+import time
+
+from conftest import device_conf
+from conftest import open_device
+from conftest import set_ports
+from power_ctrl_reset import reset_fleet
+
+OPTIONS = {'interval': 0.05, 'poll_interval': 0.05, 'settle_timeout': 2.0, 'off_time': 0.1}
+
+def results_of(resets):
+    return dict(((r.device, r.machine_id, r.power_id), r) for reset in resets for r in reset.results)
+
+def test_sp8h_reset_is_confirmed(sim):
+    fleet = sim('sp8h', 2)
+    for d in fleet.devices:
+        set_ports(d, 1, [1, 2], '1')
+        set_ports(d, 2, [8], '1')
+    targets = {'devices': [device_conf(d, name='r{}'.format(i), machines={'1': [1, 2], '2': [8]})
+                           for (i, d) in enumerate(fleet.devices)]}
+    reported = []
+
+    resets = reset_fleet(targets, deadline=10.0, on_result=reported.append, **OPTIONS)
+
+    results = results_of(resets)
+    assert len(results) == len(reported) == 6
+    for r in results.values():
+        assert r.result == 'confirmed'
+        assert r.off_seen_by == 'state'
+        assert r.off_after < r.on_after
+        assert r.ampere_before > 0 and r.ampere_min == 0.0
+
+def test_ignored_reset_is_unverified(sim):
+    device = sim('sp8h', ignore_reset=True).devices[0]
+    set_ports(device, 1, [1], '1')
+
+    resets = reset_fleet({'devices': [device_conf(device, machines={'1': [1]})]}, deadline=10.0,
+                         **dict(OPTIONS, settle_timeout=0.5))
+
+    (r,) = resets[0].results
+    assert r.result == 'unverified'
+    assert r.off_after is None
+
+def test_aw2401_stuck_port_does_not_keep_the_others_off(sim):
+    device = sim('aw2401', stuck_ports=(3,)).devices[0]
+    set_ports(device, 0, [1, 2, 3], '1')
+
+    resets = reset_fleet({'devices': [device_conf(device, ports=[1, 2, 3])]}, deadline=10.0,
+                         **dict(OPTIONS, settle_timeout=0.5))
+
+    results = dict((r.power_id, r.result) for r in resets[0].results)
+    assert results[1] == results[2] == 'confirmed'
+    assert results[3] != 'confirmed'
+    assert [p.state for p in device.state.ports[:3]] == ['1', '1', '1']
+
+def test_deadline_switches_aw2401_ports_on_again(sim):
+    device = sim('aw2401').devices[0]
+    set_ports(device, 0, [1, 2], '1')
+
+    start = time.monotonic()
+    resets = reset_fleet({'devices': [device_conf(device, ports=[1, 2])]}, deadline=0.02,
+                         **dict(OPTIONS, off_time=5.0))
+
+    assert time.monotonic() - start < 1.0
+    assert [r.result for r in resets[0].results] == ['failed', 'failed']
+    time.sleep(0.2)
+    assert [s[0] for s in open_device(device).get_status()[:2]] == ['1', '1']
+
+def test_ports_not_sent_by_the_deadline_are_skipped(sim):
+    device = sim('sp8h').devices[0]
+    set_ports(device, 1, [1, 2, 3], '1')
+
+    resets = reset_fleet({'devices': [device_conf(device, machines={'1': [1, 2, 3]})]}, deadline=0.5,
+                         **dict(OPTIONS, interval=0.7))
+
+    assert [r.result for r in resets[0].results][1:] == ['skipped', 'skipped']
+
+def test_unreachable_device_is_an_error(sim):
+    dead = {'name': 'dead', 'type': 'sp8h', 'ip': '127.0.0.1', 'port': 1, 'machines': {'1': [1]}}
+
+    resets = reset_fleet({'devices': [dead]}, deadline=5.0, **OPTIONS)
+
+    (r,) = resets[0].results
+    assert r.result == 'error'
+    assert r.error == resets[0].error
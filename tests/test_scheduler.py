@@ -0,0 +1,101 @@
+import threading
+import time
+
+from conftest import device_conf
+from conftest import open_device
+from power_ctrl_converge import sp8h_converger
+from power_ctrl_daemon import device_session
+from power_ctrl_scheduler import device_scheduler
+
+def recording(dev, sent):
+    """
+    An execute() for device_scheduler that notes the start time of every request.
+    """
+    def execute(func, retry):
+        sent.append(time.monotonic())
+        return func(dev)
+    return execute
+
+def test_concurrent_status_reads_are_coalesced(sim):
+    device = sim('sp8h', latency=0.05).devices[0]
+    dev = open_device(device)
+    with device_scheduler(dev) as sched:
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(sched.get_status(1))) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(results) == 10
+        assert all(r == results[0] for r in results)
+        assert sched.requests + sched.coalesced == 10
+        assert sched.requests <= 2
+    dev.logout()
+
+def test_switches_are_spaced_and_go_ahead_of_status_reads(sim):
+    # The latency keeps the first switch in flight until the others are queued.
+    device = sim('sp8h', latency=0.05).devices[0]
+    dev = open_device(device)
+    sent = []
+    with device_scheduler(dev, spacing=0.01, switch_spacing=0.3, execute=recording(dev, sent)) as sched:
+        first = sched.submit_switch(1, 1, dev.POWER_ON)
+        status = sched.submit_status(2)
+        second = sched.submit_switch(1, 2, dev.POWER_ON)
+        order = []
+        second.add_done_callback(lambda f: order.append('switch'))
+        status.add_done_callback(lambda f: order.append('status'))
+        first.result()
+        second.result()
+        status.result()
+
+    # The second switch was queued after the status read, but goes first, switch_spacing after the first.
+    assert order == ['switch', 'status']
+    assert sent[1] - sent[0] >= 0.3
+    dev.logout()
+
+def test_aw2401_switches_are_merged(sim):
+    device = sim('aw2401').devices[0]
+    dev = open_device(device)
+    with device_scheduler(dev, merge_window=0.1) as sched:
+        futures = [sched.submit_switch([1], dev.POWER_ON), sched.submit_switch([3], dev.POWER_ON),
+                   sched.submit_switch([1], dev.POWER_OFF)]
+        for f in futures:
+            f.result()
+
+        assert sched.merged == 2
+        assert sched.requests == 1
+
+    time.sleep(0.1)
+    # The later change of a port wins.
+    assert [s[0] for s in dev.get_status()] == ['0', '0', '1', '0']
+
+def test_scheduler_passes_device_errors_to_the_caller(sim):
+    device = sim('sp8h').devices[0]
+    dev = open_device(device)
+    with device_scheduler(dev) as sched:
+        try:
+            sched.switch(1, 1, 9)
+        except ValueError:
+            pass
+        else:
+            assert False, 'an invalid action must raise'
+        assert sched.get_status(1) is not None
+    dev.logout()
+
+def test_session_scheduler_spaces_switches_across_runs(sim):
+    device = sim('sp8h').devices[0]
+    session = device_session(device_conf(device))
+    switched = []
+    session.dev.hooks = [lambda e: switched.append(time.monotonic()) if e['event'] == 'request' and e['op'] == 'switch' else None]
+
+    # Two runs, each with a converger of its own, share the session's scheduler.
+    for pid in (1, 2):
+        sp8h_converger(session.scheduler, interval=0.05, poll_interval=0.05, deadline=2.0, settle=0.05).run(1, [pid], 1)
+    status = session.scheduler.get_status_all([1, 2])
+
+    assert switched[1] - switched[0] >= 0.65
+    assert sorted(status) == [1, 2]
+    assert session.scheduler.requests >= 5
+    with session.lock:
+        session.close()
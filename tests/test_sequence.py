@@ -0,0 +1,26 @@
+from conftest import open_device
+from power_ctrl_sequence import MIN_GAP
+from power_ctrl_sequence import sp8h_sequencer
+
+def test_sequencer_keeps_switches_apart(sim):
+    device = sim('sp8h').devices[0]
+    dev = open_device(device)
+    sequencer = sp8h_sequencer(dev, machine_budget=100.0, gap=0.1, poll_interval=0.05, settle_timeout=2.0)
+
+    results = sequencer.run({1: [1, 2]})
+
+    assert sequencer.gap == MIN_GAP
+    assert [r.state for r in results] == ['on', 'on']
+    assert results[1].sent_at - results[0].sent_at >= MIN_GAP
+    dev.logout()
+
+def test_sequencer_skips_what_never_fits_the_budget(sim):
+    device = sim('sp8h').devices[0]
+    dev = open_device(device)
+    sequencer = sp8h_sequencer(dev, machine_budget=1.0, port_load=1.0, inrush=3.0, poll_interval=0.05, settle_timeout=2.0)
+
+    (r,) = sequencer.run({1: [1]})
+
+    assert r.state == 'skipped'
+    assert device.state.machines[1][0].state == '0'
+    dev.logout()
@@ -0,0 +1,78 @@
+import json
+import multiprocessing
+import time
+
+from conftest import open_device
+from power_ctrl import session_cache
+from power_ctrl import sp8h
+
+def cached_device(device, cache):
+    dev = sp8h()
+    dev.user = dev.passwd = 'admin'
+    dev.target_url = device.host
+    dev.port = device.port
+    dev.session_cache = cache
+    dev.connect()
+    dev.login()
+    return dev
+
+def test_store_load_and_expiry(tmp_path):
+    cache = session_cache(str(tmp_path / 'sessions.json'), ttl=0.2)
+    cache.store('10.0.0.1', 80, 'admin', 'SID=1')
+
+    assert cache.load('10.0.0.1', 80, 'admin') == 'SID=1'
+    assert cache.load('10.0.0.1', 80, 'other') is None
+    cache.invalidate('10.0.0.1', 80, 'admin', 'SID=2')
+    assert cache.load('10.0.0.1', 80, 'admin') == 'SID=1'
+    time.sleep(0.25)
+    assert cache.load('10.0.0.1', 80, 'admin') is None
+
+def hold_lock(path, ready, seconds):
+    with session_cache(path):
+        ready.set()
+        time.sleep(seconds)
+
+def test_lock_serializes_processes(tmp_path):
+    path = str(tmp_path / 'sessions.json')
+    ready = multiprocessing.Event()
+    holder = multiprocessing.Process(target=hold_lock, args=(path, ready, 0.3))
+    holder.start()
+    ready.wait(5)
+
+    start = time.monotonic()
+    session_cache(path).store('10.0.0.1', 80, 'admin', 'SID=1')
+    holder.join()
+
+    assert time.monotonic() - start >= 0.2
+
+def test_second_run_reuses_the_session(sim, tmp_path):
+    device = sim('sp8h', max_login_users=1).devices[0]
+    cache = session_cache(str(tmp_path / 'sessions.json'))
+
+    first = cached_device(device, cache)
+    first.get_status(1)
+    first.disconnect()
+    second = cached_device(device, cache)
+
+    assert second.session_reused
+    assert len(second.get_status(1)) == 8
+    # The login slot is still the first run's: a fresh login would have been refused.
+    second.logout()
+    assert cache.load(device.host, device.port, 'admin') is None
+    open_device(device).logout()
+
+def test_requests_refresh_the_expiry_past_half_its_lifetime(sim, tmp_path):
+    device = sim('sp8h').devices[0]
+    path = str(tmp_path / 'sessions.json')
+    dev = cached_device(device, session_cache(path, ttl=0.4))
+    expires = dev.session_expires
+
+    dev.get_status(1)
+    assert dev.session_expires == expires
+    time.sleep(0.25)
+    dev.get_status(1)
+
+    assert dev.session_expires > expires
+    with open(path) as f:
+        assert list(json.load(f).values())[0]['expires'] == dev.session_expires
+    dev.logout()
@@ -0,0 +1,9 @@
+from power_ctrl import parse_sp8h_status
+from power_ctrl import port_status
+
+def test_status_keeps_the_ampere_strings():
+    status = parse_sp8h_status(b"[['P1','P2'],['1','0'],['0.10','0.00']]")
+
+    assert list(status) == [['1', '0.10'], ['0', '0.00']]
+    assert list(status.amperes) == [0.1, 0.0]
+    assert list(port_status(b'1', amperes=[0.25])) == [['1', '0.25']]
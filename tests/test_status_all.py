@@ -0,0 +1,32 @@
+import time
+
+from conftest import open_device
+from conftest import set_ports
+
+def test_reads_every_machine_in_order(sim):
+    device = sim('sp8h').devices[0]
+    set_ports(device, 3, [5], '1')
+    dev = open_device(device)
+    dev.status_connections = 3
+
+    status = dev.get_status_all([4, 3, 1, 3])
+    dev.logout()
+
+    assert list(status) == [4, 3, 1]
+    assert [status[mid].state.ids() for mid in status] == [[], [5], []]
+    assert device.state.logins == 1
+
+def test_renews_an_expired_session(sim):
+    device = sim('sp8h', session_timeout=0.2).devices[0]
+    set_ports(device, 2, [1, 8], '1')
+    dev = open_device(device)
+    dev.get_status_all([1, 2, 3, 4])
+
+    time.sleep(0.4)
+    status = dev.get_status_all([1, 2, 3, 4])
+    dev.logout()
+
+    assert list(status) == [1, 2, 3, 4]
+    assert [len(s) for s in status.values()] == [8, 8, 8, 8]
+    assert status[2].state.ids() == [1, 8]
+    assert device.state.logins == 2
@@ -0,0 +1,53 @@
+import time
+
+from conftest import open_device
+from power_ctrl import status_cache
+
+def test_hit_miss_expiry_and_eviction():
+    cache = status_cache(ttl=0.1, max_entries=2)
+    assert cache.get('a') is None
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    # 'b' is the least recently used now.
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    time.sleep(0.15)
+    assert cache.get('a') is None
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 3, 1)
+
+def test_invalidate_holds_off_caching():
+    cache = status_cache(ttl=10, hold_off=0.1)
+    cache.put('a', 1)
+    cache.invalidate('a')
+
+    assert cache.get('a') is None
+    cache.put('a', 2)
+    assert cache.get('a') is None
+    time.sleep(0.15)
+    cache.put('a', 3)
+    assert cache.get('a') == 3
+    assert cache.stats()['invalidations'] == 1
+
+def test_switch_invalidates_the_machine(sim):
+    device = sim('sp8h').devices[0]
+    dev = open_device(device)
+    dev.status_cache = status_cache(ttl=10, hold_off=0.2)
+
+    dev.get_status(1)
+    dev.get_status(2)
+    requests = device.state.requests
+    dev.get_status(1)
+    dev.get_status(2)
+    assert device.state.requests == requests
+
+    dev.switch(1, 1, dev.POWER_ON)
+    requests = device.state.requests
+    dev.get_status(1)
+    dev.get_status(1)
+    dev.get_status(2)
+    # Machine 1 is read from the device during the hold off, machine 2 is still cached.
+    assert device.state.requests == requests + 2
+    dev.logout()
@@ -0,0 +1,79 @@
+import io
+import struct
+import sys
+
+import pytest
+
+from conftest import device_conf
+from conftest import set_ports
+from power_ctrl_telemetry import ring_buffer
+from power_ctrl_telemetry import telemetry_poller
+
+def filled(capacity, samples):
+    buf = ring_buffer(capacity, 2)
+    for (i, sample) in enumerate(samples):
+        buf.append(100.0 + i, sample)
+    return buf
+
+@pytest.fixture(params=['pure', 'numpy'])
+def summary_impl(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        # A None entry makes "import numpy" fail.
+        monkeypatch.setitem(sys.modules, 'numpy', None)
+    return request.param
+
+def test_ring_buffer_keeps_the_newest_samples(summary_impl):
+    buf = filled(3, [[('1', '1.0'), ('0', '0.0')],
+                     [('1', '2.0'), ('0', '0.0')],
+                     [('0', '0.0'), ('1', '4.0')],
+                     [('1', '3.0'), ('1', '2.0')]])
+
+    assert len(buf) == 3
+    assert [row[0] for row in buf.rows()][::2] == [101.0, 102.0, 103.0]
+    (p1, p2) = buf.summary()
+    assert p1 == {'port': 1, 'samples': 3, 'on': pytest.approx(2 / 3), 'min': 0.0, 'max': 3.0, 'mean': pytest.approx(5 / 3)}
+    assert p2['on'] == pytest.approx(2 / 3) and p2['max'] == 4.0
+
+    # [start, end) over the wrapped window.
+    (p1, p2) = buf.summary(102.0, 104.0)
+    assert p1['samples'] == 2 and p1['mean'] == pytest.approx(1.5)
+    assert buf.summary(200.0) == []
+
+def test_ring_buffer_without_amperes(summary_impl):
+    buf = filled(4, [[('1', None), ('0', None)]] * 2)
+
+    (p1, p2) = buf.summary()
+    assert p1['on'] == 1.0 and p2['on'] == 0.0
+    assert p1['min'] is None and p1['mean'] is None
+
+def test_export_npy_header_and_rows():
+    buf = filled(2, [[('1', '1.5'), ('0', '0.0')], [('0', '0.0'), ('1', '2.5')], [('1', '0.5'), ('1', '0.5')]])
+    f = io.BytesIO()
+    buf.export_npy(f)
+    data = f.getvalue()
+
+    (length,) = struct.unpack('<H', data[8:10])
+    assert data[:8] == b'\x93NUMPY\x01\x00'
+    assert (10 + length) % 64 == 0
+    assert b"'shape': (2, 5)" in data[10:10 + length]
+    values = struct.unpack('<10d', data[10 + length:])
+    assert values[:5] == (101.0, 0.0, 1.0, 0.0, 2.5)
+    assert values[5:] == (102.0, 1.0, 1.0, 0.5, 0.5)
+
+def test_poller_samples_devices_and_counts_failures(sim):
+    device = sim('sp8h').devices[0]
+    set_ports(device, 1, [2], '1')
+    dead = {'name': 'dead', 'type': 'aw2401', 'ip': '127.0.0.1', 'port': 1}
+    poller = telemetry_poller([device_conf(device, 'rack1', machines=[1, 2]), dead], interval=0.05, capacity=16)
+
+    poller.poll_once()
+    poller.poll_once()
+
+    summary = poller.summary()
+    assert sorted(summary) == [('rack1', 1), ('rack1', 2)]
+    assert [p['on'] for p in summary[('rack1', 1)][:3]] == [0.0, 1.0, 0.0]
+    assert summary[('rack1', 1)][0]['samples'] == 2
+    assert poller.errors['dead'] == 2
+    poller.close()
@@ -0,0 +1,64 @@
+import threading
+
+from conftest import device_conf
+from conftest import set_ports
+from power_ctrl_daemon import device_session
+from power_ctrl_watch import status_watcher
+
+def watch(device, **options):
+    session = device_session(device_conf(device))
+    return status_watcher(session, [1] if device.state.kind == 'sp8h' else [0], **options)
+
+def test_reports_every_port_first_then_only_changes(sim):
+    device = sim('sp8h').devices[0]
+    watcher = watch(device)
+
+    first = watcher.poll()
+    assert [(c['port'], c['state'], c['previous_state']) for c in first] == [(i, '0', None) for i in range(1, 9)]
+    assert watcher.poll() == []
+
+    set_ports(device, 1, [3], '1')
+    (change,) = watcher.poll()
+    assert (change['machine'], change['port'], change['state'], change['previous_state']) == (1, 3, '1', '0')
+    assert change['previous_ampere'] == 0.0 and change['ampere'] > 0
+    assert watcher.poll() == []
+    watcher.session.scheduler.close()
+
+def test_ampere_threshold(sim):
+    device = sim('sp8h').devices[0]
+    port = device.state.machines[1][0]
+    port.load = 1.0
+    set_ports(device, 1, [1], '1')
+    watcher = watch(device, threshold=0.2)
+    watcher.poll()
+
+    port.load = 1.1
+    assert watcher.poll() == []
+    port.load = 1.3
+    (change,) = watcher.poll()
+    assert (change['port'], change['state'], change['previous_state']) == (1, '1', '1')
+    assert (change['previous_ampere'], change['ampere']) == (1.0, 1.3)
+    # Measured from the value last reported, not the last read.
+    port.load = 1.45
+    assert watcher.poll() == []
+    watcher.session.scheduler.close()
+
+def test_run_reports_a_switch_and_backs_off(sim):
+    device = sim('aw2401').devices[0]
+    watcher = watch(device, min_interval=0.05, max_interval=0.2, backoff=2.0)
+    reported = []
+    thread = threading.Thread(target=watcher.run, args=(reported.append, 2.0))
+    thread.start()
+    try:
+        while watcher.interval < 0.2 and thread.is_alive():
+            watcher.stopping.wait(0.02)
+        set_ports(device, 0, [2], '1')
+        watcher.poke()
+        while len(reported) < 5 and thread.is_alive():
+            watcher.stopping.wait(0.02)
+    finally:
+        watcher.stop()
+        thread.join()
+        watcher.session.scheduler.close()
+
+    assert [(c['port'], c['state']) for c in reported] == [(1, '0'), (2, '0'), (3, '0'), (4, '0'), (2, '1')]